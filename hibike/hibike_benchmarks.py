@@ -0,0 +1,313 @@
+"""
+Micro-benchmarks for the Hibike codec.
+
+Each benchmark runs over a mix of packets with every device type in
+hibikeDevices.json: the `DeviceData` its subscription sends (all readable
+params) and the `DeviceWrite` that sets all its writable params, with
+random but plausible values. Results are in packets per second.
+
+Run from the hibike/ directory:
+
+    PYTHONPATH=../runtime python3 hibike_benchmarks.py [--output FILE]
+
+The run fails if any benchmark is more than `--tolerance` slower than the
+baseline in hibike_benchmarks_baseline.json. To make runs on a busy
+machine comparable, rates are compared relative to the speed of a fixed
+pure-Python loop timed alongside them, and a benchmark that looks slower
+is run again, up to `--rounds` times in all, keeping its best result.
+Pinning the run to one CPU with `--cpu` makes it steadier still.
+
+Relative rates still depend on the CPU and Python version, so a baseline
+is only checked against runs on the same machine type and Python; other
+runs just print the differences. The committed baseline is from x86_64.
+To check on another platform, such as the robot's Raspberry Pi, save a
+baseline for it there and pass it with `--baseline`:
+
+    PYTHONPATH=../runtime python3 hibike_benchmarks.py --save-baseline \
+        --baseline hibike_benchmarks_baseline_armv7l.json
+
+Regenerate a baseline with `--save-baseline` after a deliberate change in
+speed, or when moving to a new Python version.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import struct
+import sys
+import time
+
+from runtime import hibike_message as hm
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "hibike_benchmarks_baseline.json")
+# How slower than the baseline a benchmark may be before the run fails
+DEFAULT_TOLERANCE = 0.3
+# How many times at most to run a benchmark, keeping the best result
+ROUNDS = 3
+# How many times to time each benchmark
+REPEATS = 15
+# Minimum time in seconds for each timing
+MIN_TIME = 0.02
+
+
+def random_value(param_type, rand):
+    """
+    A random value of PARAM_TYPE, in the range a device would send.
+    """
+    if param_type == "bool":
+        return rand.random() < 0.5
+    if param_type in ("float", "double"):
+        return rand.uniform(-1, 1)
+    size = struct.calcsize(hm.PARAM_TYPES[param_type])
+    if param_type.startswith("u"):
+        return rand.randrange(2 ** (8 * size))
+    return rand.randrange(-2 ** (8 * size - 1), 2 ** (8 * size - 1))
+
+
+def make_packet_mix(seed=0):
+    """
+    A list of (device ID, HibikeMessage) with the `DeviceData` and
+    `DeviceWrite` packets of every device type.
+    """
+    rand = random.Random(seed)
+    mix = []
+    for device_id in sorted(hm.DEVICES):
+        params = hm.all_params_for_device_id(device_id)
+        readable = [param for param in params if hm.readable(device_id, param)]
+        writable = [param for param in params if hm.writable(device_id, param)]
+        if readable:
+            values = [(param, random_value(hm.param_type(device_id, param), rand))
+                      for param in readable]
+            mix.append((device_id, hm.make_device_data(device_id, values)))
+        if writable:
+            values = [(param, random_value(hm.param_type(device_id, param), rand))
+                      for param in writable]
+            mix.append((device_id, hm.make_device_write(device_id, values)))
+    return mix
+
+
+def make_benchmarks(mix):
+    """
+    Benchmark names -> (function running one pass, packets per pass).
+    """
+    data = [(device_id, message) for device_id, message in mix
+            if message.get_message_id() == hm.MESSAGE_TYPES["DeviceData"]]
+    writes = [(device_id, hm.decode_device_write(message, device_id))
+              for device_id, message in mix
+              if message.get_message_id() == hm.MESSAGE_TYPES["DeviceWrite"]]
+    subscriptions = [(device_id, hm.decode_params(device_id, struct.unpack_from(
+        "<H", message.payload)[0])) for device_id, message in data]
+    encoded = [bytes(hm.encode(message)) for _, message in mix]
+    frames = []
+    for _, message in mix:
+        frame = message.to_bytes()
+        frame.append(hm.checksum(frame))
+        frames.append(bytes(frame))
+    cobs_frames = [bytes(hm.cobs_encode(frame)) for frame in frames]
+    unchecked = [frame[:-1] for frame in frames]
+
+    def parse_bytes():
+        for packet in encoded:
+            hm.parse_bytes(packet)
+
+    def parse_device_data():
+        for device_id, message in data:
+            hm.parse_device_data(message, device_id)
+
+    def make_device_write():
+        for device_id, params_and_values in writes:
+            hm.make_device_write(device_id, params_and_values)
+
+    def make_subscription_request():
+        for device_id, params in subscriptions:
+            hm.make_subscription_request(device_id, params, 40)
+
+    def cobs_encode():
+        for frame in frames:
+            hm.cobs_encode(frame)
+
+    def cobs_decode():
+        for frame in cobs_frames:
+            hm.cobs_decode(frame)
+
+    def checksum():
+        for frame in unchecked:
+            hm.checksum(frame)
+
+    def validate_checksums():
+        hm.validate_checksums(frames)
+
+    return {
+        "parse_bytes": (parse_bytes, len(encoded)),
+        "parse_device_data": (parse_device_data, len(data)),
+        "make_device_write": (make_device_write, len(writes)),
+        "make_subscription_request": (make_subscription_request, len(subscriptions)),
+        "cobs_encode": (cobs_encode, len(frames)),
+        "cobs_decode": (cobs_decode, len(cobs_frames)),
+        "checksum": (checksum, len(unchecked)),
+        "validate_checksums": (validate_checksums, len(frames)),
+    }
+
+
+def reference_loop():
+    """
+    A fixed amount of plain Python work, to measure the speed of the machine.
+    """
+    total = 0
+    for i in range(1000):
+        total ^= i
+    return total
+
+
+def calibrate(func, min_time=MIN_TIME):
+    """
+    How many calls of FUNC take at least MIN_TIME seconds.
+    """
+    calls = 1
+    while time_calls(func, calls) < min_time:
+        calls *= 2
+    return calls
+
+
+def time_calls(func, calls):
+    """
+    How many seconds CALLS calls of FUNC take.
+    """
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return time.perf_counter() - start
+
+
+def time_benchmark(func, packets, repeats=REPEATS, min_time=MIN_TIME):
+    """
+    Time FUNC, which processes PACKETS packets per call, REPEATS times.
+
+    Each timing is paired with a timing of `reference_loop`, so that the
+    machine getting slower or faster partway through affects both.
+
+    Returns:
+        The best rate in packets per second, and the median rate relative
+        to the rate of `reference_loop`.
+    """
+    # Warm up first, so one-time work like lazy imports isn't calibrated for
+    func()
+    calls = calibrate(func, min_time)
+    reference_calls = calibrate(reference_loop, min_time)
+    rates = []
+    relative_rates = []
+    for _ in range(repeats):
+        reference_rate = reference_calls / time_calls(reference_loop, reference_calls)
+        rate = calls * packets / time_calls(func, calls)
+        rates.append(rate)
+        relative_rates.append(rate / reference_rate)
+    return max(rates), statistics.median(relative_rates)
+
+
+def run_benchmarks(repeats=REPEATS, min_time=MIN_TIME, rounds=ROUNDS, good_enough=None):
+    """
+    Run every benchmark up to ROUNDS times, returning the best result of
+    each in a form suitable for saving as JSON.
+
+    A benchmark isn't run again once its relative rate reaches its entry in
+    GOOD_ENOUGH, if it has one. Without GOOD_ENOUGH, every round is run.
+    """
+    good_enough = good_enough or {}
+    rates = {}
+    relative_rates = {}
+    for name, (func, packets) in make_benchmarks(make_packet_mix()).items():
+        for _ in range(rounds):
+            rate, relative_rate = time_benchmark(func, packets, repeats, min_time)
+            if relative_rate > relative_rates.get(name, 0):
+                rates[name] = round(rate)
+                relative_rates[name] = round(relative_rate, 3)
+            if name in good_enough and relative_rates[name] >= good_enough[name]:
+                break
+    return {"python": platform.python_version(),
+            "machine": platform.machine(),
+            "packets_per_second": rates,
+            "relative_to_reference": relative_rates}
+
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    A list of (benchmark, relative rate, relative baseline rate) for every
+    benchmark in both RESULTS and BASELINE that is more than TOLERANCE
+    slower than the baseline.
+    """
+    regressions = []
+    rates = results["relative_to_reference"]
+    for name, base_rate in baseline["relative_to_reference"].items():
+        rate = rates.get(name)
+        if rate is not None and rate < base_rate * (1 - tolerance):
+            regressions.append((name, rate, base_rate))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Hibike codec.")
+    parser.add_argument("--output", metavar="FILE", help="Save the results as JSON to FILE.")
+    parser.add_argument("--baseline", metavar="FILE", default=BASELINE_FILE,
+                        help="The baseline to compare against.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Save the results as the new baseline instead of comparing.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="How much slower than the baseline, as a fraction, is a failure.")
+    parser.add_argument("--rounds", type=int, default=ROUNDS,
+                        help="How many times at most to run each benchmark.")
+    parser.add_argument("--cpu", type=int, metavar="N",
+                        help="Run only on CPU N, where supported.")
+    arguments = parser.parse_args()
+
+    if arguments.cpu is not None:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, {arguments.cpu})
+        else:
+            print("Warning: can't pin to a CPU on this platform")
+    baseline = None
+    if not arguments.save_baseline and os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    good_enough = None
+    if baseline is not None:
+        good_enough = {name: base_rate * (1 - arguments.tolerance)
+                       for name, base_rate in baseline["relative_to_reference"].items()}
+    results = run_benchmarks(rounds=arguments.rounds, good_enough=good_enough)
+    rates = results["relative_to_reference"]
+    base_rates = baseline["relative_to_reference"] if baseline is not None else {}
+    for name, rate in results["packets_per_second"].items():
+        line = "{:<28}{:>14,} packets/s".format(name, rate)
+        if name in base_rates:
+            line += "  {:+.1%}".format(rates[name] / base_rates[name] - 1)
+        print(line)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("Saved baseline to {}".format(arguments.baseline))
+        return
+    if baseline is None:
+        print("No baseline at {}; run with --save-baseline to make one".format(
+            arguments.baseline))
+        return
+    if (baseline["machine"], baseline["python"]) != (results["machine"], results["python"]):
+        print("The baseline is from Python {} on {}, so it isn't checked; save one for this "
+              "platform with --save-baseline --baseline FILE".format(baseline["python"],
+                                                                     baseline["machine"]))
+        return
+    regressions = find_regressions(results, baseline, arguments.tolerance)
+    for name, rate, base_rate in regressions:
+        print("REGRESSION: {} is {:.0%} slower than the baseline".format(
+            name, 1 - rate / base_rate))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,20 @@ Unit tests for functions in hibike_message.
 
 
 import unittest
+import importlib.util
+import json
+import os
 import random
 import queue
+import tempfile
 import time
 import threading
 
 import serial
 
-from runtime import hibike_message
+from runtime import hibike_message, device_schema
 import spawn_virtual_devices
+import hibike_benchmarks
 from hibike_tests.utils import run_with_random_data
 
 DEVICE_TYPES = list(hibike_message.DEVICES)
@@ -74,6 +79,78 @@ class CobsTests(unittest.TestCase):
         run_with_random_data(assert_encode_decode_equal, CobsTests.gen_cobs_data, times=100)
 
 
+class ChecksumTests(unittest.TestCase):
+    """ Tests for computing and validating checksums. """
+    @staticmethod
+    def gen_messages(count):
+        """ Generate COUNT messages of random lengths ending with their checksums. """
+        messages = []
+        for _ in range(count):
+            message = bytearray(random.getrandbits(8) for _ in range(random.randrange(2, 40)))
+            message.append(hibike_message.checksum(message))
+            messages.append(message)
+        return messages
+
+    def test_checksum_is_xor(self):
+        """ The checksum should be the XOR of every byte, for any length. """
+        for length in range(1, 300):
+            data = bytes(random.getrandbits(8) for _ in range(length))
+            expected = 0
+            for byte in data:
+                expected ^= byte
+            self.assertEqual(hibike_message.checksum(data), expected,
+                             "wrong checksum for {}".format(list(data)))
+
+    def test_validate_checksums(self):
+        """ Only messages that were corrupted should fail validation. """
+        for count in (1, 5, hibike_message.NUMPY_BATCH_MIN_MESSAGES, 100):
+            messages = self.gen_messages(count)
+            corrupted = set(random.sample(range(count), count // 3))
+            for i in corrupted:
+                messages[i][-1] ^= 1 << random.randrange(8)
+            expected = [i not in corrupted for i in range(count)]
+            self.assertEqual(hibike_message.validate_checksums(messages), expected)
+
+    @unittest.skipUnless(hibike_message.USING_NUMPY, "NumPy is not installed")
+    def test_validate_checksums_without_numpy(self):
+        """ Large batches should be validated the same with or without NumPy. """
+        messages = self.gen_messages(100)
+        for message in random.sample(messages, 30):
+            message[random.randrange(len(message))] ^= 0xFF
+        with_numpy = hibike_message.validate_checksums(messages)
+        hibike_message.USING_NUMPY = False
+        try:
+            without_numpy = hibike_message.validate_checksums(messages)
+        finally:
+            hibike_message.USING_NUMPY = True
+        self.assertEqual(with_numpy, without_numpy)
+
+
+class EncodeCachedTests(unittest.TestCase):
+    """ Tests for sending pre-encoded constant messages. """
+    def test_same_bytes_as_encode(self):
+        """ Cached frames should be exactly what encoding the message gives. """
+        device_id = random.choice(DEVICE_TYPES)
+        cases = [(hibike_message.make_ping, ()),
+                 (hibike_message.make_disable, ()),
+                 (hibike_message.make_heartbeat_request, (3,)),
+                 (hibike_message.make_heartbeat_response, (0, 50)),
+                 (hibike_message.make_heartbeat_response, (0, None)),
+                 (hibike_message.make_subscription_request, (device_id, (), 0))]
+        for make_message, args in cases:
+            cached = hibike_message.encode_cached(make_message, *args)
+            self.assertEqual(cached, hibike_message.encode(make_message(*args)))
+            self.assertIs(hibike_message.encode_cached(make_message, *args), cached)
+
+    def test_send_cached(self):
+        """ Sending cached bytes should write them as they are. """
+        port = FakeSerialPort()
+        cached = hibike_message.encode_cached(hibike_message.make_disable)
+        hibike_message.send(port, cached)
+        packet = hibike_message.parse_bytes(port.drain())
+        self.assertEqual(packet.get_message_id(), hibike_message.MESSAGE_TYPES["Disable"])
+
+
 class FakeSerialPort(object):
     """ A fake serial port that acts as a queue. """
     def __init__(self):
@@ -131,6 +208,14 @@ class ParamsTests(unittest.TestCase):
         run_with_random_data(assert_params_same,
                              self.gen_random_device_id_and_params, times=1000)
 
+    def test_codec_is_reused(self):
+        """ Looking up the same set of params twice should return the same codec. """
+        device_id = hibike_message.device_name_to_id("YogiBear")
+        first = hibike_message.CODECS.for_params(device_id, ["enc_pos", "duty_cycle"])
+        second = hibike_message.CODECS.for_params(device_id, ["duty_cycle", "enc_pos"])
+        self.assertIs(first, second)
+        self.assertEqual(first.params, ("duty_cycle", "enc_pos"))
+
 
 class ParsingTests(unittest.TestCase):
     """ Tests for parsing Hibike messages. """
@@ -236,6 +321,28 @@ class ParsingTests(unittest.TestCase):
                 run_with_random_data(assert_parse_is_not_none,
                                      func, times=100)
 
+    def test_device_data_round_trip(self):
+        """ Values packed into a DeviceData should decode to the same values. """
+        def assert_round_trip(device_id, params):
+            """ Check that PARAMS survive an encode and decode. """
+            values = random_values(device_id, params)
+            msg = hibike_message.make_device_data(device_id, zip(params, values))
+            decoded = dict(hibike_message.parse_device_data(msg, device_id))
+            self.assertEqual(sorted(decoded), sorted(params))
+            for param, value in zip(params, values):
+                self.assertAlmostEqual(decoded[param], value, places=5)
+
+        run_with_random_data(assert_round_trip,
+                             ParamsTests.gen_random_device_id_and_params, times=100)
+
+    def test_parsed_payload_is_read_only_view(self):
+        """ Parsed messages should expose their payload without copying it. """
+        packet = self.gen_random_sub_response()[0]
+        parse_result = hibike_message.parse_bytes(packet)
+        self.assertIsInstance(parse_result.payload, memoryview)
+        self.assertTrue(parse_result.payload.readonly)
+        self.assertEqual(bytes(parse_result.payload), bytes(parse_result.get_payload()))
+
     def test_parse_bad_checksum(self):
         """ Packets with bad checksums should not be parsed. """
         def screw_up_checksum(valid_packet):
@@ -275,6 +382,131 @@ class ParsingTests(unittest.TestCase):
                 run_with_random_data(assert_parse_idempotent, func, times=100)
 
 
+class PacketFramerTests(unittest.TestCase):
+    """ Tests for PacketFramer. """
+    NUM_PACKETS = 40
+
+    @staticmethod
+    def gen_packets(count):
+        """ Generate COUNT encoded packets and their message IDs. """
+        device_id = hibike_message.device_name_to_id("YogiBear")
+        params = hibike_message.all_params_for_device_id(device_id)
+        packets = bytearray()
+        for _ in range(count):
+            values = [random.random() for _ in params]
+            msg = hibike_message.make_device_data(device_id, zip(params, values))
+            packets.extend(ParsingTests.encode_packet(msg))
+        return packets
+
+    def test_many_packets_in_one_read(self):
+        """ Every packet in a single large read should come out. """
+        framer = hibike_message.PacketFramer()
+        packets = framer.feed(self.gen_packets(self.NUM_PACKETS))
+        self.assertEqual(len(packets), self.NUM_PACKETS)
+        self.assertEqual(framer.resyncs, 0)
+
+    def test_packets_split_across_reads(self):
+        """ Packets split at arbitrary points should be reassembled. """
+        framer = hibike_message.PacketFramer()
+        data = self.gen_packets(self.NUM_PACKETS)
+        packets = []
+        while data:
+            chunk_len = random.randrange(1, 20)
+            packets.extend(framer.feed(data[:chunk_len]))
+            data = data[chunk_len:]
+        self.assertEqual(len(packets), self.NUM_PACKETS)
+
+    def test_resync_after_garbage(self):
+        """ Garbage and truncated packets should be skipped and counted. """
+        framer = hibike_message.PacketFramer()
+        good = self.gen_packets(2)
+        truncated = self.gen_packets(1)[:10]
+        packets = framer.feed(bytearray(b"\x01\x02\x03") + truncated + good)
+        self.assertEqual(len(packets), 2)
+        self.assertEqual(framer.resyncs, 2)
+
+    def test_bad_checksum_counted(self):
+        """ Packets with bad checksums should be dropped and counted. """
+        framer = hibike_message.PacketFramer()
+        data = self.gen_packets(3)
+        data[-2] = data[-2] + 1 if data[-2] < 255 else data[-2] - 1
+        packets = framer.feed(data)
+        self.assertEqual(len(packets), 2)
+        self.assertEqual(framer.checksum_errors, 1)
+
+    def test_bad_checksums_in_large_read(self):
+        """ Bad checksums should be caught in reads large enough to batch. """
+        framer = hibike_message.PacketFramer()
+        device_id = hibike_message.device_name_to_id("YogiBear")
+        params = hibike_message.all_params_for_device_id(device_id)
+        data = bytearray()
+        for i in range(self.NUM_PACKETS):
+            msg = hibike_message.make_device_data(device_id, zip(params, [i] * len(params)))
+            frame = msg.to_bytes()
+            frame.append(hibike_message.checksum(frame) ^ (i % 4 == 0))
+            encoded = hibike_message.cobs_encode(frame)
+            data.extend(bytes((0, len(encoded))) + encoded)
+        packets = framer.feed(data)
+        bad = len(range(0, self.NUM_PACKETS, 4))
+        self.assertEqual(len(packets), self.NUM_PACKETS - bad)
+        self.assertEqual(framer.checksum_errors, bad)
+        self.assertEqual(framer.resyncs, 0)
+
+
+class DeviceSchemaTests(unittest.TestCase):
+    """
+    Tests for the device lookup tables.
+    """
+    def test_generated_tables_match_json(self):
+        """ The generated module should hold the same tables as the JSON. """
+        with open(device_schema.SCHEMA_FILE) as schema:
+            expected = device_schema.build_tables(json.load(schema))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "device_tables.py")
+            device_schema.generate(generated_file=path)
+            spec = importlib.util.spec_from_file_location("device_tables", path)
+            generated = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(generated)
+        with open(device_schema.SCHEMA_FILE, "rb") as schema:
+            self.assertEqual(generated.SCHEMA_DIGEST, device_schema.schema_digest(schema.read()))
+        for name in device_schema.TABLE_NAMES:
+            self.assertEqual(getattr(generated, name), expected[name])
+
+    def test_names_and_ids(self):
+        """ Names and IDs should map to each other, and unknown ones should be rejected. """
+        for device_id, device in hibike_message.DEVICES.items():
+            self.assertEqual(hibike_message.device_id_to_name(device_id), device["name"])
+            self.assertEqual(hibike_message.device_name_to_id(device["name"]), device_id)
+        with self.assertRaises(hibike_message.HibikeMessageException):
+            hibike_message.device_name_to_id("NotADevice")
+        with self.assertRaises(hibike_message.HibikeMessageException):
+            hibike_message.device_id_to_name(max(hibike_message.DEVICES) + 1)
+        with self.assertRaises(TypeError):
+            hibike_message.PARAM_MAP[0]["switch0"] = None
+
+
+class BenchmarkTests(unittest.TestCase):
+    """
+    Tests for the codec benchmarks.
+    """
+    def test_mix_covers_every_device(self):
+        """ Every device type should have packets in the mix. """
+        mix = hibike_benchmarks.make_packet_mix()
+        self.assertEqual({device_id for device_id, _ in mix}, set(hibike_message.DEVICES))
+
+    def test_regressions_found(self):
+        """ Only benchmarks slower than the tolerance allows should be regressions. """
+        results = hibike_benchmarks.run_benchmarks(repeats=1, min_time=0.001, rounds=1)
+        self.assertEqual(set(results["relative_to_reference"]),
+                         set(hibike_benchmarks.make_benchmarks([])))
+        baseline = {"relative_to_reference": dict(results["relative_to_reference"])}
+        self.assertEqual(hibike_benchmarks.find_regressions(results, baseline), [])
+        baseline["relative_to_reference"]["checksum"] *= 2
+        self.assertEqual([name for name, _, _ in
+                          hibike_benchmarks.find_regressions(results, baseline, 0.25)],
+                         ["checksum"])
+
+
 class BlockingReadGeneratorTests(unittest.TestCase):
     """ Tests for blocking_read_generator. """
     DUMMY_DEVICE_TYPE = "LimitSwitch"
@@ -2,18 +2,41 @@
 Unit tests for functions in hibike_process.
 """
 import asyncio
+import multiprocessing
+import os
+import queue
 import random
+import select
+import struct
+import tempfile
+import threading
 import time
 import unittest
+from unittest import mock
 
 import aioprocessing
 import serial
 
 from spawn_virtual_devices import spawn_device, get_virtual_ports
-from hibike_tests.utils import AsyncTestCase
+from hibike_tests.utils import AsyncTestCase, FakeTransport
 from hibike_tester import Hibike
 from runtime import hibike_message as hm
-from runtime.hibike_process import hotplug_async
+from runtime.util import BAD_EVENTS
+from runtime.hibike_process import (hotplug_async, CoalescedWriter, diff_sensor_values,
+                                    HOTPLUG_RESCAN_INTERVAL, IDENTIFY_TIMEOUT, IdentifyStats,
+                                    RATE_CONTROL_MAX_DELAY,
+                                    monitor_liveness, LIVENESS_DISCONNECT_TIMEOUT, Histogram,
+                                    LinkMetricsRegistry, hibike_front_end, shard_for_port,
+                                    InstructionScheduler, DataBatcher, BATCH_MAX_LATENCY,
+                                    disable_on_emergency_stop, forget_values)
+from runtime.emergency_stop import EmergencyStop
+from runtime.event_loops import LoopLagMonitor
+from runtime.hotplug import InotifyWatcher, USING_INOTIFY
+from runtime.port_cache import PortCache
+from runtime import sensor_table
+from runtime.sensor_table import SensorTable
+from runtime.serial_recording import (SerialRecorder, read_recording, ReplayTransport,
+                                      RECEIVED, SENT)
 
 
 VIRTUAL_DEVICE_STARTUP_TIME = 2
@@ -107,6 +130,72 @@ class BasicHotplugTests(AsyncTestCase):
                                            "identified devices differs from spawned devices")
 
 
+class FakeWatcher:
+    """
+    A hotplug watcher whose events are triggered by hand.
+    """
+    sees_events = True
+
+    def __init__(self, loop):
+        self.changed = asyncio.Event(loop=loop)
+        self.timeouts = []
+        self.closed = False
+
+    async def wait(self, timeout):
+        self.timeouts.append(timeout)
+        await self.changed.wait()
+        self.changed.clear()
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+class HotplugWatcherTests(AsyncTestCase):
+    """
+    Tests for event-driven hotplug.
+    """
+    def test_rescan_on_event(self):
+        """ Hibike should rescan as soon as the watcher sees a change. """
+        watcher = FakeWatcher(self.loop)
+        hotplug = self.loop.create_task(hotplug_async({}, {}, asyncio.Queue(loop=self.loop),
+                                                      aioprocessing.AioQueue(), self.loop,
+                                                      watcher=watcher))
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.assertEqual(watcher.timeouts, [HOTPLUG_RESCAN_INTERVAL])
+        watcher.changed.set()
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.assertEqual(len(watcher.timeouts), 2)
+        hotplug.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(hotplug)
+        self.assertTrue(watcher.closed)
+
+    @unittest.skipUnless(USING_INOTIFY, "inotify is not available")
+    def test_inotify_sees_new_port(self):
+        """ Creating a matching file should wake the watcher right away. """
+        with tempfile.TemporaryDirectory() as directory:
+            watcher = InotifyWatcher(self.loop, {directory: ("ttyACM*",)})
+            try:
+                open(os.path.join(directory, "ttyACM7"), "w").close()
+                start = time.monotonic()
+                self.assertTrue(self.loop.run_until_complete(watcher.wait(5)))
+                self.assertLess(time.monotonic() - start, 1)
+            finally:
+                watcher.close()
+
+    @unittest.skipUnless(USING_INOTIFY, "inotify is not available")
+    def test_inotify_ignores_other_files(self):
+        """ Files that are not serial ports should not wake the watcher. """
+        with tempfile.TemporaryDirectory() as directory:
+            watcher = InotifyWatcher(self.loop, {directory: ("ttyACM*",)})
+            try:
+                open(os.path.join(directory, "null"), "w").close()
+                self.assertFalse(self.loop.run_until_complete(watcher.wait(0.2)))
+            finally:
+                watcher.close()
+
+
 class ReadWriteTests(unittest.TestCase):
     """
     Test reading from and writing to devices.
@@ -177,3 +266,864 @@ class ReadWriteTests(unittest.TestCase):
         """
         self.read("0x123456789", "duty_cycle")
         self.hibike.bad_things_queue.get(block=False)
+
+
+class CoalescedWriterTests(AsyncTestCase):
+    """
+    Tests for `CoalescedWriter`.
+    """
+    def test_frames_merged_into_one_write(self):
+        """ Frames written in the same loop iteration go out together. """
+        writer = CoalescedWriter(self.loop)
+        writer.transport = FakeTransport()
+        frames = [hm.encode(hm.make_ping()), hm.encode(hm.make_disable()),
+                  hm.encode(hm.make_heartbeat_response(3))]
+        for frame in frames:
+            writer.write(frame)
+        self.assertEqual(writer.transport.writes, [])
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(writer.transport.writes, [b"".join(frames)])
+        self.assertEqual(writer.frames_merged, 2)
+        self.assertEqual(writer.flushes, 1)
+
+
+class WriteTests(AsyncTestCase):
+    """
+    Tests for `SmartSensorProtocol.queue_write`.
+    """
+    UID = hm.device_name_to_id("ServoControl") << 72 | 0xC0FFEE
+
+    def setUp(self):
+        super().setUp()
+        self.protocol = self.make_protocol("ServoControl")
+        self.transport = self.protocol.transport
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.transport.writes.clear()
+
+    def test_only_latest_value_sent(self):
+        """ Several writes to a param before a send should go out as one, with the last value. """
+        for value in (0.25, 0.5, 0.75):
+            self.protocol.queue_write([("servo0", value)])
+        self.protocol.queue_write([("servo1", -0.5)])
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        messages = self.transport.sent_messages()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].get_message_id(), hm.MESSAGE_TYPES["DeviceWrite"])
+        self.assertEqual(hm.decode_device_write(messages[0], hm.uid_to_device_id(self.UID)),
+                         [("servo0", 0.75), ("servo1", -0.5)])
+
+    def test_invalid_param(self):
+        """ Writing a param the device doesn't have should be an instruction error. """
+        with self.assertRaises(TypeError):
+            self.protocol.queue_write([("duty_cycle", 0.5)])
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.assertEqual(self.transport.sent_messages(), [])
+
+
+class IdentifyTests(AsyncTestCase):
+    """
+    Tests for `SmartSensorProtocol.register_sensor`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.devices = {}
+        self.pending = {"/dev/ttyFAKE0"}
+        self.stats = IdentifyStats()
+        self.protocol = self.make_protocol(None, self.devices, pending=self.pending,
+                                           identify_stats=self.stats)
+        self.transport = self.protocol.transport
+
+    def run_until_identified(self, timeout):
+        """ Run the event loop until identification is over. """
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+
+    def test_identify_without_waiting_for_timeout(self):
+        """ A device that answers should be registered right away. """
+        uid = hm.device_name_to_id("LimitSwitch") << 72 | 0xC0FFEE
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        response = hm.make_subscription_response(hm.uid_to_device_id(uid), [], 0, uid)
+        start = time.monotonic()
+        self.protocol.data_received(hm.encode(response))
+        self.run_until_identified(IDENTIFY_TIMEOUT)
+        self.assertLess(time.monotonic() - start, IDENTIFY_TIMEOUT / 2)
+        self.assertIn(uid, self.devices)
+        self.assertEqual(self.stats.summary()["/dev/ttyFAKE0"]["identified"], 1)
+
+    def test_silent_port_backs_off(self):
+        """ A silent port should be pinged a few times, then closed. """
+        self.run_until_identified(IDENTIFY_TIMEOUT * 2)
+        self.assertTrue(self.transport.closed)
+        self.assertEqual(self.devices, {})
+        pings = len(self.transport.sent_messages())
+        self.assertGreater(pings, 1)
+        self.assertLess(pings, 12)
+        stats = self.stats.summary()["/dev/ttyFAKE0"]
+        self.assertEqual((stats["attempts"], stats["identified"], stats["pings"]), (1, 0, pings))
+
+
+class ReadScheduleTests(AsyncTestCase):
+    """
+    Tests for reading params on their own schedules.
+    """
+    UID = hm.device_name_to_id("Potentiometer") << 72 | 0xC0FFEE
+
+    def test_slow_params_read_on_schedule(self):
+        """ Params with a longer delay should be read, not subscribed to. """
+        protocol = self.make_protocol("Potentiometer")
+        transport = protocol.transport
+        protocol.queue_instruction("subscribe", [self.UID, 40, ["pot0"], {"pot1": 100}])
+        self.loop.run_until_complete(asyncio.sleep(0.35, loop=self.loop))
+        messages = transport.sent_messages()
+        subscriptions = [m for m in messages
+                         if m.get_message_id() == hm.MESSAGE_TYPES["SubscriptionRequest"]]
+        reads = [m for m in messages if m.get_message_id() == hm.MESSAGE_TYPES["DeviceRead"]]
+        self.assertEqual(len(subscriptions), 1)
+        self.assertIn(len(reads), (3, 4))
+        device_id = hm.uid_to_device_id(self.UID)
+        self.assertEqual(hm.decode_params(device_id, struct.unpack("<H", reads[0].payload)[0]),
+                         ["pot1"])
+
+
+class SchedulingTests(AsyncTestCase):
+    """
+    Tests for handling packets and instructions without a task per device.
+    """
+    UID = hm.device_name_to_id("Potentiometer") << 72 | 0xC0FFEE
+
+    def test_packets_handled_on_arrival(self):
+        """ Every packet in a read should be handled before `data_received` returns. """
+        batched_data = {}
+        protocol = self.make_protocol("Potentiometer", batched_data=batched_data)
+        device_id = hm.uid_to_device_id(self.UID)
+        data = b"".join(hm.encode(hm.make_device_data(device_id, [("pot0", value)]))
+                        for value in (0.25, 0.5, 0.75))
+        protocol.data_received(data)
+        self.assertEqual(batched_data[self.UID], [("pot0", 0.75)])
+        self.assertEqual(protocol.metrics.rx_packets, 3)
+        self.assertEqual(protocol.metrics.packets_per_read.summary()["max"], 3)
+
+    def test_shared_scheduler(self):
+        """ Instructions for several devices should be carried out in one callback. """
+        scheduler = InstructionScheduler(self.loop)
+        first = self.make_protocol("Potentiometer", scheduler=scheduler)
+        second = self.make_protocol("Potentiometer", scheduler=scheduler)
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        sent = [len(device.transport.sent_messages()) for device in (first, second)]
+        first.queue_instruction("ping", [])
+        second.queue_instruction("ping", [])
+        second.transport.abort()
+        scheduler.run()
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertEqual(len(first.transport.sent_messages()), sent[0] + 1)
+        # Instructions for closed ports are dropped
+        self.assertEqual(len(second.transport.sent_messages()), sent[1])
+
+
+class RateControlTests(AsyncTestCase):
+    """
+    Tests for adapting subscription delays to link health.
+    """
+    UID = hm.device_name_to_id("Potentiometer") << 72 | 0xC0FFEE
+
+    def setUp(self):
+        super().setUp()
+        self.protocol = self.make_protocol("Potentiometer")
+        self.transport = self.protocol.transport
+        self.protocol.queue_instruction("subscribe", [self.UID, 40, ["pot0"]])
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+
+    def adapt(self):
+        """ Run one round of rate control and send what it wrote. """
+        self.protocol.adapt_rate(0.5)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+
+    def last_subscription_delay(self):
+        """ The delay of the last subscription request sent. """
+        requests = [m for m in self.transport.sent_messages()
+                    if m.get_message_id() == hm.MESSAGE_TYPES["SubscriptionRequest"]]
+        return struct.unpack("<HH", requests[-1].payload)[1]
+
+    def test_backs_off_and_recovers(self):
+        """ Missing packets should slow a device down until they arrive again. """
+        self.adapt()
+        self.adapt()
+        self.assertEqual(self.last_subscription_delay(), 80)
+        self.adapt()
+        self.assertEqual(self.last_subscription_delay(), 160)
+        self.protocol.data_packets = 4
+        self.adapt()
+        self.assertEqual(self.last_subscription_delay(), 128)
+
+    def test_fullness_only_sent_when_slowed(self):
+        """ Heartbeat responses should only set the sensor's delay while backing off. """
+        def last_heartbeat_payload():
+            responses = [m for m in self.transport.sent_messages()
+                         if m.get_message_id() == hm.MESSAGE_TYPES["HeartBeatResponse"]]
+            return bytes(responses[-1].payload)
+        self.protocol.queue_instruction("heartResp", [self.UID])
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.assertEqual(last_heartbeat_payload(), b"\x00")
+        self.adapt()
+        self.adapt()
+        self.protocol.queue_instruction("heartResp", [self.UID])
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        fullness = round(100 * 80 / RATE_CONTROL_MAX_DELAY)
+        self.assertEqual(last_heartbeat_payload(), bytes([0, fullness]))
+
+    def test_delay_bounded(self):
+        """ Delays should never go past `RATE_CONTROL_MAX_DELAY`. """
+        for _ in range(10):
+            self.adapt()
+        self.assertEqual(self.protocol.subscription_delay(), RATE_CONTROL_MAX_DELAY)
+
+
+class LivenessTests(AsyncTestCase):
+    """
+    Tests for noticing devices that have gone quiet.
+    """
+    UID = hm.device_name_to_id("Potentiometer") << 72 | 0xC0FFEE
+
+    def setUp(self):
+        super().setUp()
+        self.devices = {}
+        self.state_queue = aioprocessing.AioQueue()
+        self.protocol = self.make_protocol("Potentiometer", self.devices,
+                                           state_queue=self.state_queue)
+        self.transport = self.protocol.transport
+        self.devices[self.UID] = self.protocol
+        self.protocol.queue_instruction("subscribe", [self.UID, 40, ["pot0"]])
+        self.monitor = self.loop.create_task(monitor_liveness(self.devices, {}, self.state_queue,
+                                                              self.loop))
+
+    def tearDown(self):
+        self.monitor.cancel()
+        super().tearDown()
+
+    def next_message(self):
+        """ Wait for the next message to StateManager. """
+        for _ in range(50):
+            if not self.state_queue.empty():
+                break
+            self.loop.run_until_complete(asyncio.sleep(0.02, loop=self.loop))
+        return self.state_queue.get(timeout=1)
+
+    def test_stale_then_fresh(self):
+        """ A quiet device should be stale until it sends something. """
+        self.protocol.last_received -= 0.2
+        self.assertEqual(self.next_message(), ("device_stale", [self.UID, True]))
+        self.assertTrue(self.protocol.stale)
+        self.protocol.data_received(b"")
+        self.assertEqual(self.next_message(), ("device_stale", [self.UID, False]))
+        self.assertIn(self.UID, self.devices)
+
+    def test_disconnect(self):
+        """ A device that stays quiet should be disconnected without closing its port first. """
+        self.protocol.last_received -= LIVENESS_DISCONNECT_TIMEOUT
+        self.assertEqual(self.next_message(), ("device_disconnected", [self.UID]))
+        self.assertNotIn(self.UID, self.devices)
+        self.assertTrue(self.transport.closed)
+
+    def test_unsubscribed_device_not_stale(self):
+        """ Devices that aren't expected to send anything should be left alone. """
+        self.protocol.queue_instruction("subscribe", [self.UID, 0, []])
+        self.protocol.last_received -= LIVENESS_DISCONNECT_TIMEOUT
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.assertIn(self.UID, self.devices)
+        self.assertTrue(self.state_queue.empty())
+
+
+class LinkMetricsTests(AsyncTestCase):
+    """
+    Tests for counting traffic over serial links.
+    """
+    UID = hm.device_name_to_id("ServoControl") << 72 | 0xC0FFEE
+
+    def setUp(self):
+        super().setUp()
+        self.registry = LinkMetricsRegistry(IdentifyStats())
+        self.protocol = self.make_protocol("ServoControl", link_metrics=self.registry)
+        self.transport = self.protocol.transport
+        self.metrics = self.registry.ports[self.transport.serial.name]
+
+    def receive(self, message):
+        """ Feed MESSAGE to the protocol and process it. """
+        self.protocol.data_received(hm.encode(message))
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+
+    def test_histogram(self):
+        """ Percentiles should be the bounds of the buckets they fall in. """
+        histogram = Histogram((1, 10, 100))
+        self.assertIsNone(histogram.percentile(0.5))
+        for value in (0.5, 5, 5, 50, 500):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(0.5), 10)
+        self.assertEqual(histogram.percentile(0.99), 500)
+        self.assertEqual(histogram.summary()["max"], 500)
+
+    def test_counts_traffic(self):
+        """ Packets and bytes should be counted both ways, and garbage as resyncs. """
+        ping = hm.encode(hm.make_ping())
+        self.protocol.queue_instruction("ping", [])
+        self.receive(hm.make_heartbeat_request())
+        self.protocol.data_received(b"\x01\x02")
+        self.receive(hm.make_error(hm.ERROR_CODES["CheckumError"]))
+        self.assertEqual(self.metrics.rx_packets, 2)
+        # Identification pings, the ping and the heartbeat response
+        self.assertEqual(self.metrics.tx_packets, len(self.transport.sent_messages()))
+        self.assertEqual(self.metrics.tx_bytes, sum(map(len, self.transport.writes)))
+        self.assertGreaterEqual(self.metrics.tx_bytes, 2 * len(ping))
+        self.assertGreater(self.metrics.resyncs, 0)
+        self.assertEqual(self.metrics.device_errors, {"CheckumError": 1})
+
+    def test_echo_latency(self):
+        """ The time from a write to the device reporting the param should be recorded. """
+        self.protocol.queue_write([("servo0", 0.5)])
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.receive(hm.make_device_data(hm.uid_to_device_id(self.UID), [("servo0", 0.5)]))
+        self.assertEqual(self.metrics.echo_latency.count, 1)
+        self.receive(hm.make_device_data(hm.uid_to_device_id(self.UID), [("servo0", 0.5)]))
+        self.assertEqual(self.metrics.echo_latency.count, 1)
+
+    def test_report_rates(self):
+        """ Reports should include rates since the last report, and survive reconnects. """
+        self.registry.report(0)
+        self.receive(hm.make_subscription_response(hm.uid_to_device_id(self.UID), [], 0,
+                                                   self.UID))
+        report = self.registry.report(2)[self.transport.serial.name]
+        self.assertEqual(report["rx_packet_rate"], 0.5)
+        self.assertEqual(report["uid"], self.UID)
+        other = self.make_protocol(None, link_metrics=self.registry)
+        self.assertIs(other.metrics, self.metrics)
+
+
+class SerialRecordingTests(AsyncTestCase):
+    """
+    Tests for recording serial traffic and replaying it.
+    """
+    UID = hm.device_name_to_id("Potentiometer") << 72 | 0xC0FFEE
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "recording.hbr")
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def test_round_trip(self):
+        """ Records should be read back in order, ignoring a truncated one at the end. """
+        recorder = SerialRecorder(self.path, "/dev/ttyFAKE0")
+        recorder.record(RECEIVED, b"\x00\x01")
+        recorder.record(SENT, b"\x02")
+        recorder.close()
+        with open(self.path, "ab") as recording_file:
+            recording_file.write(b"\x00\x00")
+        recording = read_recording(self.path)
+        self.assertEqual(recording.port, "/dev/ttyFAKE0")
+        self.assertEqual([(direction, data) for _, direction, data in recording.records],
+                         [(RECEIVED, b"\x00\x01"), (SENT, b"\x02")])
+        self.assertLessEqual(recording.records[0][0], recording.records[1][0])
+
+    def test_not_a_recording(self):
+        """ Other files should be rejected. """
+        with open(self.path, "wb") as recording_file:
+            recording_file.write(b"hello")
+        with self.assertRaises(ValueError):
+            read_recording(self.path)
+
+    def test_record_and_replay(self):
+        """ Replaying a recording should give the protocol the same device and values. """
+        device_id = hm.uid_to_device_id(self.UID)
+        protocol = self.make_protocol(None, recording_dir=self.directory.name)
+        for message in (hm.make_subscription_response(device_id, [], 0, self.UID),
+                        hm.make_device_data(device_id, [("pot0", 0.5)])):
+            protocol.data_received(hm.encode(message))
+            self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        protocol.connection_lost(None)
+        [name] = os.listdir(self.directory.name)
+        recording = read_recording(os.path.join(self.directory.name, name))
+        self.assertTrue(recording.sent())
+
+        batched_data = {}
+        replayed = self.make_protocol(None, batched_data=batched_data, connect=False)
+        transport = ReplayTransport(replayed, recording, self.loop, speed=None)
+        self.loop.run_until_complete(transport.play())
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.assertEqual(replayed.uid, self.UID)
+        self.assertEqual(dict(batched_data[self.UID])["pot0"], 0.5)
+        self.assertTrue(transport.writes)
+
+
+class ShardTests(unittest.TestCase):
+    """
+    Tests for splitting Hibike into shards.
+    """
+    UID = hm.device_name_to_id("LimitSwitch") << 72 | 0xC0FFEE
+
+    def setUp(self):
+        self.bad_things_queue = queue.Queue()
+        self.state_manager_pipe, front_end_pipe = multiprocessing.Pipe()
+        pipes = [multiprocessing.Pipe() for _ in range(2)]
+        self.shard_pipes = [shard_pipe for _, shard_pipe in pipes]
+        self.front_end = threading.Thread(target=hibike_front_end, args=(
+            self.bad_things_queue, front_end_pipe, [pipe for pipe, _ in pipes]))
+        self.front_end.start()
+
+    def tearDown(self):
+        self.state_manager_pipe.close()
+        self.front_end.join(1)
+
+    def test_shard_for_port(self):
+        """ Ports should always go to the same shard. """
+        shards = {shard_for_port("/dev/ttyACM{}".format(i), 4) for i in range(20)}
+        self.assertLessEqual(shards, {0, 1, 2, 3})
+        self.assertGreater(len(shards), 1)
+        self.assertEqual(shard_for_port("/dev/ttyACM0", 4), shard_for_port("/dev/ttyACM0", 4))
+
+    def test_routes_to_device_shard(self):
+        """ Instructions for a device should go to the shard that has it. """
+        self.shard_pipes[1].send(("device_added", self.UID))
+        self.state_manager_pipe.send(["read_params", [self.UID, ["switch0"]]])
+        self.assertTrue(self.shard_pipes[1].poll(1))
+        self.assertEqual(self.shard_pipes[1].recv(), ["read_params", [self.UID, ["switch0"]]])
+        self.assertFalse(self.shard_pipes[0].poll(0.1))
+
+    def test_broadcast(self):
+        """ Instructions for every device should go to every shard. """
+        self.state_manager_pipe.send(["disable_all", []])
+        for shard_pipe in self.shard_pipes:
+            self.assertTrue(shard_pipe.poll(1))
+            self.assertEqual(shard_pipe.recv(), ["disable_all", []])
+
+    def test_nonexistent_device(self):
+        """ Instructions for devices no shard has, or that went away, should be reported. """
+        self.shard_pipes[0].send(("device_added", self.UID))
+        self.shard_pipes[0].send(("device_removed", self.UID))
+        self.state_manager_pipe.send(["read_params", [self.UID, ["switch0"]]])
+        bad_thing = self.bad_things_queue.get(timeout=1)
+        self.assertEqual(bad_thing.event, BAD_EVENTS.HIBIKE_NONEXISTENT_DEVICE)
+
+
+class PortCacheTests(AsyncTestCase):
+    """
+    Tests for `PortCache` and registering cached devices.
+    """
+    PORT = "/dev/ttyFAKE0"
+    UID = hm.device_name_to_id("LimitSwitch") << 72 | 0xC0FFEE
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "port_cache.json")
+        self.state_queue = aioprocessing.AioQueue()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def make_cached_protocol(self, cache, devices, pending):
+        """ Connect a protocol to a fake transport on `PORT`. """
+        return self.make_protocol(None, devices, port=self.PORT, state_queue=self.state_queue,
+                                  pending=pending, port_cache=cache, usb_serial="A1")
+
+    def test_save_and_reload(self):
+        """ Entries should survive a restart, but only for the same USB device. """
+        cache = PortCache(self.path, self.loop)
+        cache.store(self.PORT, "A1", self.UID, 40, ["switch0"])
+        cache.save()
+        cache = PortCache(self.path, self.loop)
+        self.assertEqual(cache.lookup(self.PORT, "A1"), (self.UID, 40, ["switch0"]))
+        self.assertIsNone(cache.lookup(self.PORT, "B2"))
+        self.assertIsNone(cache.lookup("/dev/ttyFAKE1", "A1"))
+
+    def test_corrupt_cache_ignored(self):
+        """ A cache file that can't be read should be treated as empty. """
+        with open(self.path, "w") as cache_file:
+            cache_file.write("{not json")
+        self.assertIsNone(PortCache(self.path, self.loop).lookup(self.PORT, "A1"))
+
+    def test_cached_device_registered_before_answering(self):
+        """ A cached device should be registered without waiting for it. """
+        cache = PortCache(self.path, self.loop)
+        cache.store(self.PORT, "A1", self.UID, 40, ["switch0"])
+        devices = {}
+        pending = {self.PORT}
+        protocol = self.make_cached_protocol(cache, devices, pending)
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.assertIn(self.UID, devices)
+        response = hm.make_subscription_response(hm.uid_to_device_id(self.UID),
+                                                 ["switch0"], 40, self.UID)
+        protocol.data_received(hm.encode(response))
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.assertEqual(pending, set())
+        self.assertIs(devices[self.UID], protocol)
+        self.assertEqual(cache.lookup(self.PORT, "A1"), (self.UID, 40, ["switch0"]))
+
+    def test_different_device_replaces_cached(self):
+        """ If a different device answers, the cached one should be dropped. """
+        cache = PortCache(self.path, self.loop)
+        cache.store(self.PORT, "A1", self.UID, 40, ["switch0"])
+        devices = {}
+        pending = {self.PORT}
+        protocol = self.make_cached_protocol(cache, devices, pending)
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        other_uid = hm.device_name_to_id("Potentiometer") << 72 | 0xBEEF
+        response = hm.make_subscription_response(hm.uid_to_device_id(other_uid), [], 0,
+                                                 other_uid)
+        protocol.data_received(hm.encode(response))
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.assertEqual(list(devices), [other_uid])
+        self.assertIsNone(cache.lookup(self.PORT, "A1"))
+
+    def test_cached_device_elsewhere_kept(self):
+        """ A cached device that has since reconnected elsewhere shouldn't be disconnected. """
+        cache = PortCache(self.path, self.loop)
+        cache.store(self.PORT, "A1", self.UID, 40, ["switch0"])
+        devices = {}
+        protocol = self.make_cached_protocol(cache, devices, {self.PORT})
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        elsewhere = object()
+        devices[self.UID] = elsewhere
+        other_uid = hm.device_name_to_id("Potentiometer") << 72 | 0xBEEF
+        response = hm.make_subscription_response(hm.uid_to_device_id(other_uid), [], 0,
+                                                 other_uid)
+        protocol.data_received(hm.encode(response))
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.assertIs(devices[self.UID], elsewhere)
+        messages = []
+        while True:
+            try:
+                messages.append(self.state_queue.get(timeout=0.1))
+            except queue.Empty:
+                break
+        self.assertNotIn(("device_disconnected", [self.UID]), messages)
+
+
+class DeltaBatchTests(unittest.TestCase):
+    """
+    Tests for `diff_sensor_values`.
+    """
+    def test_only_changed_values_sent(self):
+        """ Unchanged values should be left out of a delta. """
+        last_sent = {1: {"switch0": True, "switch1": False}}
+        sensor_values = {1: [("switch0", True), ("switch1", True)],
+                         2: [("v_batt", 11.1)]}
+        delta = diff_sensor_values(sensor_values, last_sent)
+        self.assertEqual(delta, {1: [("switch1", True)], 2: [("v_batt", 11.1)]})
+        self.assertEqual(diff_sensor_values(sensor_values, last_sent), {})
+
+    def test_disconnected_devices_forgotten(self):
+        """ Devices that are gone should be dropped from the last sent values. """
+        last_sent = {1: {"switch0": True}}
+        diff_sensor_values({}, last_sent)
+        self.assertEqual(last_sent, {})
+
+
+class FakeDevice:
+    """
+    Stands in for a subscribed `SmartSensorProtocol`.
+    """
+    def __init__(self):
+        self.stale = False
+
+    def stale_timeout(self): # pylint: disable=no-self-use
+        """ Subscribed devices have a stale timeout. """
+        return 0.1
+
+
+class DataBatcherTests(AsyncTestCase):
+    """
+    Tests for sending batches when devices have reported.
+    """
+    def setUp(self):
+        super().setUp()
+        self.sensor_values = {}
+        self.devices = {1: FakeDevice(), 2: FakeDevice()}
+        self.state_queue = aioprocessing.AioQueue()
+        self.batcher = DataBatcher(self.sensor_values, self.devices, self.state_queue,
+                                   self.loop)
+
+    def report(self, uid, value):
+        """ Have the device at UID send VALUE. """
+        self.sensor_values[uid] = [("pot0", value)]
+        self.batcher.report(uid)
+
+    def next_batch(self, timeout=1):
+        """ Wait up to TIMEOUT seconds for the next batch, or None. """
+        deadline = time.monotonic() + timeout
+        while self.state_queue.empty() and time.monotonic() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.005, loop=self.loop))
+        if self.state_queue.empty():
+            return None
+        command, data = self.state_queue.get(timeout=1)
+        self.assertEqual(command, "device_values")
+        return data
+
+    def test_sent_once_all_devices_report(self):
+        """ A batch should go out as soon as the last subscribed device reports. """
+        self.report(1, 0.5)
+        self.assertIsNone(self.next_batch(BATCH_MAX_LATENCY / 4))
+        self.report(2, 0.25)
+        batch, arrivals = self.next_batch(BATCH_MAX_LATENCY / 4)
+        self.assertEqual(batch, {1: [("pot0", 0.5)], 2: [("pot0", 0.25)]})
+        self.assertLessEqual(arrivals[1], arrivals[2])
+        self.assertLess(time.time() - arrivals[1], BATCH_MAX_LATENCY)
+
+    def test_sent_at_deadline(self):
+        """ A device that doesn't report shouldn't hold up the others for long. """
+        self.report(1, 0.5)
+        start = time.monotonic()
+        batch, arrivals = self.next_batch()
+        self.assertGreaterEqual(time.monotonic() - start, BATCH_MAX_LATENCY * 0.9)
+        self.assertEqual(batch, {1: [("pot0", 0.5)]})
+        self.assertGreaterEqual(time.time() - arrivals[1], BATCH_MAX_LATENCY * 0.9)
+
+    def test_stale_devices_not_waited_for(self):
+        """ Stale devices shouldn't hold up a batch, and deltas leave out unchanged values. """
+        self.devices[2].stale = True
+        self.report(1, 0.5)
+        self.assertEqual(self.next_batch(BATCH_MAX_LATENCY / 4)[0], {1: [("pot0", 0.5)]})
+        self.report(1, 0.5)
+        self.assertIsNone(self.next_batch(BATCH_MAX_LATENCY * 2))
+
+    def test_sent_in_order(self):
+        """ Batches should reach `StateManager` in the order they were sent. """
+        for value in range(50):
+            self.report(1, value)
+            self.batcher.flush()
+        values = [self.next_batch()[0][1][0][1] for _ in range(50)]
+        self.assertEqual(values, list(range(50)))
+
+    def test_forgotten_device_sent_in_full(self):
+        """ A device that resubscribes should get all of its values sent again. """
+        self.sensor_values[1] = [("pot0", 0.5), ("switch0", True)]
+        self.batcher.report(1)
+        self.batcher.flush()
+        self.next_batch()
+        forget_values(1, self.sensor_values, self.batcher)
+        self.assertNotIn(1, self.sensor_values)
+        self.report(1, 0.5)
+        self.batcher.flush()
+        self.assertEqual(self.next_batch()[0], {1: [("pot0", 0.5)]})
+
+
+class LoopLagTests(AsyncTestCase):
+    """
+    Tests for measuring how late the event loop runs.
+    """
+    def test_stall_measured(self):
+        """ A callback that blocks the loop should show up as lag. """
+        monitor = LoopLagMonitor(self.loop, interval=0.01)
+        self.assertIsNone(monitor.summary()["p50"])
+        monitor.start()
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.loop.call_soon(time.sleep, 0.1)
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        monitor.stop()
+        summary = monitor.summary()
+        self.assertGreater(summary["samples"], 5)
+        self.assertLess(summary["p50"], 50)
+        self.assertGreaterEqual(summary["max"], 50)
+        self.assertEqual(summary["p99"], summary["max"])
+
+
+class EmergencyStopTests(AsyncTestCase):
+    """
+    Tests for disabling devices through `EmergencyStop`.
+    """
+    SERIAL_NUMBERS = (1, 2)
+    UIDS = [hm.device_name_to_id("YogiBear") << 72 | serial_number
+            for serial_number in SERIAL_NUMBERS]
+
+    def setUp(self):
+        super().setUp()
+        self.emergency_stop = EmergencyStop()
+
+    def tearDown(self):
+        self.emergency_stop.close()
+        super().tearDown()
+
+    def is_readable(self):
+        """ Whether the emergency stop's pipe can be read from. """
+        return bool(select.select([self.emergency_stop], [], [], 0)[0])
+
+    def test_latched(self):
+        """ Only the first trigger counts, and the pipe stays readable. """
+        self.assertFalse(self.emergency_stop.triggered)
+        self.assertIsNone(self.emergency_stop.latency())
+        self.assertFalse(self.is_readable())
+        self.assertTrue(self.emergency_stop.trigger())
+        self.assertFalse(self.emergency_stop.trigger())
+        self.assertTrue(self.emergency_stop.triggered)
+        self.assertGreaterEqual(self.emergency_stop.latency(), 0)
+        self.assertTrue(self.is_readable())
+        self.assertTrue(self.is_readable())
+
+    def test_trigger_from_other_process(self):
+        """ A trigger in a forked process should be seen in this one. """
+        process = multiprocessing.Process(target=self.emergency_stop.trigger)
+        process.start()
+        process.join(5)
+        self.assertTrue(self.emergency_stop.triggered)
+        self.assertTrue(self.is_readable())
+
+    def make_devices(self):
+        """ Connect a protocol to a fake transport for each of `UIDS`. """
+        devices = {}
+        for serial_number in self.SERIAL_NUMBERS:
+            protocol = self.make_protocol("YogiBear", serial_number=serial_number)
+            devices[protocol.uid] = protocol
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        return devices
+
+    def next_report(self, state_queue):
+        """ Run the loop until something is put on STATE_QUEUE, and return it. """
+        deadline = time.monotonic() + 1
+        while state_queue.empty() and time.monotonic() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.005, loop=self.loop))
+        return state_queue.get(timeout=1)
+
+    def test_devices_disabled(self):
+        """ Every device should be sent a disable when the pipe wakes the loop. """
+        devices = self.make_devices()
+        state_queue = aioprocessing.AioQueue()
+        self.loop.add_reader(self.emergency_stop.fileno(), disable_on_emergency_stop,
+                             self.emergency_stop, devices, state_queue, self.loop)
+        self.emergency_stop.trigger()
+        command, (_, latency) = self.next_report(state_queue)
+        self.assertEqual(command, "emergency_stop_latency")
+        self.assertGreaterEqual(latency, 0)
+        for protocol in devices.values():
+            messages = protocol.transport.sent_messages()
+            self.assertEqual(messages[-1].get_message_id(), hm.MESSAGE_TYPES["Disable"])
+        # The pipe stays readable, so the callback must have stopped watching it
+        self.assertFalse(self.loop.remove_reader(self.emergency_stop.fileno()))
+
+    def test_pending_writes_dropped(self):
+        """ Writes queued before the stop shouldn't go out after the disable. """
+        devices = self.make_devices()
+        state_queue = aioprocessing.AioQueue()
+        device = devices[self.UIDS[0]]
+        device.queue_write([("duty_cycle", 0.5)])
+        self.emergency_stop.trigger()
+        disable_on_emergency_stop(self.emergency_stop, devices, state_queue, self.loop)
+        self.next_report(state_queue)
+        message_ids = [message.get_message_id()
+                       for message in device.transport.sent_messages()]
+        self.assertEqual(message_ids[-1], hm.MESSAGE_TYPES["Disable"])
+        self.assertNotIn(hm.MESSAGE_TYPES["DeviceWrite"], message_ids)
+
+
+class TornStruct(struct.Struct):
+    """
+    A struct that writes one byte at a time, calling BETWEEN after each
+    byte, like a writer in another process being read partway through.
+    """
+    def __init__(self, fmt, between):
+        super().__init__(fmt)
+        self.between = between
+
+    def pack_into(self, buffer, offset, *values): # pylint: disable=arguments-differ
+        for i, byte in enumerate(self.pack(*values)):
+            buffer[offset + i] = byte
+            self.between()
+
+
+class SensorTableTests(unittest.TestCase):
+    """
+    Tests for `SensorTable`.
+    """
+    def setUp(self):
+        self.table = SensorTable.create(max_devices=4)
+        self.reader = SensorTable.attach(self.table._shm.name) # pylint: disable=protected-access
+        self.uid = 2 << 72 | 0xC0FFEE  # A Potentiometer
+
+    def tearDown(self):
+        self.reader.close()
+        self.table.close()
+        self.table.unlink()
+
+    def test_read_written_values(self):
+        """ Values written by Hibike should be visible to another reader. """
+        self.table.update(self.uid, [("pot0", 0.25), ("pot2", 0.75)])
+        self.assertEqual(list(self.reader.uids()), [self.uid])
+        self.assertEqual(self.reader.get_value(self.uid, "pot0"), 0.25)
+        self.assertEqual(self.reader.get_value(self.uid, "pot2"), 0.75)
+        self.assertIsNone(self.reader.get_value(self.uid, "pot1"))
+
+    def test_removed_device(self):
+        """ Reading from a removed device should raise `KeyError`. """
+        self.table.update(self.uid, [("pot0", 0.25)])
+        self.assertEqual(self.reader.get_value(self.uid, "pot0"), 0.25)
+        self.table.remove_device(self.uid)
+        self.assertEqual(list(self.reader.uids()), [])
+        with self.assertRaises(KeyError):
+            self.reader.get_value(self.uid, "pot0")
+
+    def test_stale_device(self):
+        """ Readers should see when a device is marked stale, without losing its values. """
+        self.table.update(self.uid, [("pot0", 0.25)])
+        self.assertFalse(self.reader.is_stale(self.uid))
+        self.table.set_stale(self.uid, True)
+        self.assertTrue(self.reader.is_stale(self.uid))
+        self.assertEqual(self.reader.get_value(self.uid, "pot0"), 0.25)
+        self.table.update(self.uid, [("pot0", 0.5)])
+        self.table.set_stale(self.uid, False)
+        self.assertFalse(self.reader.is_stale(self.uid))
+
+    def read_during_writes(self, read, write):
+        """
+        Call READ after every byte WRITE writes to a slot, as if the
+        reader had looked up the slot just before the write began.
+
+        Returns:
+            What each READ returned or raised.
+        """
+        self.reader.uids()
+        results = []
+
+        def between():
+            try:
+                results.append(read())
+            except (KeyError, RuntimeError) as e:
+                results.append(type(e))
+        self.reader._refresh_slots = lambda: None # pylint: disable=protected-access
+        with mock.patch.object(sensor_table, "SEQUENCE", TornStruct("<I", between)), \
+                mock.patch.object(sensor_table, "SLOT_HEADER", TornStruct("<IHBxQQd", between)), \
+                mock.patch.object(sensor_table, "MAX_READ_RETRIES", 2):
+            write()
+        return results
+
+    def test_read_during_removal(self):
+        """ A reader should never get a value from a device while it is removed. """
+        self.table.update(self.uid, [("pot0", 0.25)])
+        results = self.read_during_writes(lambda: self.reader.get_value(self.uid, "pot0"),
+                                          lambda: self.table.remove_device(self.uid))
+        # Reads wait while the slot changes, then find it free
+        self.assertEqual(set(results), {RuntimeError, KeyError})
+        self.assertEqual(results[-1], KeyError)
+
+    def test_read_while_marked_stale(self):
+        """ A reader should see a device as fresh until it is wholly marked stale. """
+        self.table.update(self.uid, [("pot0", 0.25)])
+        results = self.read_during_writes(lambda: self.reader.is_stale(self.uid),
+                                          lambda: self.table.set_stale(self.uid, True))
+        results = [result for result in results if result is not RuntimeError]
+        self.assertEqual(results[-1], True)
+        self.assertEqual(results, sorted(results))
+
+    def test_shared_slots(self):
+        """ Writers sharing a table should use separate slots. """
+        other = SensorTable.attach(self.table._shm.name) # pylint: disable=protected-access
+        lock = multiprocessing.Lock()
+        self.table.share(0, 2, lock)
+        other.share(1, 2, lock)
+        other_uid = self.uid + 1
+        self.assertEqual(self.table.add_device(self.uid), 0)
+        self.assertEqual(other.add_device(other_uid), 1)
+        other.clear()
+        self.assertEqual(list(self.reader.uids()), [self.uid])
+        other.close()
@@ -4,6 +4,11 @@ General utilities for unit tests.
 import asyncio
 import unittest
 
+import aioprocessing
+
+from runtime import hibike_message as hm
+from runtime.hibike_process import SmartSensorProtocol
+
 def run_with_random_data(func, arg_func, kwarg_func=lambda: {}, times=5):
     """
     Test FUNC with random arguments generated by ARG_FUNC and
@@ -15,6 +20,46 @@ def run_with_random_data(func, arg_func, kwarg_func=lambda: {}, times=5):
         func(*arg_func(), **kwarg_func())
 
 
+class FakeSerial:
+    """
+    Stands in for the `serial.Serial` of a transport.
+    """
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeTransport:
+    """
+    A transport that records what was written to it.
+    """
+    def __init__(self, port="/dev/ttyFAKE0"):
+        self.writes = []
+        self.closed = False
+        self.serial = FakeSerial(port)
+
+    def write(self, data):
+        """ Record a write. """
+        self.writes.append(bytes(data))
+
+    def is_closing(self):
+        """ Whether the transport was aborted. """
+        return self.closed
+
+    def abort(self):
+        """ Close the transport. """
+        self.closed = True
+
+    def pause_reading(self):
+        """ Does nothing. """
+
+    def resume_reading(self):
+        """ Does nothing. """
+
+    def sent_messages(self):
+        """ Parse everything written so far. """
+        return hm.PacketFramer().feed(b"".join(self.writes))
+
+
 class AsyncTestCase(unittest.TestCase):
     """
     A test case that creates an event loop before a test and
@@ -52,3 +97,25 @@ class AsyncTestCase(unittest.TestCase):
         # pylint: disable=unused-variable
         _, pending = self.loop.run_until_complete(asyncio.wait([task, stop_task],
                                                                return_when=asyncio.FIRST_COMPLETED))
+
+    def make_protocol(self, device_name, devices=None, batched_data=None, # pylint: disable=too-many-arguments
+                      serial_number=0xC0FFEE, port="/dev/ttyFAKE0", state_queue=None,
+                      pending=None, connect=True, **kwargs):
+        """
+        Make a `SmartSensorProtocol` for a device of type ``device_name``
+        with ``serial_number``, connected to a `FakeTransport` on ``port``
+        unless ``connect`` is false. With no ``device_name``, the device has
+        not identified itself yet. Other ``kwargs`` are passed to the protocol.
+        """
+        protocol = SmartSensorProtocol({} if devices is None else devices,
+                                       {} if batched_data is None else batched_data,
+                                       asyncio.Queue(loop=self.loop),
+                                       aioprocessing.AioQueue() if state_queue is None
+                                       else state_queue,
+                                       self.loop, {port} if pending is None else pending,
+                                       **kwargs)
+        if device_name is not None:
+            protocol.uid = hm.device_name_to_id(device_name) << 72 | serial_number
+        if connect:
+            protocol.connection_made(FakeTransport(port))
+        return protocol
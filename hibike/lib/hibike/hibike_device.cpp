@@ -117,9 +117,12 @@ void hibike_loop() {
 
 				case HEART_BEAT_RESPONSE:
 					resp_heartbeat = curr_time;
-					// update sub delay with the queue fullness
-					queue_fullness = *((uint8_t*) &hibike_buff.payload[1]);
-					update_sub_delay();
+					// update sub delay with the queue fullness, if there is one,
+					// and only while subscribed; otherwise keep the requested delay
+					if (hibike_buff.payload_length >= 2 && sub_delay > 0) {
+						queue_fullness = *((uint8_t*) &hibike_buff.payload[1]);
+						update_sub_delay();
+					}
 					break;
 
 				case PING:
@@ -32,12 +32,11 @@ class VirtualDevice(asyncio.Protocol):
     A fake Hibike smart sensor.
     """
     HEARTBEAT_DELAY_MS = 100
-    PACKET_BOUNDARY = bytes([0])
     def __init__(self, uid, event_loop, verbose=False):
         self.uid = uid
         self.event_loop = event_loop
         self._ready = asyncio.Event(loop=event_loop)
-        self.serial_buf = bytearray()
+        self.framer = hm.PacketFramer()
         self.read_queue = asyncio.Queue(loop=event_loop)
         self.verbose = verbose
 
@@ -61,18 +60,8 @@ class VirtualDevice(asyncio.Protocol):
         event_loop.create_task(self.request_heartbeats())
 
     def data_received(self, data):
-        self.serial_buf.extend(data)
-        zero_loc = self.serial_buf.find(bytes([0]))
-        if zero_loc != -1:
-            self.serial_buf = self.serial_buf[zero_loc:]
-            packet = hm.parse_bytes(self.serial_buf)
-            if packet != None:
-                self.serial_buf = self.serial_buf[1:]
-                self.read_queue.put_nowait(packet)
-            elif self.serial_buf.count(self.PACKET_BOUNDARY) > 1:
-                new_packet = self.serial_buf[1:].find(self.PACKET_BOUNDARY) + 1
-                self.serial_buf = self.serial_buf[new_packet:]
-
+        for packet in self.framer.feed(data):
+            self.read_queue.put_nowait(packet)
 
     def verbose_log(self, fmt_string, *fmt_args):
         """Log a message if verbosity is enabled."""
@@ -113,7 +102,7 @@ class VirtualDevice(asyncio.Protocol):
         await self._ready.wait()
         while not self.transport.is_closing():
             await asyncio.sleep(self.HEARTBEAT_DELAY_MS/1000, loop=self.event_loop)
-            hm.send(self.transport, hm.make_heartbeat_request())
+            hm.send(self.transport, hm.encode_cached(hm.make_heartbeat_request))
 
     # pylint: disable=unused-argument
     def _process_ping(self, msg):
@@ -127,7 +116,7 @@ class VirtualDevice(asyncio.Protocol):
         self.update_time = time.time()
         dev_id = hm.uid_to_device_id(self.uid)
         self.verbose_log("Subscription request received")
-        params, delay = struct.unpack("<HH", msg.get_payload())
+        params, delay = struct.unpack("<HH", msg.payload)
         subscribed_params = hm.decode_params(dev_id, params)
         hm.send(self.transport,
                 hm.make_subscription_response(dev_id, subscribed_params, delay, self.uid))
@@ -138,7 +127,7 @@ class VirtualDevice(asyncio.Protocol):
         self.verbose_log("Device read received")
         device_id = hm.uid_to_device_id(self.uid)
         # Send a device data with the requested param and value tuples
-        params, = struct.unpack("<H", msg.get_payload())
+        params, = struct.unpack("<H", msg.payload)
         read_params = hm.decode_params(device_id, params)
         read_data = []
 
@@ -30,6 +30,9 @@ from .util import (
     StudentAPIError,
 )
 from .statemanager import StateManager
+from .emergency_stop import EmergencyStop
+from .event_loops import new_event_loop, LoopLagMonitor, LOOP_LAG_REPORT_INTERVAL
+from .sensor_table import SensorTable, MAX_DEVICES, USING_SHARED_MEMORY
 from .studentapi import Actions, Gamepad, Field, Robot
 
 COROUTINE_WARNING = """
@@ -72,7 +75,7 @@ def print_version():
 
 
 # pylint: disable=too-many-branches,too-many-locals
-def runtime(test_name=""): # pylint: disable=too-many-statements
+def runtime(test_name="", hibike_shards=1, use_uvloop=False): # pylint: disable=too-many-statements
     test_mode = test_name != ""
     max_iter = 3 if test_mode else None
 
@@ -86,14 +89,27 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
     spawn_process = process_factory(bad_things_queue, state_queue)
     restart_count = 0
     emergency_stopped = False
+    # Lets an emergency stop reach Hibike without going through StateManager
+    emergency_stop = EmergencyStop()
+    # Tests check against the canned devices in StateManager, so they
+    # read sensors the slow way.
+    sensor_table = None
+    if USING_SHARED_MEMORY and not test_mode:
+        # Each shard gets its own share of the slots
+        sensor_table = SensorTable.create(max_devices=MAX_DEVICES * hibike_shards)
 
     try:
-        spawn_process(PROCESS_NAMES.STATE_MANAGER, start_state_manager)
-        spawn_process(PROCESS_NAMES.UDP_RECEIVE_PROCESS, start_udp_receiver)
-        spawn_process(PROCESS_NAMES.HIBIKE, start_hibike)
+        spawn_process(PROCESS_NAMES.STATE_MANAGER, start_state_manager, emergency_stop)
+        spawn_process(PROCESS_NAMES.UDP_RECEIVE_PROCESS, start_udp_receiver, emergency_stop)
+        if hibike_shards > 1:
+            spawn_hibike_shards(bad_things_queue, state_queue, sensor_table, hibike_shards,
+                                spawn_process, use_uvloop, emergency_stop)
+        else:
+            spawn_process(PROCESS_NAMES.HIBIKE, start_hibike, sensor_table, None, use_uvloop,
+                          emergency_stop)
 
         def fc_server_target():
-            fc_server = FieldControlServer(state_queue)
+            fc_server = FieldControlServer(state_queue, emergency_stop)
             # pylint: disable=no-member
             asyncio.run(run_field_control_server(fc_server, '0.0.0.0', 6020))
 
@@ -132,19 +148,23 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
                     terminate_process(PROCESS_NAMES.UDP_RECEIVE_PROCESS)
                     terminate_process(PROCESS_NAMES.UDP_SEND_PROCESS)
                     terminate_process(PROCESS_NAMES.TCP_PROCESS)
-                    spawn_process(PROCESS_NAMES.UDP_RECEIVE_PROCESS, start_udp_receiver)
+                    spawn_process(PROCESS_NAMES.UDP_RECEIVE_PROCESS, start_udp_receiver,
+                                  emergency_stop)
+                    state_queue.put([SM_COMMANDS.CLEAR_ADDR, []])
                     dawn_connected = False
                     control_state = "idle"
                     break
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_TELEOP and control_state != "teleop":
                     terminate_process(PROCESS_NAMES.STUDENT_CODE)
                     name = test_name or "teleop"
-                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, name, max_iter)
+                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, name, max_iter,
+                                  sensor_table, use_uvloop, emergency_stop)
                     control_state = "teleop"
                     continue
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_AUTO and control_state != "auto":
                     terminate_process(PROCESS_NAMES.STUDENT_CODE)
-                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, "autonomous")
+                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, "autonomous",
+                                  None, sensor_table, use_uvloop, emergency_stop)
                     control_state = "auto"
                     continue
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_IDLE and control_state != "idle":
@@ -175,10 +195,16 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
         print("Funtime Runtime had too much fun.")
         print(e)
         print("".join(traceback.format_tb(sys.exc_info()[2])))
+    finally:
+        emergency_stop.close()
+        if sensor_table is not None:
+            sensor_table.close()
+            sensor_table.unlink()
 
 
-# pylint: disable=too-many-locals
-def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter=None):
+# pylint: disable=too-many-locals,too-many-arguments
+def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter=None,
+                     sensor_table=None, use_uvloop=False, emergency_stop=None):
     try:
         terminated = False
 
@@ -196,6 +222,10 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
             func(*args)
             signal.alarm(0)
 
+        # Make the loop current before any student code runs, so coroutines
+        # started from `setup` with `Robot.run` land on the loop that runs
+        loop = new_event_loop(use_uvloop)
+
         signal.alarm(RUNTIME_CONFIG.STUDENT_CODE_TIMELIMIT.value)
         try:
             import studentcode as studentCode
@@ -220,7 +250,7 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
         ensure_is_function(test_name + "main", main_fn)
         ensure_not_overridden(studentCode, "Robot")
 
-        studentCode.Robot = Robot(state_queue, pipe)
+        studentCode.Robot = Robot(state_queue, pipe, sensor_table, emergency_stop)
         studentCode.Gamepad = Gamepad(state_queue, pipe)
         studentCode.Field = Field(state_queue, pipe)
         studentCode.Actions = Actions
@@ -238,6 +268,9 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
         exception_cell = [None]
         clarify_coroutine_warnings(exception_cell)
 
+        loop_lag = LoopLagMonitor(loop)
+        lag_report_period = round(LOOP_LAG_REPORT_INTERVAL * RUNTIME_CONFIG.STUDENT_CODE_HZ.value)
+
         async def main_loop():
             exec_count = 0
             while not terminated and (exception_cell[0] is None) and (
@@ -250,6 +283,9 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
                 # Throttle sending print statements
                 if (exec_count % 5) == 0:
                     studentCode.Robot._send_prints() # pylint: disable=protected-access
+                if exec_count and (exec_count % lag_report_period) == 0:
+                    state_queue.put([SM_COMMANDS.RECORD_LOOP_LAG,
+                                     [PROCESS_NAMES.STUDENT_CODE.value, loop_lag.summary()]])
 
                 sleep_time = max(next_call - loop.time(), 0.)
                 state_queue.put([SM_COMMANDS.STUDENT_MAIN_OK, []])
@@ -264,13 +300,12 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
                         "Process Ended",
                         event=BAD_EVENTS.END_EVENT))
 
-        loop = asyncio.get_event_loop()
-
         def my_exception_handler(_loop, context):
             if exception_cell[0] is None:
                 exception_cell[0] = context["exception"]
 
         loop.set_exception_handler(my_exception_handler)
+        loop_lag.start()
         loop.run_until_complete(main_loop())
 
     except TimeoutError:
@@ -283,9 +318,9 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.STUDENT_CODE_ERROR))
 
 
-def start_state_manager(bad_things_queue, state_queue, runtime_pipe):
+def start_state_manager(bad_things_queue, state_queue, runtime_pipe, emergency_stop=None):
     try:
-        state_manager = StateManager(bad_things_queue, state_queue, runtime_pipe)
+        state_manager = StateManager(bad_things_queue, state_queue, runtime_pipe, emergency_stop)
         state_manager.start()
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.STATE_MANAGER_CRASH))
@@ -299,9 +334,9 @@ def start_udp_sender(bad_things_queue, state_queue, sm_pipe):
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.UDP_SEND_ERROR))
 
 
-def start_udp_receiver(bad_things_queue, state_queue, sm_pipe):
+def start_udp_receiver(bad_things_queue, state_queue, sm_pipe, emergency_stop=None):
     try:
-        recv_class = UDPRecvClass(bad_things_queue, state_queue, sm_pipe)
+        recv_class = UDPRecvClass(bad_things_queue, state_queue, sm_pipe, emergency_stop)
         recv_class.start()
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.UDP_RECV_ERROR))
@@ -417,22 +452,72 @@ def test_success(test_file_name):
     return filecmp.cmp(expected_output, test_output)
 
 
-def start_hibike(bad_things_queue, state_queue, pipe):
+def spawn_hibike_shards(bad_things_queue, state_queue, sensor_table, shard_count, spawn_process, # pylint: disable=too-many-arguments
+                        use_uvloop=False, emergency_stop=None):
+    """
+    Split Hibike into SHARD_COUNT processes that each handle some of the
+    serial ports, behind a front end that StateManager talks to as Hibike.
+    """
+    shard_pipes = [multiprocessing.Pipe() for _ in range(shard_count)]
+    sensor_table_lock = multiprocessing.Lock()
+    for shard, (_, pipe) in enumerate(shard_pipes):
+        process_name = "{}_shard_{}".format(PROCESS_NAMES.HIBIKE.value, shard)
+        new_process = multiprocessing.Process(
+            target=start_hibike_shard, name=process_name,
+            args=[bad_things_queue, state_queue, pipe, sensor_table, shard, shard_count,
+                  sensor_table_lock, use_uvloop, emergency_stop])
+        ALL_PROCESSES[process_name] = new_process
+        new_process.daemon = True
+        new_process.start()
+    spawn_process(PROCESS_NAMES.HIBIKE, start_hibike, sensor_table,
+                  [front_end_pipe for front_end_pipe, _ in shard_pipes])
+
+
+def add_hibike_paths():
+    """Modify sys.path so we can find hibike.
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    parent_path = path.rstrip("runtime")
+    hibike = os.path.join(parent_path, "hibike")
+    sys.path.insert(1, hibike)
+
+
+def start_hibike(bad_things_queue, state_queue, pipe, sensor_table=None, shard_pipes=None, # pylint: disable=too-many-arguments
+                 use_uvloop=False, emergency_stop=None):
     # bad_things_queue - queue to runtime
     # state_queue - queue to StateManager
     # pipe - pipe from statemanager
-    def add_paths():
-        """Modify sys.path so we can find hibike.
-        """
-        path = os.path.dirname(os.path.abspath(__file__))
-        parent_path = path.rstrip("runtime")
-        hibike = os.path.join(parent_path, "hibike")
-        sys.path.insert(1, hibike)
+    # sensor_table - shared memory for sensor values, or None
+    # shard_pipes - pipes to the Hibike shards, if Hibike is split into shards
+    # use_uvloop - whether to run on uvloop, if it is installed
+    # emergency_stop - the `EmergencyStop` that disables every device at once
+    try:
+        add_hibike_paths()
+        from . import hibike_process # pylint: disable=import-error
+        if shard_pipes:
+            hibike_process.hibike_front_end(bad_things_queue, pipe, shard_pipes)
+        else:
+            hibike_process.hibike_process(bad_things_queue, state_queue, pipe, sensor_table,
+                                          use_uvloop=use_uvloop,
+                                          emergency_stop=emergency_stop)
+    except Exception as e:
+        bad_things_queue.put(BadThing(sys.exc_info(), str(e)))
+
 
+def start_hibike_shard(bad_things_queue, state_queue, pipe, sensor_table, # pylint: disable=too-many-arguments
+                       shard, shard_count, sensor_table_lock, use_uvloop=False,
+                       emergency_stop=None):
+    # pipe - pipe from the Hibike front end
+    # shard, shard_count - which of the Hibike shards this is
+    # sensor_table_lock - shared by the shards that write to sensor_table
     try:
-        add_paths()
+        add_hibike_paths()
         from . import hibike_process # pylint: disable=import-error
-        hibike_process.hibike_process(bad_things_queue, state_queue, pipe)
+        if sensor_table is not None:
+            sensor_table.share(shard, shard_count, sensor_table_lock)
+        hibike_process.hibike_process(bad_things_queue, state_queue, pipe, sensor_table,
+                                      shard=shard, shard_count=shard_count,
+                                      use_uvloop=use_uvloop, emergency_stop=emergency_stop)
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e)))
 
@@ -477,11 +562,15 @@ def main():
                         help="Run specified tests. If no arguments, run all tests.")
     parser.add_argument('-v', '--version', action='store_true',
                         help='Print the version and exit.')
+    parser.add_argument("--hibike-shards", type=int, default=1, metavar="N",
+                        help="Spread serial ports across N Hibike processes.")
+    parser.add_argument("--uvloop", action="store_true",
+                        help="Run Hibike and student code on uvloop, if it is installed.")
     arguments = parser.parse_args()
     if arguments.version:
         print_version()
     elif arguments.test is None:
-        runtime()
+        runtime(hibike_shards=max(arguments.hibike_shards, 1), use_uvloop=arguments.uvloop)
     else:
         runtime_test(arguments.test)
 
@@ -142,10 +142,16 @@ class UDPSendClass(AnsibleHandler):
             try:
                 proto_message = runtime_pb2.RuntimeData()
                 proto_message.robot_state = state['studentCodeState'][0]
+                stale_devices = state['hibike'][0].get('stale_devices', [{}])[0]
                 for uid, values in state['hibike'][0]['devices'][0].items():
                     sensor = proto_message.sensor_data.add()
                     sensor.uid = str(uid)
                     sensor.device_type = SENSOR_TYPE[uid >> 72]
+                    if uid in stale_devices:
+                        # The proto has no field for this, so send it as a param
+                        stale_pair = sensor.param_value.add()
+                        stale_pair.param = 'stale'
+                        stale_pair.bool_value = True
                     for param, value in values[0].items():
                         if value[0] is None:
                             continue
@@ -219,8 +225,10 @@ class UDPRecvClass(AnsibleHandler):
     is sent to SM.
     """
 
-    def __init__(self, badThingsQueue, stateQueue, pipe):
+    def __init__(self, badThingsQueue, stateQueue, pipe, emergencyStop=None):
         self.recv_buffer = TwoBuffer()
+        # The `EmergencyStop` fast path to Hibike, if any
+        self.emergency_stop = emergencyStop
         packager_name = ThreadNames.UDP_UNPACKAGER
         sock_recv_name = ThreadNames.UDP_RECEIVER
         host = ""  # 0.0.0.0
@@ -288,6 +296,9 @@ class UDPRecvClass(AnsibleHandler):
             if self.control_state is None or new_state != self.control_state:
                 self.control_state = received_proto.student_code_status
                 sm_state_command = self.sm_mapping[new_state]
+                if (sm_state_command is SM_COMMANDS.EMERGENCY_STOP
+                        and self.emergency_stop is not None):
+                    self.emergency_stop.trigger()
                 self.state_queue.put([sm_state_command, []])
             all_gamepad_dict = {}
             for gamepad in received_proto.gamepads:
@@ -542,8 +553,9 @@ solution = None
 
 
 class FieldControlServer:
-    def __init__(self, state_queue):
+    def __init__(self, state_queue, emergency_stop=None):
         self.state_queue = state_queue
+        self.emergency_stop = emergency_stop
         self.access = asyncio.Lock()
 
     def set_alliance(self, alliance: str):
@@ -559,6 +571,8 @@ class FieldControlServer:
             'teleop': SM_COMMANDS.ENTER_TELEOP,
             'estop': SM_COMMANDS.EMERGENCY_STOP,
         }
+        if modes[mode] is SM_COMMANDS.EMERGENCY_STOP and self.emergency_stop is not None:
+            self.emergency_stop.trigger()
         self.state_queue.put([modes[mode], []])
 
     def set_master(self, master: bool):
@@ -0,0 +1,139 @@
+"""
+Lookup tables for the device types in hibikeDevices.json.
+
+Parsing the JSON and building the tables on every import is slow for the
+student code process, which imports them each time it restarts. Running
+
+    python3 -m runtime.device_schema
+
+(or `make devices`) compiles the tables into the `device_tables` module,
+which is imported instead. If that module is missing, or was generated
+from a different version of the JSON, the tables are built from the JSON.
+
+Tables:
+    DEVICES          - device IDs -> devices, as they appear in the JSON
+    PARAM_MAP        - device IDs -> param names -> (number, type, read, write)
+    DEVICE_IDS       - device names -> device IDs
+    DEVICE_NAMES     - device IDs -> device names
+    PARAMS_BY_NUMBER - device IDs -> (param name, struct format character)
+                       for each param, in order of param number
+"""
+import os
+import sys
+import zlib
+from types import MappingProxyType
+
+__all__ = ["DEVICES", "PARAM_MAP", "DEVICE_IDS", "DEVICE_NAMES", "PARAMS_BY_NUMBER",
+           "PARAM_TYPES", "USING_GENERATED_TABLES"]
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "hibikeDevices.json")
+GENERATED_FILE = os.path.join(os.path.dirname(__file__), "device_tables.py")
+TABLE_NAMES = ("DEVICES", "PARAM_MAP", "DEVICE_IDS", "DEVICE_NAMES", "PARAMS_BY_NUMBER")
+
+# Dictionary mapping param types to python struct format characters
+PARAM_TYPES = {
+    "bool": "?",
+    "uint8_t": "B",
+    "int8_t": "b",
+    "uint16_t": "H",
+    "int16_t": "h",
+    "uint32_t": "I",
+    "int32_t": "i",
+    "uint64_t": "Q",
+    "int64_t": "q",
+    "float": "f",
+    "double": "d"
+}
+
+GENERATED_HEADER = '''"""
+Lookup tables for the device types in hibikeDevices.json.
+
+Generated by `python3 -m runtime.device_schema`. Do not edit.
+"""
+# pylint: skip-file
+'''
+
+
+def schema_digest(contents):
+    """
+    A checksum of the JSON schema CONTENTS, to tell whether generated tables
+    are up to date.
+    """
+    return zlib.crc32(contents)
+
+
+def build_tables(devices):
+    """
+    Build the tables from DEVICES, a list of devices as in the JSON.
+    """
+    params_by_number = {}
+    for device in devices:
+        params = sorted(device["params"], key=lambda param: param["number"])
+        params_by_number[device["id"]] = tuple((param["name"], PARAM_TYPES[param["type"]])
+                                               for param in params)
+    return {
+        "DEVICES": {device["id"]: device for device in devices},
+        "PARAM_MAP": {device["id"]: {param["name"]: (param["number"], param["type"],
+                                                     param["read"], param["write"])
+                                     for param in device["params"]}
+                      for device in devices},
+        "DEVICE_IDS": {device["name"]: device["id"] for device in devices},
+        "DEVICE_NAMES": {device["id"]: device["name"] for device in devices},
+        "PARAMS_BY_NUMBER": params_by_number,
+    }
+
+
+def generate(schema_file=SCHEMA_FILE, generated_file=GENERATED_FILE):
+    """
+    Compile the tables for SCHEMA_FILE into a module at GENERATED_FILE.
+    """
+    import json
+    import pprint
+    with open(schema_file, "rb") as schema:
+        contents = schema.read()
+    tables = build_tables(json.loads(contents))
+    with open(generated_file, "w") as generated:
+        generated.write(GENERATED_HEADER)
+        generated.write("\nSCHEMA_DIGEST = {!r}\n".format(schema_digest(contents)))
+        for name in TABLE_NAMES:
+            generated.write("\n{} = {}\n".format(name, pprint.pformat(tables[name], width=100)))
+
+
+def load_tables(schema_file=SCHEMA_FILE):
+    """
+    The tables for SCHEMA_FILE, and whether they came from the generated module.
+    """
+    with open(schema_file, "rb") as schema:
+        contents = schema.read()
+    try:
+        from . import device_tables
+    except ImportError:
+        device_tables = None
+    if device_tables is not None and device_tables.SCHEMA_DIGEST == schema_digest(contents):
+        return {name: getattr(device_tables, name) for name in TABLE_NAMES}, True
+    # The json module alone takes longer to import than the generated tables
+    import json
+    return build_tables(json.loads(contents)), False
+
+
+def freeze(tables):
+    """
+    Make read-only views of TABLES.
+    """
+    frozen = {name: MappingProxyType(table) for name, table in tables.items()}
+    frozen["PARAM_MAP"] = MappingProxyType({device_id: MappingProxyType(params)
+                                            for device_id, params in tables["PARAM_MAP"].items()})
+    return frozen
+
+
+_TABLES, USING_GENERATED_TABLES = load_tables()
+_TABLES = freeze(_TABLES)
+DEVICES = _TABLES["DEVICES"]
+PARAM_MAP = _TABLES["PARAM_MAP"]
+DEVICE_IDS = _TABLES["DEVICE_IDS"]
+DEVICE_NAMES = _TABLES["DEVICE_NAMES"]
+PARAMS_BY_NUMBER = _TABLES["PARAMS_BY_NUMBER"]
+
+
+if __name__ == "__main__":
+    generate(*sys.argv[1:])
@@ -0,0 +1,77 @@
+"""
+A fast path for emergency stops that skips StateManager's queue.
+
+An emergency stop normally goes from whoever asked for it to StateManager,
+to the runtime main loop, back through StateManager, and down a pipe to
+Hibike, so it can wait behind a backlog of sensor batches. `EmergencyStop`
+is created before Runtime's processes are forked and is shared by all of
+them. Triggering it stores the time in shared memory and writes a byte to
+a pipe that Hibike watches with its event loop, so Hibike disables every
+device as soon as it wakes up. The usual path still runs alongside it, to
+stop student code and update the robot's state.
+
+Stops are latched: the byte is never read back out, so every process
+watching the pipe sees it. Runtime shuts down after an emergency stop.
+"""
+import multiprocessing
+import os
+import time
+
+__all__ = ["EmergencyStop"]
+
+
+class EmergencyStop:
+    """
+    A latched emergency stop flag that processes can wait on.
+
+    Must be created before the processes that share it are forked.
+    """
+    __slots__ = ("_triggered_at", "_read_fd", "_write_fd")
+
+    def __init__(self):
+        # The `time.monotonic` of the first trigger, or 0. The monotonic
+        # clock is system-wide, so the time means the same in every process.
+        self._triggered_at = multiprocessing.Value("d", 0.)
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._write_fd, False)
+
+    def trigger(self):
+        """
+        Stop the robot. Returns whether this was the first trigger.
+        """
+        with self._triggered_at.get_lock():
+            if self._triggered_at.value:
+                return False
+            self._triggered_at.value = time.monotonic()
+        os.write(self._write_fd, b"\x00")
+        return True
+
+    @property
+    def triggered(self):
+        """
+        Whether the robot has been stopped.
+        """
+        return self._triggered_at.value != 0
+
+    def latency(self):
+        """
+        Seconds since the first trigger, or None if there hasn't been one.
+        """
+        triggered_at = self._triggered_at.value
+        if not triggered_at:
+            return None
+        return time.monotonic() - triggered_at
+
+    def fileno(self):
+        """
+        A file descriptor that becomes readable, and stays readable, once
+        the robot is stopped.
+        """
+        return self._read_fd
+
+    def close(self):
+        """
+        Close the pipe in this process.
+        """
+        os.close(self._read_fd)
+        os.close(self._write_fd)
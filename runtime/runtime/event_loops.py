@@ -0,0 +1,102 @@
+"""
+Event loops for Runtime's processes, and a monitor of how late they run.
+
+Processes can run on uvloop, if it is installed, instead of the default
+asyncio loop. `LoopLagMonitor` schedules a callback at a fixed interval
+and measures how late it runs, which is how long anything scheduled on
+the loop waits behind other work: the headroom a process has left.
+"""
+import asyncio
+import collections
+
+try:
+    import uvloop
+    USING_UVLOOP = True
+except ImportError:
+    USING_UVLOOP = False
+
+__all__ = ["new_event_loop", "LoopLagMonitor", "USING_UVLOOP"]
+
+# Time in seconds between loop lag samples
+LOOP_LAG_INTERVAL = 0.05
+# How many of the latest samples percentiles are taken over (10 seconds' worth)
+LOOP_LAG_WINDOW = 200
+# Time in seconds between loop lag reports to StateManager
+LOOP_LAG_REPORT_INTERVAL = 1
+
+
+def new_event_loop(use_uvloop=False):
+    """
+    Make a new event loop the current one and return it.
+
+    With USE_UVLOOP, the loop is a uvloop loop, if uvloop is installed.
+    """
+    if use_uvloop and USING_UVLOOP:
+        event_loop = uvloop.new_event_loop()
+    else:
+        if use_uvloop:
+            print("Unable to import uvloop, using the default event loop instead.")
+        event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    return event_loop
+
+
+class LoopLagMonitor:
+    """
+    Sample how late an event loop runs callbacks.
+
+    :param event_loop: The event loop to monitor
+    :param float interval: Time in seconds between samples
+    :param int window: How many of the latest samples to keep
+    """
+    __slots__ = ("_event_loop", "_interval", "_samples", "_expected", "_handle")
+
+    def __init__(self, event_loop, interval=LOOP_LAG_INTERVAL, window=LOOP_LAG_WINDOW):
+        self._event_loop = event_loop
+        self._interval = interval
+        # Lag of each sample, in milliseconds
+        self._samples = collections.deque(maxlen=window)
+        self._expected = None
+        self._handle = None
+
+    def start(self):
+        """
+        Start sampling.
+        """
+        self._expected = self._event_loop.time() + self._interval
+        self._handle = self._event_loop.call_at(self._expected, self._sample)
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _sample(self):
+        now = self._event_loop.time()
+        self._samples.append((now - self._expected) * 1000)
+        # Schedule from now, so a long stall counts as one late sample
+        self._expected = now + self._interval
+        self._handle = self._event_loop.call_at(self._expected, self._sample)
+
+    def percentile(self, fraction):
+        """
+        The lag, in milliseconds, that FRACTION of the samples are at most,
+        or None if there are no samples yet.
+        """
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+    def summary(self):
+        """
+        The median, 99th percentile and largest lag in milliseconds, and
+        the number of samples they were taken over.
+        """
+        return {"p50": self.percentile(0.5),
+                "p99": self.percentile(0.99),
+                "max": max(self._samples, default=None),
+                "samples": len(self._samples)}
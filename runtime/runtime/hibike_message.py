@@ -3,24 +3,16 @@ Functions and classes for dealing with Hibike packets.
 """
 from __future__ import print_function
 # Rewritten because Python.__version__ != 3
+import importlib.util
 import struct
-import os
-import json
 import threading
 from functools import lru_cache
 
 from cobs import cobs
 
-CONFIG_FILE = open(os.path.join(
-    os.path.dirname(__file__), 'hibikeDevices.json'), 'r')
-DEVICES = json.load(CONFIG_FILE)
+from .device_schema import (DEVICES, PARAM_MAP, DEVICE_IDS, DEVICE_NAMES, PARAMS_BY_NUMBER,
+                            PARAM_TYPES)
 
-PARAM_MAP = {device["id"]: {param["name"]: (param["number"],
-                                            param["type"],
-                                            param["read"],
-                                            param["write"]) for param in device["params"]}
-             for device in DEVICES}
-DEVICES = {device["id"]: device for device in DEVICES}
 """
 structure of devices
 {0:
@@ -33,20 +25,13 @@ structure of devices
 
 """
 
-# Dictionary mapping param types to python struct format characters
-PARAM_TYPES = {
-    "bool": "?",
-    "uint8_t": "B",
-    "int8_t": "b",
-    "uint16_t": "H",
-    "int16_t": "h",
-    "uint32_t": "I",
-    "int32_t": "i",
-    "uint64_t": "Q",
-    "int64_t": "q",
-    "float": "f",
-    "double": "d"
-}
+# NumPy is only imported by the first batch of checksums large enough to use it
+USING_NUMPY = importlib.util.find_spec("numpy") is not None
+# Below this many messages, validating checksums one at a time is faster than NumPy
+NUMPY_BATCH_MIN_MESSAGES = 16
+
+# The leading params bitmask of DeviceData and DeviceWrite payloads
+PARAMS_BITMASK_STRUCT = struct.Struct("<H")
 
 # Dictionary of message types: message id
 MESSAGE_TYPES = {
@@ -70,15 +55,33 @@ ERROR_CODES = {
 }
 
 
+def _readonly_view(data):
+    """
+    A read-only ``memoryview`` of DATA.
+    """
+    view = memoryview(data)
+    if view.readonly:
+        return view
+    # memoryview.toreadonly is new in Python 3.8; before then, copy instead
+    if hasattr(view, "toreadonly"):
+        return view.toreadonly()
+    return memoryview(bytes(view))
+
+
 class HibikeMessage:
     """
     An Hibike packet.
+
+    The payload is kept as a read-only ``memoryview`` into whatever buffer it
+    was parsed from or built in, so creating and decoding messages does not
+    copy it (except on Python 3.7 and earlier).
     """
+    __slots__ = ("_message_id", "_payload")
+
     def __init__(self, message_id, payload):
         assert message_id in MESSAGE_TYPES.values()
         self._message_id = message_id
-        self._payload = payload[:]
-        self._length = len(payload)
+        self._payload = _readonly_view(payload)
 
     def get_message_id(self):
         """
@@ -86,24 +89,40 @@ class HibikeMessage:
         """
         return self._message_id
 
+    @property
+    def payload(self):
+        """
+        A read-only view of the payload.
+        """
+        return self._payload
+
     def get_payload(self):
         """
         Get a copy of the payload as a bytearray.
         """
-        return self._payload[:]
+        return bytearray(self._payload)
 
     def to_bytes(self):
         """
         A representation of this message in bytes.
         """
-        m_buff = bytearray()
-        m_buff.append(self._message_id)
-        m_buff.append(self._length)
-        m_buff.extend(self.get_payload())
+        m_buff = bytearray(len(self._payload) + 2)
+        self.write_into(m_buff)
         return m_buff
 
+    def write_into(self, m_buff):
+        """
+        Write the header and payload into the start of ``m_buff``,
+        returning the number of bytes written.
+        """
+        length = len(self._payload)
+        m_buff[0] = self._message_id
+        m_buff[1] = length
+        m_buff[2:length + 2] = self._payload
+        return length + 2
+
     def __str__(self):
-        return str([self._message_id] + [self._length] + list(self._payload))
+        return str([self._message_id] + [len(self._payload)] + list(self._payload))
 
     def __repr__(self):
         return str(self)
@@ -133,29 +152,83 @@ def get_id(uid):
 
 def checksum(data):
     """
-    Compute a checksum for DATA.
+    Compute a checksum for DATA: the XOR of all its bytes.
+
+    DATA is read as one big integer, which is folded in half until it fits
+    in 64 bits, so the XOR is done a machine word at a time instead of a
+    byte at a time.
     """
-    # Remove this later after development
-    assert isinstance(data, bytearray), "data must be a bytearray"
+    value = int.from_bytes(data, "little")
+    width = len(data) * 8
+    while width > 64:
+        width = (width + 127) // 128 * 64
+        value = (value >> width) ^ (value & ((1 << width) - 1))
+    value ^= value >> 32
+    value ^= value >> 16
+    value ^= value >> 8
+    return value & 0xFF
 
-    chk = data[0]
-    for i in range(1, len(data)):
-        chk ^= data[i]
-    return chk
+
+def validate_checksums(messages):
+    """
+    Check the checksums of MESSAGES, a list of decoded messages that each
+    end with their checksum byte.
+
+    A message is valid when the XOR of all its bytes, checksum included, is
+    zero. Large batches are checked with NumPy, if it is installed.
+
+    Returns:
+        A list of whether each message is valid.
+    """
+    if USING_NUMPY and len(messages) >= NUMPY_BATCH_MIN_MESSAGES:
+        # Only imported here, so processes that never see a batch this
+        # large don't pay for importing NumPy
+        import numpy  # pylint: disable=import-outside-toplevel
+        lengths = numpy.fromiter(map(len, messages), dtype=numpy.intp, count=len(messages))
+        offsets = numpy.zeros(len(messages), dtype=numpy.intp)
+        numpy.cumsum(lengths[:-1], out=offsets[1:])
+        data = numpy.frombuffer(b"".join(messages), dtype=numpy.uint8)
+        return (numpy.bitwise_xor.reduceat(data, offsets) == 0).tolist()
+    return [checksum(message) == 0 for message in messages]
+
+
+def encode(message):
+    """
+    Frame ``message`` for the wire: a zero byte, the COBS-encoded length,
+    then the COBS-encoded message and checksum.
+    """
+    m_buff = bytearray(len(message.payload) + 3)
+    end = message.write_into(m_buff)
+    m_buff[end] = checksum(memoryview(m_buff)[:end])
+    encoded = cobs.encode(m_buff)
+    out_buf = bytearray(len(encoded) + 2)
+    out_buf[1] = len(encoded)
+    out_buf[2:] = encoded
+    return out_buf
+
+
+@lru_cache(maxsize=512)
+def encode_cached(make_message, *args):
+    """
+    The wire bytes of ``make_message(*args)``, framed once per distinct ARGS.
+
+    For messages fully determined by a few hashable arguments, such as pings,
+    disables, heartbeats and unsubscriptions, which are sent over and over.
+    """
+    return bytes(encode(make_message(*args)))
 
 
 def send(connection, message):
     """
     Send ``message`` over ``connection``.
 
+    ``message`` is a HibikeMessage or wire bytes from ``encode_cached``.
     This function accepts regular serial ports or asynchronous transports.
     """
-    m_buff = message.to_bytes()
-    chk = checksum(m_buff)
-    m_buff.append(chk)
-    encoded = cobs_encode(m_buff)
-    out_buf = bytearray([0x00, len(encoded)]) + encoded
-    connection.write(out_buf)
+    if isinstance(message, bytes):
+        connection.write(message)
+    else:
+        connection.write(encode(message))
 
 
 def encode_params(device_id, params):
@@ -168,15 +241,13 @@ def encode_params(device_id, params):
     Returns:
         An int representing the bitmask of a set of parameters.
     """
-    param_nums = [PARAM_MAP[device_id][name][0] for name in params]
-    entries = [1 << num for num in param_nums]
+    param_map = PARAM_MAP[device_id]
     mask = 0
-    for entry in entries:
-        mask = mask | entry
+    for name in params:
+        mask |= 1 << param_map[name][0]
     return mask
 
 
-@lru_cache(maxsize=128)
 def decode_params(device_id, params_bitmask):
     """
     Decode PARAMS_BITMASK.
@@ -187,16 +258,7 @@ def decode_params(device_id, params_bitmask):
     Returns:
         A list of names symbolizing the encoded parameters.
     """
-    converted_params = []
-    for param_count in range(16):
-        if (params_bitmask & (1 << param_count)) > 0:
-            converted_params.append(param_count)
-    named_params = []
-    for param in converted_params:
-        if param >= len(DEVICES[device_id]["params"]):
-            break
-        named_params.append(DEVICES[device_id]["params"][param]["name"])
-    return named_params
+    return list(CODECS[device_id, params_bitmask].params)
 
 
 @lru_cache(maxsize=128)
@@ -220,6 +282,71 @@ def format_string(device_id, params):
     return format_string_cached(device_id, tuple(params))
 
 
+class ParamCodec:
+    """
+    A precompiled encoder and decoder for one set of parameters of a device type.
+
+    The payload of a ``DeviceData`` or ``DeviceWrite`` packet is the params
+    bitmask followed by the values of those params in order of param number,
+    so one ``struct.Struct`` covers the whole payload.
+
+    :param int device_id: A device type id (not uid)
+    :param int bitmask: The set of parameters in binary form
+    """
+    __slots__ = ("device_id", "bitmask", "params", "payload_struct")
+
+    def __init__(self, device_id, bitmask):
+        self.device_id = device_id
+        self.bitmask = bitmask
+        all_params = PARAMS_BY_NUMBER[device_id]
+        params = []
+        type_string = "<H"
+        for param_count in range(16):
+            if bitmask & (1 << param_count):
+                if param_count >= len(all_params):
+                    break
+                name, type_char = all_params[param_count]
+                params.append(name)
+                type_string += type_char
+        self.params = tuple(params)
+        self.payload_struct = struct.Struct(type_string)
+
+    def encode(self, params_and_values):
+        """
+        Pack an iterable of (param, value) tuples into a payload.
+        """
+        values = dict(params_and_values)
+        return self.payload_struct.pack(self.bitmask, *[values[name] for name in self.params])
+
+    def decode(self, payload):
+        """
+        Unpack a payload into a list of (param, value) tuples.
+        """
+        return list(zip(self.params, self.payload_struct.unpack(payload)[1:]))
+
+
+class CodecRegistry(dict):
+    """
+    A mapping from ``(device_id, params_bitmask)`` to ``ParamCodec``.
+
+    Codecs are compiled the first time a combination is seen and reused
+    afterwards, so the per-packet cost is a single dictionary lookup.
+    """
+    def __missing__(self, key):
+        device_id, bitmask = key
+        codec = self[key] = ParamCodec(device_id, bitmask)
+        return codec
+
+    def for_params(self, device_id, params):
+        """
+        Get the codec for an iterable of param names.
+        """
+        return self[device_id, encode_params(device_id, params)]
+
+
+CODECS = CodecRegistry()
+
+
 def make_ping():
     """ Makes and returns Ping message."""
     payload = bytearray()
@@ -240,9 +367,17 @@ def make_heartbeat_request(heartbeat_id=0):
     message = HibikeMessage(MESSAGE_TYPES["HeartBeatRequest"], payload)
     return message
 
-def make_heartbeat_response(heartbeat_id=0):
-    """ Makes and returns HeartBeat message."""
-    payload = bytearray(struct.pack('<B', heartbeat_id))
+def make_heartbeat_response(heartbeat_id=0, queue_fullness=None):
+    """
+    Makes and returns HeartBeat message.
+
+    If QUEUE_FULLNESS is given, smart sensors adjust their subscription
+    delays to it: 0 means send at full speed, and 100 means as slowly as possible.
+    """
+    if queue_fullness is None:
+        payload = bytearray(struct.pack('<B', heartbeat_id))
+    else:
+        payload = bytearray(struct.pack('<BB', heartbeat_id, queue_fullness))
     message = HibikeMessage(MESSAGE_TYPES["HeartBeatResponse"], payload)
     return message
 
@@ -317,15 +452,9 @@ def make_device_write(device_id, params_and_values):
         device_id         - a device type id (not uid).
         params_and_values - an iterable of param (name, value) tuples
     """
-    params_and_values = sorted(
-        params_and_values, key=lambda x: PARAM_MAP[device_id][x[0]][0])
-    params = [param[0] for param in params_and_values]
-    params_bitmask = encode_params(device_id, params)
-    values = [param[1] for param in params_and_values]
-
-    type_string = '<H' + format_string(device_id, params)
-    temp_payload = struct.pack(type_string, params_bitmask, *values)
-    payload = bytearray(temp_payload)
+    params_and_values = list(params_and_values)
+    codec = CODECS.for_params(device_id, [param for param, _ in params_and_values])
+    payload = bytearray(codec.encode(params_and_values))
     message = HibikeMessage(MESSAGE_TYPES["DeviceWrite"], payload)
     return message
 
@@ -341,15 +470,9 @@ def make_device_data(device_id, params_and_values):
         device_id         - a device type id (not uid).
         params_and_values - an iterable of param (name, value) tuples
     """
-    params = [param_tuple[0] for param_tuple in params_and_values]
-    params_bitmask = encode_params(device_id, params)
-    values = [param_tuple[1] for param_tuple in params_and_values]
-
-    type_string = '<H' + format_string(device_id, params)
-
-    temp_payload = struct.pack(type_string, params_bitmask, *values)
-    payload = bytearray(temp_payload)
-
+    params_and_values = list(params_and_values)
+    codec = CODECS.for_params(device_id, [param for param, _ in params_and_values])
+    payload = bytearray(codec.encode(params_and_values))
     message = HibikeMessage(MESSAGE_TYPES["DeviceData"], payload)
     return message
 
@@ -367,7 +490,7 @@ def parse_subscription_response(msg):
     Expand MSG into its constituent parts.
     """
     assert msg.get_message_id() == MESSAGE_TYPES["SubscriptionResponse"]
-    payload = msg.get_payload()
+    payload = msg.payload
     assert len(payload) == 15
     params, delay, device_id, year, id_num = struct.unpack("<HHHBQ", payload)
     params = decode_params(device_id, params)
@@ -380,13 +503,10 @@ def decode_device_write(msg, device_id):
     Decode a DeviceWrite packet, MSG, into its constituent parts.
     """
     assert msg.get_message_id() == MESSAGE_TYPES["DeviceWrite"]
-    payload = msg.get_payload()
+    payload = msg.payload
     assert len(payload) >= 2
-    params, = struct.unpack("<H", payload[:2])
-    params = decode_params(device_id, params)
-    struct_format = "<" + format_string(device_id, params)
-    values = struct.unpack(struct_format, payload[2:])
-    return list(zip(params, values))
+    params, = PARAMS_BITMASK_STRUCT.unpack_from(payload)
+    return CODECS[device_id, params].decode(payload)
 
 
 def parse_device_data(msg, device_id):
@@ -394,13 +514,38 @@ def parse_device_data(msg, device_id):
     Decode a DeviceData packet, MSG, into its constituent parts.
     """
     assert msg.get_message_id() == MESSAGE_TYPES["DeviceData"]
-    payload = msg.get_payload()
+    payload = msg.payload
     assert len(payload) >= 2
-    params, = struct.unpack("<H", payload[:2])
-    params = decode_params(device_id, params)
-    struct_format = "<" + format_string(device_id, params)
-    values = struct.unpack(struct_format, payload[2:])
-    return list(zip(params, values))
+    params, = PARAMS_BITMASK_STRUCT.unpack_from(payload)
+    return CODECS[device_id, params].decode(payload)
+
+
+def unframe(encoded):
+    """
+    COBS-decode the body of a single frame into a message ending with its
+    checksum byte, or None if the frame is malformed.
+    """
+    message = cobs_decode(encoded)
+    if len(message) < 2 or len(message) != 2 + message[1] + 1:
+        return None
+    return message
+
+
+def decode_frame(encoded):
+    """
+    Decode the COBS-encoded body of a single frame into a HibikeMessage.
+
+    Returns:
+        None if the frame is malformed.
+        -1 if the checksum doesn't match.
+        Otherwise, a new HibikeMessage.
+    """
+    message = unframe(encoded)
+    if message is None:
+        return None
+    if checksum(message) != 0:
+        return -1
+    return HibikeMessage(message[0], memoryview(message)[2:-1])
 
 
 def parse_bytes(msg_bytes):
@@ -412,62 +557,98 @@ def parse_bytes(msg_bytes):
     cobs_frame, message_size = msg_bytes[:2]
     if cobs_frame != 0 or len(msg_bytes) < message_size + 2:
         return None
-    message = cobs_decode(msg_bytes[2:message_size + 2])
-
-    if len(message) < 2:
+    message = decode_frame(msg_bytes[2:message_size + 2])
+    if message == -1:
         return None
-    message_id, payload_length = message[0], message[1]
-    if len(message) < 2 + payload_length + 1:
-        return None
-    payload = message[2:2 + payload_length]
-    chk = message[2 + payload_length]
-    if chk != checksum(message[:-1]):
-        return None
-    return HibikeMessage(message_id, payload)
+    return message
+
+
+class PacketFramer:
+    """
+    Split a stream of bytes from a serial port into Hibike packets.
+
+    Bytes are fed in as they arrive; every complete frame is decoded and only
+    the unconsumed tail is kept for the next call, so draining a read that
+    holds many packets takes linear time. The checksums of all the frames
+    completed by a read are validated together.
+
+    Attributes:
+        resyncs         - how many times garbage or a truncated frame was skipped
+        checksum_errors - how many frames were dropped for a bad checksum
+    """
+    __slots__ = ("_buf", "resyncs", "checksum_errors")
+
+    def __init__(self):
+        self._buf = bytearray()
+        self.resyncs = 0
+        self.checksum_errors = 0
+
+    def feed(self, data):
+        """
+        Consume DATA and return a list of every packet completed by it.
+        """
+        buf = self._buf
+        buf.extend(data)
+        buf_len = len(buf)
+        messages = []
+        pos = 0
+        while True:
+            start = buf.find(0, pos)
+            if start == -1:
+                if pos < buf_len:
+                    self.resyncs += 1
+                pos = buf_len
+                break
+            if start != pos:
+                self.resyncs += 1
+            if start + 1 >= buf_len:
+                pos = start
+                break
+            frame_end = start + 2 + buf[start + 1]
+            # COBS-encoded data never contains a zero, so a zero inside the
+            # frame means it was cut short and a new packet has started.
+            next_zero = buf.find(0, start + 1, min(frame_end, buf_len))
+            if next_zero != -1:
+                self.resyncs += 1
+                pos = next_zero
+                continue
+            if frame_end > buf_len:
+                pos = start
+                break
+            message = unframe(buf[start + 2:frame_end])
+            if message is None:
+                self.resyncs += 1
+            else:
+                messages.append(message)
+            pos = frame_end
+        del buf[:pos]
+        packets = []
+        for message, valid in zip(messages, validate_checksums(messages)):
+            if valid:
+                packets.append(HibikeMessage(message[0], memoryview(message)[2:-1]))
+            else:
+                self.checksum_errors += 1
+        return packets
 
 
 def blocking_read_generator(serial_conn, stop_event=threading.Event()):
     """
     Yield packets from SERIAL_CONN, stopping if STOP_EVENT is set.
     """
-    zero_byte = bytes([0])
-    packets_buffer = bytearray()
+    framer = PacketFramer()
     # Switch to nonblocking mode so that we don't get stuck reading
     old_timeout = serial_conn.timeout
     serial_conn.timeout = 0
     while not stop_event.is_set():
-        # Wait for a 0 byte to appear
-        if packets_buffer.find(zero_byte) == -1:
-            new_bytes = serial_conn.read(max(1, serial_conn.inWaiting()))
-            packets_buffer.extend(new_bytes)
-            continue
-
-        # Truncate incomplete packets at start of buffer
-        packets_buffer = packets_buffer[packets_buffer.find(zero_byte):]
-
-        # Attempt to parse a packet
-        packet = parse_bytes(packets_buffer)
-
-        if packet != None:
-            # Chop off a byte so we don't output this packet again
-            packets_buffer = packets_buffer[1:]
+        new_bytes = serial_conn.read(max(1, serial_conn.inWaiting()))
+        for packet in framer.feed(new_bytes):
             yield packet
-        else:
-            # If there's another packet in the buffer
-            # we can safely jump to it for the next iteration
-            if packets_buffer.count(zero_byte) > 1:
-                new_packet = packets_buffer[1:].find(zero_byte) + 1
-                packets_buffer = packets_buffer[new_packet:]
-            # Otherwise, there might be more incoming bytes for the current packet,
-            # so we do a read and try again
-            else:
-                new_bytes = serial_conn.read(max(1, serial_conn.inWaiting()))
-                packets_buffer.extend(new_bytes)
+            if stop_event.is_set():
+                break
 
     serial_conn.timeout = old_timeout
 
 
-
 def blocking_read(serial_conn):
     """
     Read a list of packets from SERIAL_CONN, blocking until a complete packet is received.
@@ -579,20 +760,20 @@ def device_name_to_id(name):
     """
     Turn NAME into its corresponding device ID.
     """
-    for device in DEVICES.values():
-        if device["name"] == name:
-            return device["id"]
-    raise HibikeMessageException("Invalid device name: %s" % name)
+    try:
+        return DEVICE_IDS[name]
+    except KeyError:
+        raise HibikeMessageException("Invalid device name: %s" % name)
 
 
 def device_id_to_name(device_id):
     """
     Turn DEVICE_ID into its corresponding device name.
     """
-    for device in DEVICES.values():
-        if device["id"] == device_id:
-            return device["name"]
-    raise HibikeMessageException("Invalid device id: %d" % id)
+    try:
+        return DEVICE_NAMES[device_id]
+    except KeyError:
+        raise HibikeMessageException("Invalid device id: %d" % device_id)
 
 
 def uid_to_device_name(uid):
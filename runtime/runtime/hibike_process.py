@@ -2,11 +2,15 @@
 The main Hibike process.
 """
 import asyncio
+import bisect
+import functools
 import glob
+import multiprocessing.connection
 import os
 import sys
 import random
 import time
+import zlib
 
 import serial_asyncio
 import aioprocessing
@@ -14,29 +18,87 @@ import aiofiles
 
 
 from . import hibike_message as hm
+from .event_loops import new_event_loop, LoopLagMonitor, LOOP_LAG_REPORT_INTERVAL
+from .hotplug import make_hotplug_watcher
+from .port_cache import PortCache, usb_serial_numbers
+from .serial_recording import SerialRecorder, recording_path, RECEIVED, SENT
 try:
     import hibike_packet
     USING_PACKET_EXTENSION = True
 except ImportError:
     USING_PACKET_EXTENSION = False
 
-__all__ = ["hibike_process"]
+__all__ = ["hibike_process", "hibike_front_end"]
 
-# .04 milliseconds sleep is the same frequency we subscribe to devices at
-BATCH_SLEEP_TIME = .04
-# Time in seconds to wait until reading from a potential sensor
+# The longest, in seconds, a sensor value waits to be sent to StateManager.
+# This is the same as the period we subscribe to devices at.
+BATCH_MAX_LATENCY = .04
+# The shortest time in seconds between batches, however quickly devices report
+BATCH_MIN_INTERVAL = .01
+# Time in seconds to wait for a potential sensor to identify itself
 IDENTIFY_TIMEOUT = 1
+# Time in seconds to wait for an answer to the first ping. Each
+# retry waits twice as long as the last, up to IDENTIFY_MAX_RETRY_DELAY.
+IDENTIFY_RETRY_DELAY = 0.02
+IDENTIFY_MAX_RETRY_DELAY = 0.25
 # Time in seconds to wait between checking for new devices
 # and cleaning up old ones.
 HOTPLUG_POLL_INTERVAL = 1
+# Time in seconds between rescans when the hotplug watcher reports
+# new ports as they appear, so rescans are only a safety net.
+HOTPLUG_RESCAN_INTERVAL = 5
+# File listing the serial ports of virtual devices
+VIRTUAL_DEVICE_CONFIG_FILE = os.path.join(os.path.dirname(__file__), "virtual_devices.txt")
+# File remembering which device was on each port, for faster restarts
+PORT_CACHE_FILE = os.path.join(os.path.dirname(__file__), "port_cache.json")
+# Whether to record everything sent and received on each port, for replaying later
+RECORD_SERIAL_TRAFFIC = False
+RECORDING_DIRECTORY = os.path.join(os.path.dirname(__file__), "recordings")
 # Whether to use profiling or not. On the BBB, profiling adds a significant overhead (~30%).
 USE_PROFILING = False
 # Where to output profiling statistics. By default, this is in Callgrind format
 PROFILING_OUTPUT_FILE = "func_stats"
 # The time period to take measurements over, in seconds
 PROFILING_PERIOD = 60
-PAUSE_QUEUE_SIZE = 10
-RESUME_QUEUE_SIZE = 2
+# Whether to send StateManager only the values that changed since the last batch
+USE_DELTA_BATCHES = True
+# Send every value, changed or not, once every this many batches
+KEYFRAME_INTERVAL = 25
+# Whether to lengthen the subscription delays of devices with congested links
+USE_RATE_CONTROL = True
+# Time in seconds between subscription delay adjustments
+RATE_CONTROL_INTERVAL = 0.5
+# The longest subscription delay, in milliseconds. Smart sensors slow down
+# to this when told their queue is 100% full.
+RATE_CONTROL_MAX_DELAY = 250
+# A link is congested if one read holds this many packets (so bytes piled up
+# while the event loop was busy), if a packet is garbled, or if fewer than
+# RATE_CONTROL_MIN_DELIVERY of the expected packets arrive
+RATE_CONTROL_READ_LIMIT = 5
+RATE_CONTROL_MIN_DELIVERY = 0.5
+# How much to lengthen delays by when a link is congested, and to shorten
+# them by when it isn't
+RATE_CONTROL_BACKOFF = 2
+RATE_CONTROL_RECOVERY = 0.8
+# Time in seconds between checks that devices are still sending
+LIVENESS_CHECK_INTERVAL = 0.02
+# Time in seconds between heartbeat requests from smart sensors
+DEVICE_HEARTBEAT_INTERVAL = 0.2
+# A device is stale once it has been silent for this many times the
+# interval it should be sending at, and for at least LIVENESS_STALE_MIN seconds
+LIVENESS_STALE_FACTOR = 2.5
+LIVENESS_STALE_MIN = 0.1
+# A device is disconnected once it has been silent this long. Smart sensors
+# disable themselves after a second without heartbeat responses anyway.
+LIVENESS_DISCONNECT_TIMEOUT = 1
+# Time in seconds between link metrics reports to StateManager
+METRICS_INTERVAL = 1
+# Upper bounds of the histogram buckets for write echo latency, in
+# milliseconds, and for the number of packets in each read
+ECHO_LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+PACKETS_PER_READ_BUCKETS = (0, 1, 2, 5, 10, 20, 50)
+# Error message payload codes -> names
+ERROR_NAMES = {code: name for name, code in hm.ERROR_CODES.items()}
 
 def scan_for_serial_ports():
     """
@@ -50,7 +112,34 @@ def scan_for_serial_ports():
                glob.glob("/dev/tty.usbmodem*"))
 
 
-async def get_working_serial_ports(event_loop, excludes=()):
+async def read_virtual_devices(event_loop, cache):
+    """
+    Read the ports in `VIRTUAL_DEVICE_CONFIG_FILE`.
+
+    The file is only reread if it changed since it was stored in `cache`,
+    a dictionary that should be passed to every call.
+
+    Returns:
+        A set of port names.
+    """
+    try:
+        stat = os.stat(VIRTUAL_DEVICE_CONFIG_FILE)
+    except OSError:
+        cache.clear()
+        return set()
+    version = (stat.st_mtime_ns, stat.st_size)
+    if cache.get("version") != version:
+        try:
+            async with aiofiles.open(VIRTUAL_DEVICE_CONFIG_FILE, loop=event_loop) as f:
+                contents = await f.read()
+        except IOError:
+            return set()
+        cache["version"] = version
+        cache["ports"] = frozenset(contents.split())
+    return set(cache["ports"])
+
+
+async def get_working_serial_ports(event_loop, excludes=(), virtual_devices_cache=None):
     """
     Scan for open COM ports, except those in `excludes`.
 
@@ -59,43 +148,377 @@ async def get_working_serial_ports(event_loop, excludes=()):
     """
     excludes = set(excludes)
     ports = await event_loop.run_in_executor(None, scan_for_serial_ports)
-    try:
-        virtual_device_config_file = os.path.join(os.path.dirname(__file__), "virtual_devices.txt")
-        async with aiofiles.open(virtual_device_config_file, loop=event_loop) as f:
-            contents = await f.read()
-            ports.update(contents.split())
-    except IOError:
-        pass
+    if virtual_devices_cache is None:
+        virtual_devices_cache = {}
+    ports.update(await read_virtual_devices(event_loop, virtual_devices_cache))
     ports.difference_update(excludes)
     return list(ports)
 
 
-async def hotplug_async(devices, batched_data, error_queue, state_queue, event_loop):
+async def hotplug_async(devices, batched_data, error_queue, state_queue, event_loop, # pylint: disable=too-many-arguments,too-many-locals
+                        sensor_table=None, watcher=None, identify_stats=None, port_cache=None,
+                        link_metrics=None, recording_dir=None, port_filter=None,
+                        batcher=None):
     """
     Scan for new devices on serial ports and automatically spin them up.
+
+    Ports are rescanned whenever `watcher` (by default, one from
+    `make_hotplug_watcher`) sees a change, and at least every
+    `HOTPLUG_RESCAN_INTERVAL` seconds. If `identify_stats` is given,
+    identification times are recorded in it. If `port_cache` is given,
+    devices found on a port before are registered without waiting to
+    identify them. If `link_metrics` is given, each port's traffic is
+    counted in it, and if `recording_dir` is given, recorded there. If
+    `port_filter` is given, only ports it returns true for are opened.
+    Every device shares one `InstructionScheduler`, and tells `batcher`,
+    if given, when its values arrive.
     """
     pending = set()
-    def protocol_factory():
+    virtual_devices_cache = {}
+    scheduler = InstructionScheduler(event_loop)
+    if watcher is None:
+        watcher = make_hotplug_watcher(event_loop, VIRTUAL_DEVICE_CONFIG_FILE)
+    def protocol_factory(usb_serial=None):
         """
         Create a `SmartSensorProtocol` with necessary parameters filled in.
         """
-        return SmartSensorProtocol(devices, batched_data, error_queue,
-                                   state_queue, event_loop, pending)
+        return SmartSensorProtocol(devices, batched_data, error_queue, state_queue,
+                                   event_loop, pending, sensor_table, identify_stats,
+                                   port_cache, usb_serial, link_metrics, recording_dir,
+                                   scheduler, batcher)
 
-    while True:
-        await asyncio.sleep(HOTPLUG_POLL_INTERVAL, loop=event_loop)
-        port_names = set([dev.transport.serial.name for dev in devices.values()\
-                          if dev.transport is not None and dev.transport.serial is not None])
-        port_names.update(pending)
-        new_serials = await get_working_serial_ports(event_loop, port_names)
-        for port in new_serials:
-            try:
-                pending.add(port)
-                await serial_asyncio.create_serial_connection(event_loop, protocol_factory, port,
-                                                              baudrate=115200)
-            except serial_asyncio.serial.SerialException:
-                pass
-        await remove_disconnected_devices(error_queue, devices, state_queue, event_loop)
+    try:
+        while True:
+            port_names = set([dev.transport.serial.name for dev in devices.values()\
+                              if dev.transport is not None and dev.transport.serial is not None])
+            port_names.update(pending)
+            new_serials = await get_working_serial_ports(event_loop, port_names,
+                                                         virtual_devices_cache)
+            if port_filter is not None:
+                new_serials = [port for port in new_serials if port_filter(port)]
+            usb_serials = {}
+            if new_serials and port_cache is not None:
+                usb_serials = await event_loop.run_in_executor(None, usb_serial_numbers)
+            for port in new_serials:
+                try:
+                    pending.add(port)
+                    factory = functools.partial(protocol_factory, usb_serials.get(port))
+                    await serial_asyncio.create_serial_connection(event_loop, factory,
+                                                                  port, baudrate=115200)
+                except serial_asyncio.serial.SerialException:
+                    pending.discard(port)
+            await remove_disconnected_devices(error_queue, devices, state_queue, event_loop,
+                                              sensor_table, batched_data, batcher)
+            # Disconnects are confirmed over two passes, so don't wait long for the second.
+            if watcher.sees_events and error_queue.empty():
+                timeout = HOTPLUG_RESCAN_INTERVAL
+            else:
+                timeout = HOTPLUG_POLL_INTERVAL
+            await watcher.wait(timeout)
+    finally:
+        watcher.close()
+
+
+class CoalescedWriter:
+    """
+    Gather every frame written to a transport during one iteration of the
+    event loop and flush them with a single write.
+
+    Each write to a USB serial port has a fixed overhead, so bursts of small
+    frames (pings, subscriptions, writes) are much cheaper sent together.
+
+    :param event_loop: The event loop
+    """
+    __slots__ = ("transport", "metrics", "recorder", "_event_loop", "_buf", "_frames",
+                 "frames_merged", "flushes")
+
+    def __init__(self, event_loop):
+        self.transport = None
+        # The `LinkMetrics` to count sent frames in, and the `SerialRecorder`
+        # to record writes with, if any
+        self.metrics = None
+        self.recorder = None
+        self._event_loop = event_loop
+        self._buf = bytearray()
+        self._frames = 0
+        # Number of frames that went out as part of another frame's write
+        self.frames_merged = 0
+        self.flushes = 0
+
+    def write(self, data):
+        """
+        Queue DATA to be written at the end of this loop iteration.
+        """
+        if not self._buf:
+            self._event_loop.call_soon(self.flush)
+        self._buf.extend(data)
+        self._frames += 1
+        if self.metrics is not None:
+            self.metrics.tx_packets += 1
+            self.metrics.tx_bytes += len(data)
+
+    def flush(self):
+        """
+        Write out all queued frames.
+        """
+        if not self._buf:
+            return
+        # The transport may hold on to the buffer, so hand it off and start a new one
+        buf, self._buf = self._buf, bytearray()
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(buf)
+            if self.recorder is not None:
+                self.recorder.record(SENT, buf)
+        self.frames_merged += self._frames - 1
+        self.flushes += 1
+        self._frames = 0
+
+
+class IdentifyStats:
+    """
+    How long identifying devices has taken on each serial port.
+    """
+    __slots__ = ("ports",)
+
+    def __init__(self):
+        # Port name -> [attempts, devices found, pings sent, total time, fastest, slowest, last]
+        self.ports = {}
+
+    def record(self, port, elapsed, pings, identified):
+        """
+        Record one attempt to identify a device on PORT.
+
+        :param float elapsed: Seconds from the first ping until the device
+        answered, or until we gave up
+        :param int pings: Number of pings sent
+        :param bool identified: Whether a device answered
+        """
+        stats = self.ports.setdefault(port, [0, 0, 0, 0.0, None, None, None])
+        stats[0] += 1
+        stats[2] += pings
+        if identified:
+            stats[1] += 1
+            stats[3] += elapsed
+            stats[4] = elapsed if stats[4] is None else min(stats[4], elapsed)
+            stats[5] = elapsed if stats[5] is None else max(stats[5], elapsed)
+            stats[6] = elapsed
+
+    def summary(self):
+        """
+        Returns:
+            A mapping from port names to dictionaries of statistics. Times
+            only count attempts where a device was found.
+        """
+        return {port: {"attempts": attempts,
+                       "identified": identified,
+                       "pings": pings,
+                       "mean_time": total / identified if identified else None,
+                       "min_time": fastest,
+                       "max_time": slowest,
+                       "last_time": last}
+                for port, (attempts, identified, pings, total, fastest, slowest, last)
+                in self.ports.items()}
+
+
+class Histogram:
+    """
+    Counts of samples in fixed buckets, cheap enough to record every packet.
+
+    :param bounds: Increasing upper bounds of the buckets. Larger samples
+    are counted in one more bucket at the end.
+    """
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def record(self, value):
+        """
+        Add one sample.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        An upper bound on the sample that FRACTION of the samples are at or
+        below, or None if there are no samples.
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Returns:
+            A dictionary of the count, mean, median, 99th percentile and
+            maximum of the samples.
+        """
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(0.5),
+                "p99": self.percentile(0.99),
+                "max": self.max}
+
+
+class LinkMetrics:
+    """
+    Counters for the traffic over one serial link.
+
+    Checksum errors and resyncs are counted by the link's packet framer;
+    `attach` keeps the counts of earlier framers when the port reconnects.
+    """
+    __slots__ = ("uid", "rx_packets", "rx_bytes", "tx_packets", "tx_bytes", "device_errors",
+                 "packets_per_read", "echo_latency", "_framer", "_checksum_errors", "_resyncs")
+
+    def __init__(self):
+        # The UID of the device last identified on the link
+        self.uid = None
+        self.rx_packets = 0
+        self.rx_bytes = 0
+        self.tx_packets = 0
+        self.tx_bytes = 0
+        # Error names from `hm.ERROR_CODES` -> Error messages received
+        self.device_errors = {}
+        # How many packets each read from the port held
+        self.packets_per_read = Histogram(PACKETS_PER_READ_BUCKETS)
+        # Milliseconds from sending a `DeviceWrite` to receiving the written params
+        self.echo_latency = Histogram(ECHO_LATENCY_BUCKETS)
+        self._framer = None
+        self._checksum_errors = 0
+        self._resyncs = 0
+
+    def attach(self, framer):
+        """
+        Count the parse errors of FRAMER from now on.
+        """
+        self._checksum_errors = self.checksum_errors
+        self._resyncs = self.resyncs
+        self._framer = framer
+
+    @property
+    def checksum_errors(self):
+        """ Frames dropped for a bad checksum. """
+        return self._checksum_errors + getattr(self._framer, "checksum_errors", 0)
+
+    @property
+    def resyncs(self):
+        """ Times garbage or a truncated frame was skipped. """
+        return self._resyncs + getattr(self._framer, "resyncs", 0)
+
+    def summary(self):
+        """
+        Returns:
+            A dictionary of every counter and histogram summary.
+        """
+        return {"uid": self.uid,
+                "rx_packets": self.rx_packets,
+                "rx_bytes": self.rx_bytes,
+                "tx_packets": self.tx_packets,
+                "tx_bytes": self.tx_bytes,
+                "checksum_errors": self.checksum_errors,
+                "resyncs": self.resyncs,
+                "device_errors": dict(self.device_errors),
+                "packets_per_read": self.packets_per_read.summary(),
+                "echo_latency": self.echo_latency.summary()}
+
+
+class LinkMetricsRegistry:
+    """
+    The `LinkMetrics` of every serial port Hibike has opened.
+
+    :param IdentifyStats identify_stats: Identification times to include
+    in reports, if any
+    """
+    __slots__ = ("ports", "identify_stats", "_last_totals")
+
+    def __init__(self, identify_stats=None):
+        self.ports = {}
+        self.identify_stats = identify_stats
+        # Port name -> (time, rx packets, rx bytes, tx packets, tx bytes) at the last report
+        self._last_totals = {}
+
+    def for_port(self, port):
+        """
+        The metrics for PORT, which are kept across reconnects.
+        """
+        metrics = self.ports.get(port)
+        if metrics is None:
+            metrics = self.ports[port] = LinkMetrics()
+        return metrics
+
+    def report(self, now):
+        """
+        Summarize every port, with packet and byte rates per second since
+        the last report.
+
+        :param float now: The current time, by `time.monotonic`
+        Returns:
+            A mapping from port names to summaries.
+        """
+        identify = self.identify_stats.summary() if self.identify_stats is not None else {}
+        report = {}
+        for port, metrics in self.ports.items():
+            summary = metrics.summary()
+            totals = (now, summary["rx_packets"], summary["rx_bytes"],
+                      summary["tx_packets"], summary["tx_bytes"])
+            last = self._last_totals.get(port)
+            self._last_totals[port] = totals
+            for name, index in (("rx_packet_rate", 1), ("rx_byte_rate", 2),
+                                ("tx_packet_rate", 3), ("tx_byte_rate", 4)):
+                if last is None or now <= last[0]:
+                    summary[name] = None
+                else:
+                    summary[name] = (totals[index] - last[index]) / (now - last[0])
+            summary["identify"] = identify.get(port)
+            report[port] = summary
+        return report
+
+
+class InstructionScheduler:
+    """
+    Carry out instructions for devices, such as subscribing or writing params.
+
+    Instructions for every device wait in one queue and are carried out
+    together once per iteration of the event loop, instead of each device
+    waking up its own task for each instruction.
+
+    :param event_loop: The event loop
+    """
+    __slots__ = ("_event_loop", "_pending")
+
+    def __init__(self, event_loop):
+        self._event_loop = event_loop
+        self._pending = []
+
+    def schedule(self, device, instruction, args):
+        """
+        Have DEVICE carry out INSTRUCTION with ARGS soon.
+        """
+        if not self._pending:
+            self._event_loop.call_soon(self.run)
+        self._pending.append((device, instruction, args))
+
+    def run(self):
+        """
+        Carry out every scheduled instruction.
+        """
+        pending, self._pending = self._pending, []
+        for device, instruction, args in pending:
+            if device.transport is not None and not device.transport.is_closing():
+                device.execute(instruction, args)
 
 
 class SmartSensorProtocol(asyncio.Protocol):
@@ -109,105 +532,375 @@ class SmartSensorProtocol(asyncio.Protocol):
     :param event_loop: The event loop
     :param set pending: Set of serial connections that may or may not
     have devices on them.
+    :param SensorTable sensor_table: Shared memory for sensor values, if any
+    :param IdentifyStats identify_stats: Where to record how long identification took, if anywhere
+    :param PortCache port_cache: The devices last seen on each port, if known
+    :param str usb_serial: The serial number of the USB device behind this port, if known
+    :param LinkMetricsRegistry link_metrics: Where to count traffic, if anywhere
+    :param str recording_dir: Where to record traffic, if anywhere
+    :param InstructionScheduler scheduler: What carries out instructions for
+    this device, usually shared with every other device. By default, the
+    device gets its own.
+    :param DataBatcher batcher: What to tell when new values arrive, if anything
     """
-    PACKET_BOUNDARY = bytes([0])
-    __slots__ = ("uid", "write_queue", "batched_data", "read_queue", "error_queue",
-                 "state_queue", "instance_id", "transport", "_ready", "serial_buf")
-    # pylint: disable=too-many-arguments
-    def __init__(self, devices, batched_data, error_queue, state_queue, event_loop, pending: set):
+    __slots__ = ("uid", "scheduler", "pending_writes", "subscription", "read_delays",
+                 "rate_scale", "data_packets", "read_peak", "parse_errors", "batched_data",
+                 "batcher", "error_queue", "state_queue", "sensor_table", "identify_stats",
+                 "port_cache", "usb_serial", "instance_id", "last_received", "sends_heartbeats",
+                 "stale", "link_metrics", "metrics", "recording_dir", "recorder", "transport",
+                 "writer", "_event_loop", "_write_times", "_next_reads", "_read_timer", "_ready",
+                 "_identified", "serial_buf")
+    # pylint: disable=too-many-arguments,too-many-locals
+    def __init__(self, devices, batched_data, error_queue, state_queue, event_loop, pending: set,
+                 sensor_table=None, identify_stats=None, port_cache=None, usb_serial=None,
+                 link_metrics=None, recording_dir=None, scheduler=None, batcher=None):
         # We haven't found out what our UID is yet
         self.uid = None
 
-        self.write_queue = asyncio.Queue(loop=event_loop)
+        if scheduler is None:
+            scheduler = InstructionScheduler(event_loop)
+        self.scheduler = scheduler
+        # Param values written by StateManager that have not been sent yet.
+        # A newer value for a param replaces the older one.
+        self.pending_writes = {}
+        # The (params, delay) last subscribed to by StateManager
+        self.subscription = ([], 0)
+        # Params that are read on their own schedule instead of being
+        # subscribed to, mapped to the delay between reads in milliseconds
+        self.read_delays = {}
+        # How much rate control has lengthened delays by, and the link
+        # health it is based on. `data_packets` is None until the first
+        # full interval after subscribing.
+        self.rate_scale = 1
+        self.data_packets = None
+        self.read_peak = 0
+        self.parse_errors = 0
         self.batched_data = batched_data
-        self.read_queue = asyncio.Queue(loop=event_loop)
+        self.batcher = batcher
         self.error_queue = error_queue
         self.state_queue = state_queue
+        self.sensor_table = sensor_table
+        self.identify_stats = identify_stats
+        self.port_cache = port_cache
+        self.usb_serial = usb_serial
         self.instance_id = random.getrandbits(128)
+        # When anything last arrived from the device, by `time.monotonic`,
+        # and whether it sends heartbeats that should keep arriving even
+        # when it is not subscribed
+        self.last_received = time.monotonic()
+        self.sends_heartbeats = False
+        self.stale = False
+        # Replaced by the metrics of our port once it is known
+        self.link_metrics = link_metrics
+        self.metrics = LinkMetrics()
+        self.recording_dir = recording_dir
+        self.recorder = None
 
         self.transport = None
+        self.writer = CoalescedWriter(event_loop)
+        self._event_loop = event_loop
+        # Params written but not yet reported back -> when they were first written
+        self._write_times = {}
+        # Params in `read_delays` -> when they are next due to be read, and
+        # the timer for the next read
+        self._next_reads = {}
+        self._read_timer = None
         self._ready = asyncio.Event(loop=event_loop)
+        self._identified = asyncio.Event(loop=event_loop)
         if USING_PACKET_EXTENSION:
             # pylint: disable=no-member
             self.serial_buf = hibike_packet.RingBuffer()
         else:
-            self.serial_buf = bytearray()
+            self.serial_buf = hm.PacketFramer()
 
         event_loop.create_task(self.register_sensor(event_loop, devices, pending))
-        event_loop.create_task(self.send_messages())
-        event_loop.create_task(self.recv_messages())
 
     async def register_sensor(self, event_loop, devices, pending):
         """
         Try to get our UID from the sensor and register it with `hibike_process`.
+
+        Pings are retried with exponential backoff until the sensor answers,
+        so only silent ports wait the full `IDENTIFY_TIMEOUT`.
+
+        If the port cache knows which device was on this port last time, that
+        device is registered and resubscribed straight away, and the answer
+        to the pings only confirms it.
         """
         await self._ready.wait()
-        hm.send(self.transport, hm.make_ping())
-        await asyncio.sleep(IDENTIFY_TIMEOUT, loop=event_loop)
-        if self.uid is None:
+        port = self.transport.serial.name
+        cached = None
+        if self.port_cache is not None:
+            cached = self.port_cache.lookup(port, self.usb_serial)
+        if cached is not None:
+            cached_uid, delay, params = cached
+            self.uid = cached_uid
+            self.metrics.uid = cached_uid
+            devices[cached_uid] = self
+            if self.sensor_table is not None:
+                self.sensor_table.add_device(cached_uid)
+            forget_values(cached_uid, self.batched_data, self.batcher)
+            self.state_queue.put_nowait(("device_subscribed", [cached_uid, delay, params]))
+            hm.send(self.writer, hm.make_subscription_request(hm.uid_to_device_id(cached_uid),
+                                                              params, delay))
+        start = time.monotonic()
+        deadline = start + IDENTIFY_TIMEOUT
+        retry_delay = IDENTIFY_RETRY_DELAY
+        pings = 0
+        while not self._identified.is_set() and not self.transport.is_closing():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            hm.send(self.writer, hm.encode_cached(hm.make_ping))
+            pings += 1
+            try:
+                await asyncio.wait_for(self._identified.wait(), min(retry_delay, remaining),
+                                       loop=event_loop)
+            except asyncio.TimeoutError:
+                retry_delay = min(retry_delay * 2, IDENTIFY_MAX_RETRY_DELAY)
+        identified = self._identified.is_set()
+        if self.identify_stats is not None:
+            self.identify_stats.record(port, time.monotonic() - start, pings, identified)
+        if cached is not None and (not identified or self.uid != cached_uid):
+            # Someone swapped devices, or the port went quiet; don't trust the cache again
+            self.port_cache.forget(port)
+            # Unless the liveness monitor has already given up on it
+            if devices.get(cached_uid) is self:
+                del devices[cached_uid]
+                if self.sensor_table is not None:
+                    self.sensor_table.remove_device(cached_uid)
+                forget_values(cached_uid, self.batched_data, self.batcher)
+                self.state_queue.put_nowait(("device_disconnected", [cached_uid]))
+            cached = None
+        if not identified:
+            self.uid = None
             self.quit()
-        else:
-            hm.send(self.transport, hm.make_ping())
-            hm.send(self.transport,
-                    hm.make_subscription_request(hm.uid_to_device_id(self.uid), [], 0))
+        elif cached is None:
+            hm.send(self.writer, hm.encode_cached(hm.make_ping))
+            hm.send(self.writer, hm.encode_cached(hm.make_subscription_request,
+                                                  hm.uid_to_device_id(self.uid), (), 0))
             devices[self.uid] = self
-        pending.remove(self.transport.serial.name)
+        pending.discard(port)
 
-    async def send_messages(self):
+    def queue_instruction(self, instruction, args):
         """
-        Send messages in the queue to the sensor.
+        Have the scheduler carry out INSTRUCTION with ARGS soon.
         """
-        await self._ready.wait()
-        while not self.transport.is_closing():
-            instruction, args = await self.write_queue.get()
-            if instruction == "ping":
-                hm.send(self.transport, hm.make_ping())
-            elif instruction == "subscribe":
-                uid, delay, params = args
-                hm.send(self.transport,
-                        hm.make_subscription_request(hm.uid_to_device_id(uid),
-                                                     params, delay))
-            elif instruction == "read":
-                uid, params = args
-                hm.send(self.transport, hm.make_device_read(hm.uid_to_device_id(uid), params))
-            elif instruction == "write":
-                uid, params_and_values = args
-                hm.send(self.transport, hm.make_device_write(hm.uid_to_device_id(uid),
-                                                             params_and_values))
-            elif instruction == "disable":
-                hm.send(self.transport, hm.make_disable())
-            elif instruction == "heartResp":
-                uid = args[0]
-                hm.send(self.transport, hm.make_heartbeat_response(self.read_queue.qsize()))
+        self.scheduler.schedule(self, instruction, args)
 
-    async def recv_messages(self):
+    def execute(self, instruction, args):
         """
-        Process received messages.
+        Carry out an instruction now; see `queue_instruction`.
         """
-        await self._ready.wait()
-        while not self.transport.is_closing():
-            if self.read_queue.qsize() >= PAUSE_QUEUE_SIZE:
-                self.transport.pause_reading()
-            if self.read_queue.qsize() <= RESUME_QUEUE_SIZE:
-                self.transport.resume_reading()
-            packet = await self.read_queue.get()
+        if instruction == "ping":
+            hm.send(self.writer, hm.encode_cached(hm.make_ping))
+        elif instruction == "subscribe":
+            uid, delay, params = args[:3]
+            self.subscription = (params, delay)
+            self.data_packets = None
+            hm.send(self.writer,
+                    hm.make_subscription_request(hm.uid_to_device_id(uid),
+                                                 params, self.subscription_delay()))
+            read_delays = args[3] if len(args) > 3 else {}
+            if read_delays != self.read_delays:
+                self.read_delays = read_delays
+                self.read_params()
+        elif instruction == "read":
+            uid, params = args
+            hm.send(self.writer, hm.make_device_read(hm.uid_to_device_id(uid), params))
+        elif instruction == "write":
+            uid = args[0]
+            params_and_values = list(self.pending_writes.items())
+            self.pending_writes.clear()
+            if params_and_values:
+                hm.send(self.writer, hm.make_device_write(hm.uid_to_device_id(uid),
+                                                          params_and_values))
+                now = time.monotonic()
+                for param, _ in params_and_values:
+                    self._write_times.setdefault(param, now)
+        elif instruction == "disable":
+            hm.send(self.writer, hm.encode_cached(hm.make_disable))
+        elif instruction == "heartResp":
+            # Smart sensors derive their delay from how full we say our queue is,
+            # clamped to 40-250 ms, so only report it while rate control is
+            # slowing the device down; otherwise a 10 ms or 500 ms subscription
+            # would drift into that range.
+            queue_fullness = None
+            if self.rate_scale > 1 and self.subscription_delay():
+                queue_fullness = min(100, round(100 * self.subscription_delay()
+                                                / RATE_CONTROL_MAX_DELAY))
+            hm.send(self.writer, hm.encode_cached(hm.make_heartbeat_response, 0, queue_fullness))
+
+    def handle_packets(self, packets):
+        """
+        Process the packets from one read, as soon as they arrive.
+        """
+        self.read_peak = max(self.read_peak, len(packets))
+        self.metrics.packets_per_read.record(len(packets))
+        self.metrics.rx_packets += len(packets)
+        for packet in packets:
             message_type = packet.get_message_id()
-            if message_type == hm.MESSAGE_TYPES["SubscriptionResponse"]:
-                params, delay, uid = hm.parse_subscription_response(packet)
-                self.uid = uid
-                await self.state_queue.coro_put(("device_subscribed", [uid, delay, params]))
-            elif message_type == hm.MESSAGE_TYPES["DeviceData"]:
-                # This is kind of a hack, but it allows us to use `recv_messages` for
+            if message_type == hm.MESSAGE_TYPES["DeviceData"]:
+                # This is kind of a hack, but it allows us to use `handle_packets` for
                 # detecting new smart sensors as well as reading from known ones.
                 if self.uid is not None:
+                    if self.data_packets is not None:
+                        self.data_packets += 1
                     params_and_values = hm.parse_device_data(packet, hm.uid_to_device_id(self.uid))
-                    self.batched_data[uid] = params_and_values
+                    if self._write_times:
+                        self.record_echoes(params_and_values)
+                    if self.sensor_table is not None:
+                        self.sensor_table.update(self.uid, params_and_values)
+                    if self.read_delays and self.uid in self.batched_data:
+                        # Subscriptions and reads return different params, so keep both
+                        merged = dict(self.batched_data[self.uid])
+                        merged.update(params_and_values)
+                        params_and_values = list(merged.items())
+                    self.batched_data[self.uid] = params_and_values
+                    if self.batcher is not None:
+                        self.batcher.report(self.uid)
             elif message_type == hm.MESSAGE_TYPES["HeartBeatRequest"]:
+                self.sends_heartbeats = True
                 if self.uid is not None:
-                    self.write_queue.put_nowait(("heartResp", [self.uid]))
+                    self.queue_instruction("heartResp", [self.uid])
+            elif message_type == hm.MESSAGE_TYPES["SubscriptionResponse"]:
+                params, delay, uid = hm.parse_subscription_response(packet)
+                self.uid = uid
+                self.metrics.uid = uid
+                self._identified.set()
+                if delay and self.port_cache is not None:
+                    self.port_cache.store(self.transport.serial.name, self.usb_serial,
+                                          uid, delay, params)
+                if self.sensor_table is not None:
+                    self.sensor_table.add_device(uid)
+                # Values of params that are no longer subscribed to would never change again
+                forget_values(uid, self.batched_data, self.batcher)
+                self.state_queue.put_nowait(("device_subscribed", [uid, delay, params]))
+            elif message_type == hm.MESSAGE_TYPES["Error"]:
+                payload = packet.get_payload()
+                name = ERROR_NAMES.get(payload[0], "GenericError") if payload else "GenericError"
+                self.metrics.device_errors[name] = self.metrics.device_errors.get(name, 0) + 1
+
+    def record_echoes(self, params_and_values):
+        """
+        Record how long written params took to be reported back.
+        """
+        now = time.monotonic()
+        for param, _ in params_and_values:
+            written = self._write_times.pop(param, None)
+            if written is not None:
+                self.metrics.echo_latency.record((now - written) * 1000)
+
+    def read_params(self):
+        """
+        Send `DeviceRead`s for the params in `read_delays` that are due, and
+        set a timer to come back when the next ones are.
+
+        Params that are due at the same time are read together.
+        """
+        if self._read_timer is not None:
+            self._read_timer.cancel()
+            self._read_timer = None
+        if self.transport is None or self.transport.is_closing():
+            return
+        for param in self._next_reads.keys() - self.read_delays.keys():
+            del self._next_reads[param]
+        now = self._event_loop.time()
+        due = []
+        for param, delay in self.read_delays.items():
+            next_read = self._next_reads.get(param, now)
+            if next_read <= now:
+                due.append(param)
+                # Skip reads that were missed instead of sending a burst
+                self._next_reads[param] = max(next_read + delay * self.rate_scale / 1000, now)
+        if due and self.uid is not None:
+            hm.send(self.writer, hm.make_device_read(hm.uid_to_device_id(self.uid), due))
+        if self.read_delays:
+            self._read_timer = self._event_loop.call_at(
+                min(self._next_reads[param] for param in self.read_delays), self.read_params)
+
+    def subscription_delay(self):
+        """
+        The subscription delay StateManager asked for, lengthened by rate control.
+        """
+        delay = self.subscription[1]
+        if not delay:
+            return 0
+        return min(round(delay * self.rate_scale), max(delay, RATE_CONTROL_MAX_DELAY))
+
+    def adapt_rate(self, elapsed):
+        """
+        Lengthen the subscription delay if the link has been congested for
+        the last ELAPSED seconds, or shorten it back towards the requested
+        delay if not.
+        """
+        delivered, self.data_packets = self.data_packets, 0
+        read_peak, self.read_peak = self.read_peak, 0
+        parse_errors = getattr(self.serial_buf, "resyncs", 0) + \
+            getattr(self.serial_buf, "checksum_errors", 0)
+        new_errors, self.parse_errors = parse_errors - self.parse_errors, parse_errors
+        params, requested_delay = self.subscription
+        if not params or not requested_delay or self.uid is None or delivered is None:
+            return
+        delay = self.subscription_delay()
+        expected = elapsed * 1000 / delay
+        congested = (read_peak >= RATE_CONTROL_READ_LIMIT or new_errors > 0
+                     or delivered < expected * RATE_CONTROL_MIN_DELIVERY)
+        max_scale = max(1, RATE_CONTROL_MAX_DELAY / requested_delay)
+        if congested:
+            self.rate_scale = min(self.rate_scale * RATE_CONTROL_BACKOFF, max_scale)
+        else:
+            self.rate_scale = max(self.rate_scale * RATE_CONTROL_RECOVERY, 1)
+        if self.subscription_delay() != delay:
+            hm.send(self.writer, hm.make_subscription_request(hm.uid_to_device_id(self.uid),
+                                                              params, self.subscription_delay()))
+
+    def stale_timeout(self):
+        """
+        How many seconds the device may be silent for before it is stale,
+        or None if it is not expected to send anything on its own.
+        """
+        interval = self.subscription_delay() / 1000
+        if self.sends_heartbeats:
+            interval = min(interval, DEVICE_HEARTBEAT_INTERVAL) if interval \
+                else DEVICE_HEARTBEAT_INTERVAL
+        if not interval:
+            return None
+        return max(interval * LIVENESS_STALE_FACTOR, LIVENESS_STALE_MIN)
+
+    def queue_write(self, params_and_values):
+        """
+        Add param values to the pending writes, to be sent in one `DeviceWrite`.
+
+        Only one "write" instruction is queued at a time, so however often
+        params are written, the latest values go out on the next send.
+        Raises `TypeError` for params the device doesn't have.
+        """
+        device_params = hm.PARAM_MAP[hm.uid_to_device_id(self.uid)]
+        params_and_values = dict(params_and_values)
+        for param in params_and_values:
+            if param not in device_params:
+                # Not a `KeyError`, which would be reported as a missing device
+                raise TypeError("Invalid param: {}".format(param))
+        if not self.pending_writes:
+            self.queue_instruction("write", [self.uid])
+        self.pending_writes.update(params_and_values)
 
     def connection_made(self, transport):
         self.transport = transport
+        self.writer.transport = transport
+        if self.link_metrics is not None and transport.serial is not None:
+            self.metrics = self.link_metrics.for_port(transport.serial.name)
+        self.metrics.attach(self.serial_buf)
+        self.writer.metrics = self.metrics
+        if self.recording_dir is not None and transport.serial is not None:
+            try:
+                os.makedirs(self.recording_dir, exist_ok=True)
+                self.recorder = SerialRecorder(recording_path(self.recording_dir,
+                                                              transport.serial.name),
+                                               transport.serial.name)
+            except OSError:
+                pass
+            self.writer.recorder = self.recorder
         self._ready.set()
 
     def quit(self):
@@ -218,31 +911,33 @@ class SmartSensorProtocol(asyncio.Protocol):
 
     if USING_PACKET_EXTENSION:
         def data_received(self, data):
+            self.last_received = time.monotonic()
+            self.metrics.rx_bytes += len(data)
+            if self.recorder is not None:
+                self.recorder.record(RECEIVED, data)
             self.serial_buf.extend(data)
-            # pylint: disable=no-member
-            maybe_packet = hibike_packet.process_buffer(self.serial_buf)
-            if maybe_packet is not None:
+            packets = []
+            while True:
+                # pylint: disable=no-member
+                maybe_packet = hibike_packet.process_buffer(self.serial_buf)
+                if maybe_packet is None:
+                    break
                 message_id, payload = maybe_packet
-                message = hm.HibikeMessage(message_id, payload)
-                self.read_queue.put_nowait(message)
+                packets.append(hm.HibikeMessage(message_id, payload))
+            self.handle_packets(packets)
     else:
         def data_received(self, data):
-            self.serial_buf.extend(data)
-            zero_loc = self.serial_buf.find(self.PACKET_BOUNDARY)
-            if zero_loc != -1:
-                self.serial_buf = self.serial_buf[zero_loc:]
-                packet = hm.parse_bytes(self.serial_buf)
-                if packet != None:
-                    # Chop off a byte so we don't output this packet again
-                    self.serial_buf = self.serial_buf[1:]
-                    self.read_queue.put_nowait(packet)
-                elif self.serial_buf.count(self.PACKET_BOUNDARY) > 1:
-                    # If there's another packet in the buffer
-                    # we can safely jump to it for the next iteration
-                    new_packet = self.serial_buf[1:].find(self.PACKET_BOUNDARY) + 1
-                    self.serial_buf = self.serial_buf[new_packet:]
+            self.last_received = time.monotonic()
+            self.metrics.rx_bytes += len(data)
+            if self.recorder is not None:
+                self.recorder.record(RECEIVED, data)
+            self.handle_packets(self.serial_buf.feed(data))
 
     def connection_lost(self, exc):
+        if self._read_timer is not None:
+            self._read_timer.cancel()
+        if self.recorder is not None:
+            self.recorder.close()
         if self.uid is not None:
             error = Disconnect(uid=self.uid, instance_id=self.instance_id, accessed=False)
             self.error_queue.put_nowait(error)
@@ -258,7 +953,8 @@ class Disconnect:
         self.accessed = accessed
 
 
-async def remove_disconnected_devices(error_queue, devices, state_queue, event_loop):
+async def remove_disconnected_devices(error_queue, devices, state_queue, event_loop, # pylint: disable=too-many-arguments
+                                      sensor_table=None, batched_data=None, batcher=None):
     """
     Clean up any disconnected devices in `error_queue`.
     """
@@ -266,7 +962,10 @@ async def remove_disconnected_devices(error_queue, devices, state_queue, event_l
     while True:
         try:
             error = error_queue.get_nowait()
-            pack = devices[error.uid]
+            pack = devices.get(error.uid)
+            if pack is None:
+                # Already removed, e.g. because it turned out not to be the cached device
+                continue
             if not error.accessed:
                 # Wait until the next cycle to make sure it's disconnected
                 error.accessed = True
@@ -277,20 +976,234 @@ async def remove_disconnected_devices(error_queue, devices, state_queue, event_l
                 continue
             uid = error.uid
             del devices[uid]
-            await state_queue.coro_put(("device_disconnected", [uid]), loop=event_loop)
+            if sensor_table is not None:
+                sensor_table.remove_device(uid)
+            if batched_data is not None:
+                forget_values(uid, batched_data, batcher)
+            state_queue.put_nowait(("device_disconnected", [uid]))
         except asyncio.QueueEmpty:
             for err in next_time_errors:
                 error_queue.put_nowait(err)
             return
 
 
-async def batch_data(sensor_values, state_queue, event_loop):
+def forget_values(uid, batched_data, batcher):
     """
-    Periodically send sensor values to `StateManager`.
+    Drop the latest values of the device at UID, and what was last sent of
+    them, so that none outlive its subscription.
     """
+    batched_data.pop(uid, None)
+    if batcher is not None:
+        batcher.forget(uid)
+
+
+def diff_sensor_values(sensor_values, last_sent):
+    """
+    Find the values in `sensor_values` that differ from `last_sent`.
+
+    `last_sent` maps UIDs to dictionaries of the values last sent to
+    `StateManager`, and is updated in place.
+
+    Returns:
+        A mapping from UIDs to lists of changed (param, value) tuples.
+    """
+    delta = {}
+    for uid, params_and_values in sensor_values.items():
+        sent = last_sent.setdefault(uid, {})
+        changed = [(param, value) for param, value in params_and_values
+                   if param not in sent or sent[param] != value]
+        if changed:
+            delta[uid] = changed
+            sent.update(changed)
+    for uid in last_sent.keys() - sensor_values.keys():
+        del last_sent[uid]
+    return delta
+
+
+class DataBatcher:
+    """
+    Send sensor values to `StateManager` in batches.
+
+    A batch is sent as soon as every device that is subscribed (and not
+    stale) has reported since the last one, or once the oldest unsent value
+    has waited `BATCH_MAX_LATENCY` seconds, but no more often than every
+    `BATCH_MIN_INTERVAL` seconds. Each batch is sent along with the
+    `time.time` at which each device's values arrived.
+
+    Batches are put on the queue synchronously, so they reach `StateManager`
+    in order; otherwise an old delta could overwrite newer values.
+
+    With `USE_DELTA_BATCHES`, only changed values are sent, except for
+    a full keyframe every `KEYFRAME_INTERVAL` batches.
+
+    :param dict sensor_values: UIDs -> latest lists of (param, value), kept
+    up to date by the devices
+    :param dict devices: UIDs -> `SmartSensorProtocol`s
+    :param state_queue: The queue to `StateManager`
+    :param event_loop: The event loop
+    """
+    __slots__ = ("sensor_values", "devices", "state_queue", "_event_loop", "_received",
+                 "_unsent", "_last_sent", "_batch_count", "_last_flush", "_timer")
+
+    def __init__(self, sensor_values, devices, state_queue, event_loop):
+        self.sensor_values = sensor_values
+        self.devices = devices
+        self.state_queue = state_queue
+        self._event_loop = event_loop
+        # UIDs -> the wall-clock time their latest values arrived, and the
+        # UIDs whose values arrived since the last batch
+        self._received = {}
+        self._unsent = set()
+        self._last_sent = {}
+        self._batch_count = 0
+        self._last_flush = float("-inf")
+        self._timer = None
+
+    def report(self, uid):
+        """
+        Note that new values from the device at UID are in `sensor_values`.
+        """
+        now = self._event_loop.time()
+        self._received[uid] = time.time()
+        if not self._unsent:
+            self._schedule(now + BATCH_MAX_LATENCY)
+        self._unsent.add(uid)
+        if all(device_uid in self._unsent for device_uid, device in self.devices.items()
+               if device.stale_timeout() is not None and not device.stale):
+            self._schedule(max(now, self._last_flush + BATCH_MIN_INTERVAL))
+
+    def forget(self, uid):
+        """
+        Forget the values of the device at UID, so that the next batch
+        holds all of its params again.
+        """
+        self._received.pop(uid, None)
+        self._unsent.discard(uid)
+        self._last_sent.pop(uid, None)
+
+    def _schedule(self, when):
+        """
+        Send the next batch at WHEN, unless it is already due sooner.
+        """
+        if self._timer is not None:
+            if self._timer.when() <= when:
+                return
+            self._timer.cancel()
+        self._timer = self._event_loop.call_at(when, self.flush)
+
+    def flush(self):
+        """
+        Send a batch now.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = self._event_loop.time()
+        self._last_flush = now
+        self._unsent.clear()
+        for uid in self._received.keys() - self.sensor_values.keys():
+            del self._received[uid]
+        if not USE_DELTA_BATCHES or self._batch_count % KEYFRAME_INTERVAL == 0:
+            self._last_sent = {uid: dict(params) for uid, params in self.sensor_values.items()}
+            batch = dict(self.sensor_values)
+        else:
+            batch = diff_sensor_values(self.sensor_values, self._last_sent)
+        self._batch_count += 1
+        if batch:
+            arrivals = {uid: self._received[uid] for uid in batch if uid in self._received}
+            self.state_queue.put_nowait(("device_values", [batch, arrivals]))
+
+
+async def control_subscription_rates(devices, event_loop):
+    """
+    Every `RATE_CONTROL_INTERVAL` seconds, adjust each device's subscription
+    delay to the health of its link, so that an overloaded link or process
+    gets less data instead of falling further and further behind.
+    """
+    last_time = event_loop.time()
     while True:
-        await asyncio.sleep(BATCH_SLEEP_TIME, loop=event_loop)
-        await state_queue.coro_put(("device_values", [sensor_values]), loop=event_loop)
+        await asyncio.sleep(RATE_CONTROL_INTERVAL, loop=event_loop)
+        now = event_loop.time()
+        for device in list(devices.values()):
+            device.adapt_rate(now - last_time)
+        last_time = now
+
+
+async def monitor_liveness(devices, batched_data, state_queue, event_loop, sensor_table=None, # pylint: disable=too-many-arguments
+                           batcher=None):
+    """
+    Tell `StateManager` as soon as a device goes quiet.
+
+    A device that has been silent for longer than its `stale_timeout` is
+    marked stale until it sends something again. One that stays silent
+    for `LIVENESS_DISCONNECT_TIMEOUT` seconds (or twice its stale timeout,
+    if that is longer) is disconnected without waiting for the serial port
+    to close, which can take seconds or never happen on a wedged link.
+    """
+    while True:
+        await asyncio.sleep(LIVENESS_CHECK_INTERVAL, loop=event_loop)
+        now = time.monotonic()
+        for uid, device in list(devices.items()):
+            timeout = device.stale_timeout()
+            if timeout is None:
+                continue
+            silence = now - device.last_received
+            if silence >= max(LIVENESS_DISCONNECT_TIMEOUT, 2 * timeout):
+                del devices[uid]
+                forget_values(uid, batched_data, batcher)
+                if sensor_table is not None:
+                    sensor_table.remove_device(uid)
+                # The `Disconnect` this causes is ignored, since the device is already gone
+                device.quit()
+                state_queue.put_nowait(("device_disconnected", [uid]))
+                continue
+            stale = silence >= timeout
+            if stale != device.stale:
+                device.stale = stale
+                if sensor_table is not None:
+                    sensor_table.set_stale(uid, stale)
+                state_queue.put_nowait(("device_stale", [uid, stale]))
+
+
+async def report_loop_lag(monitor, state_queue, event_loop):
+    """
+    Every `LOOP_LAG_REPORT_INTERVAL` seconds, send how late the event loop
+    is running to `StateManager`.
+    """
+    process_name = multiprocessing.current_process().name
+    while True:
+        await asyncio.sleep(LOOP_LAG_REPORT_INTERVAL, loop=event_loop)
+        await state_queue.coro_put(("loop_lag", [process_name, monitor.summary()]),
+                                   loop=event_loop)
+
+
+def disable_on_emergency_stop(emergency_stop, devices, state_queue, event_loop):
+    """
+    Disable every device as soon as EMERGENCY_STOP is triggered, without
+    waiting for the scheduler or for writes to be coalesced, and send how
+    long after the trigger the disables were written to `StateManager`.
+    """
+    event_loop.remove_reader(emergency_stop.fileno())
+    for device in list(devices.values()):
+        # Writes queued before the stop must not go out after the disable
+        device.pending_writes.clear()
+        if device.transport is not None and not device.transport.is_closing():
+            device.execute("disable", [])
+            device.writer.flush()
+    latency = emergency_stop.latency() * 1000
+    process_name = multiprocessing.current_process().name
+    state_queue.put_nowait(("emergency_stop_latency", [process_name, latency]))
+
+
+async def report_link_metrics(link_metrics, state_queue, event_loop):
+    """
+    Every `METRICS_INTERVAL` seconds, send a summary of every link to `StateManager`.
+    """
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL, loop=event_loop)
+        report = link_metrics.report(time.monotonic())
+        if report:
+            await state_queue.coro_put(("link_metrics", [report]), loop=event_loop)
 
 
 async def print_profiler_stats(event_loop, time_delay):
@@ -310,6 +1223,48 @@ async def print_profiler_stats(event_loop, time_delay):
     yappi.get_thread_stats().print_all()
 
 
+def shard_for_port(port, shard_count):
+    """
+    The shard that handles PORT. Ports always go to the same shard, so each
+    shard's port cache stays valid across restarts.
+    """
+    return zlib.crc32(port.encode()) % shard_count
+
+
+class ShardStateQueue:
+    """
+    Send messages from a shard to `StateManager`, first telling the front
+    end which shard devices are on so it can route instructions to them.
+
+    Since the front end hears about a device before `StateManager` does,
+    it knows where a device is by the time an instruction for it arrives.
+    """
+    def __init__(self, state_queue, front_end_pipe):
+        self._state_queue = state_queue
+        self._front_end_pipe = front_end_pipe
+
+    async def coro_put(self, item, **kwargs):
+        """
+        Put ITEM on the `StateManager` queue.
+        """
+        self._tell_front_end(item)
+        await self._state_queue.coro_put(item, **kwargs)
+
+    def put_nowait(self, item):
+        """
+        Put ITEM on the `StateManager` queue without waiting.
+        """
+        self._tell_front_end(item)
+        self._state_queue.put_nowait(item)
+
+    def _tell_front_end(self, item):
+        message, args = item
+        if message == "device_subscribed":
+            self._front_end_pipe.send(("device_added", args[0]))
+        elif message == "device_disconnected":
+            self._front_end_pipe.send(("device_removed", args[0]))
+
+
 class QueueContext:
     """
     Stub to force aioprocessing to use an existing queue.
@@ -322,26 +1277,66 @@ class QueueContext:
         return self._queue
 
 
-def hibike_process(bad_things_queue, state_queue, pipe_from_child):
+def hibike_process(bad_things_queue, state_queue, pipe_from_child, sensor_table=None, # pylint: disable=too-many-arguments,too-many-locals
+                   shard=None, shard_count=1, use_uvloop=False, emergency_stop=None):
     """
-    Run the main hibike processs.
+    Run the main hibike processs, on uvloop if `use_uvloop` is set and it is
+    installed.
+
+    If `sensor_table` is given, device values are also written to it
+    for student code to read directly.
+
+    If `shard` is given, this process is one of `shard_count` shards behind
+    `hibike_front_end`, and only handles the ports `shard_for_port` gives it.
+    Instructions come from the front end through `pipe_from_child`.
+
+    If `emergency_stop` is given, every device is disabled the moment it
+    is triggered, and writes are ignored from then on.
     """
+    shard_pipe = pipe_from_child
     pipe_from_child = aioprocessing.AioConnection(pipe_from_child)
     # By default, AioQueue instantiates a new Queue object, but we
     # don't want that.
     state_queue = aioprocessing.AioQueue(context=QueueContext(state_queue))
     bad_things_queue = aioprocessing.AioQueue(context=QueueContext(bad_things_queue))
+    port_filter = None
+    port_cache_file = PORT_CACHE_FILE
+    if shard is not None:
+        state_queue = ShardStateQueue(state_queue, shard_pipe)
+        port_filter = lambda port: shard_for_port(port, shard_count) == shard
+        port_cache_file = "{}.{}.json".format(os.path.splitext(PORT_CACHE_FILE)[0], shard)
 
     devices = {}
     batched_data = {}
-    event_loop = asyncio.get_event_loop()
+    event_loop = new_event_loop(use_uvloop)
     error_queue = asyncio.Queue(loop=event_loop)
+    identify_stats = IdentifyStats()
+    port_cache = PortCache(port_cache_file, event_loop)
+    link_metrics = LinkMetricsRegistry(identify_stats)
 
-    event_loop.create_task(batch_data(batched_data, state_queue, event_loop))
-    event_loop.create_task(hotplug_async(devices, batched_data, error_queue,
-                                         state_queue, event_loop))
+    batcher = DataBatcher(batched_data, devices, state_queue, event_loop)
+    if USE_RATE_CONTROL:
+        event_loop.create_task(control_subscription_rates(devices, event_loop))
+    event_loop.create_task(monitor_liveness(devices, batched_data, state_queue, event_loop,
+                                            sensor_table, batcher))
+    event_loop.create_task(report_link_metrics(link_metrics, state_queue, event_loop))
+    loop_lag = LoopLagMonitor(event_loop)
+    loop_lag.start()
+    event_loop.create_task(report_loop_lag(loop_lag, state_queue, event_loop))
+    if sensor_table is not None:
+        sensor_table.clear()
+    event_loop.create_task(hotplug_async(devices, batched_data, error_queue, state_queue,
+                                         event_loop, sensor_table,
+                                         identify_stats=identify_stats, port_cache=port_cache,
+                                         link_metrics=link_metrics,
+                                         recording_dir=RECORDING_DIRECTORY
+                                         if RECORD_SERIAL_TRAFFIC else None,
+                                         port_filter=port_filter, batcher=batcher))
     event_loop.create_task(dispatch_instructions(devices, bad_things_queue, state_queue,
-                                                 pipe_from_child, event_loop))
+                                                 pipe_from_child, event_loop, emergency_stop))
+    if emergency_stop is not None:
+        event_loop.add_reader(emergency_stop.fileno(), disable_on_emergency_stop,
+                              emergency_stop, devices, state_queue, event_loop)
     # start event loop
     if USE_PROFILING:
         try:
@@ -354,10 +1349,90 @@ def hibike_process(bad_things_queue, state_queue, pipe_from_child):
     event_loop.run_forever()
 
 
-async def dispatch_instructions(devices, bad_things_queue, state_queue,
-                                pipe_from_child, event_loop):
+def hibike_front_end(bad_things_queue, pipe_from_child, shard_pipes):
+    """
+    Stand in for Hibike when it is split into shards, passing instructions
+    from `StateManager` on to the shard that has the device.
+
+    Shards send everything else straight to `StateManager`, so instructions
+    are all that pass through here. Returns when `StateManager` hangs up.
+
+    :param list shard_pipes: Connections to the shards, in shard order
+    """
+    # Pylint doesn't understand our import shenanigans
+    # pylint: disable=import-error
+    from . import util as runtimeUtil
+
+    device_shards = {}
+    dead_shards = set()
+
+    def read_from_shard(shard):
+        try:
+            message, uid = shard_pipes[shard].recv()
+        except EOFError:
+            # The shard crashed, and its devices went with it
+            dead_shards.add(shard)
+            for uid in [uid for uid, owner in device_shards.items() if owner == shard]:
+                del device_shards[uid]
+            return
+        if message == "device_added":
+            device_shards[uid] = shard
+        elif message == "device_removed" and device_shards.get(uid) == shard:
+            del device_shards[uid]
+
+    def find_shard(uid):
+        if uid not in device_shards:
+            # The shard told us about the device before StateManager heard of
+            # it, so the news is already waiting
+            for shard, shard_pipe in enumerate(shard_pipes):
+                while shard not in dead_shards and shard_pipe.poll():
+                    read_from_shard(shard)
+        return device_shards[uid]
+
+    while True:
+        live_pipes = [shard_pipe for shard, shard_pipe in enumerate(shard_pipes)
+                      if shard not in dead_shards]
+        for connection in multiprocessing.connection.wait([pipe_from_child] + live_pipes):
+            if connection is not pipe_from_child:
+                shard = shard_pipes.index(connection)
+                # `find_shard` may have read everything already
+                while shard not in dead_shards and connection.poll():
+                    read_from_shard(shard)
+                continue
+            try:
+                instruction, args = pipe_from_child.recv()
+            except EOFError:
+                return
+            try:
+                if instruction in ("enumerate_all", "disable_all"):
+                    for shard_pipe in live_pipes:
+                        shard_pipe.send([instruction, args])
+                elif instruction == "timestamp_down":
+                    if live_pipes:
+                        live_pipes[0].send([instruction, args])
+                else:
+                    shard_pipes[find_shard(args[0])].send([instruction, args])
+            except KeyError as e:
+                bad_things_queue.put(runtimeUtil.BadThing(
+                    sys.exc_info(),
+                    str(e),
+                    event=runtimeUtil.BAD_EVENTS.HIBIKE_NONEXISTENT_DEVICE))
+            except TypeError as e:
+                bad_things_queue.put(runtimeUtil.BadThing(
+                    sys.exc_info(),
+                    str(e),
+                    event=runtimeUtil.BAD_EVENTS.HIBIKE_INSTRUCTION_ERROR))
+            except BrokenPipeError:
+                # The shard crashed; we find out properly when reading from it
+                pass
+
+
+async def dispatch_instructions(devices, bad_things_queue, state_queue, # pylint: disable=too-many-arguments
+                                pipe_from_child, event_loop, emergency_stop=None):
     """
     Respond to instructions from `StateManager`.
+
+    Writes are dropped once `emergency_stop`, if given, has been triggered.
     """
     path = os.path.dirname(os.path.abspath(__file__))
     parent_path = path.rstrip("hibike")
@@ -372,19 +1447,21 @@ async def dispatch_instructions(devices, bad_things_queue, state_queue,
         try:
             if instruction == "enumerate_all":
                 for pack in devices.values():
-                    pack.write_queue.put_nowait(("ping", []))
+                    pack.queue_instruction("ping", [])
             elif instruction == "subscribe_device":
                 uid = args[0]
-                devices[uid].write_queue.put_nowait(("subscribe", args))
+                devices[uid].queue_instruction("subscribe", args)
             elif instruction == "write_params":
-                uid = args[0]
-                devices[uid].write_queue.put_nowait(("write", args))
+                if emergency_stop is not None and emergency_stop.triggered:
+                    continue
+                uid, params_and_values = args
+                devices[uid].queue_write(params_and_values)
             elif instruction == "read_params":
                 uid = args[0]
-                devices[uid].write_queue.put_nowait(("read", args))
+                devices[uid].queue_instruction("read", args)
             elif instruction == "disable_all":
                 for pack in devices.values():
-                    pack.write_queue.put_nowait(("disable", []))
+                    pack.queue_instruction("disable", [])
             elif instruction == "timestamp_down":
                 timestamp = time.time()
                 args.append(timestamp)
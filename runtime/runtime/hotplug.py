@@ -0,0 +1,166 @@
+"""
+Watchers that tell Hibike when serial ports may have appeared or disappeared.
+
+Each watcher has a coroutine ``wait(timeout)`` that returns ``True`` as soon as
+something changed, or ``False`` once ``timeout`` seconds pass without a change,
+and a ``sees_events`` attribute that says whether it can ever return ``True``.
+Hibike rescans for ports after either, so a watcher that misses an event only
+delays a device by ``timeout``.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import struct
+import sys
+
+__all__ = ["PollingWatcher", "InotifyWatcher", "make_hotplug_watcher", "USING_INOTIFY"]
+
+# Names of device nodes that may be smart sensors; see `scan_for_serial_ports`
+SERIAL_PORT_PATTERNS = ("ttyACM*", "ttyUSB*", "tty.usbmodem*")
+# Time in seconds to wait after an event for the rest of a burst to arrive.
+# udev creates a device node and sets its permissions in separate steps.
+HOTPLUG_SETTLE_TIME = 0.05
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1  # pylint: disable=pointless-statement
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+LIBC = _load_libc()
+USING_INOTIFY = LIBC is not None
+
+
+class PollingWatcher:
+    """
+    A watcher that never sees events, so Hibike rescans once per timeout.
+    """
+    sees_events = False
+
+    def __init__(self, event_loop):
+        self._event_loop = event_loop
+
+    async def wait(self, timeout):
+        """
+        Sleep for `timeout` seconds.
+        """
+        await asyncio.sleep(timeout, loop=self._event_loop)
+        return False
+
+    def close(self):
+        """
+        Stop watching.
+        """
+
+
+class InotifyWatcher:
+    """
+    Watch directories with inotify for files matching some patterns.
+
+    :param event_loop: The event loop
+    :param dict patterns: Mapping from directories to watch to the
+    ``fnmatch`` patterns of the file names that matter in each
+    """
+    sees_events = True
+
+    def __init__(self, event_loop, patterns):
+        self._event_loop = event_loop
+        self._changed = asyncio.Event(loop=event_loop)
+        self._fd = LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._patterns = {}
+        mask = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        for directory, names in patterns.items():
+            wd = LIBC.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(err, os.strerror(err), directory)
+            self._patterns[wd] = names
+        event_loop.add_reader(self._fd, self._read_events)
+
+    def _read_events(self):
+        data = bytearray()
+        while True:
+            try:
+                chunk = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                break
+            data.extend(chunk)
+        pos = 0
+        while pos + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = bytes(data[pos:pos + name_len]).rstrip(b"\0").decode(errors="replace")
+            pos += name_len
+            if mask & IN_Q_OVERFLOW or any(fnmatch.fnmatchcase(name, pattern)
+                                           for pattern in self._patterns.get(wd, ())):
+                self._changed.set()
+
+    async def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for a watched file to change.
+        """
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout, loop=self._event_loop)
+        except asyncio.TimeoutError:
+            return False
+        # Let the rest of a burst of events arrive so we only rescan once.
+        await asyncio.sleep(HOTPLUG_SETTLE_TIME, loop=self._event_loop)
+        self._changed.clear()
+        return True
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        if self._fd is not None:
+            self._event_loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+def make_hotplug_watcher(event_loop, virtual_device_config_file):
+    """
+    Watch ``/dev`` for serial ports and ``virtual_device_config_file`` for
+    virtual devices, falling back to polling if inotify is not available.
+    """
+    if USING_INOTIFY:
+        patterns = {"/dev": SERIAL_PORT_PATTERNS}
+        config_dir, config_name = os.path.split(virtual_device_config_file)
+        patterns.setdefault(config_dir, ())
+        patterns[config_dir] += (config_name,)
+        try:
+            return InotifyWatcher(event_loop, patterns)
+        except OSError:
+            pass
+    return PollingWatcher(event_loop)
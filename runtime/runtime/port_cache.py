@@ -0,0 +1,98 @@
+"""
+Remember which device was on each serial port between runs of Hibike.
+
+When runtime restarts, Hibike registers the device it saw on a port last
+time as soon as the port opens, and then checks in the background that the
+device that answers is really the same one.
+"""
+import json
+import os
+
+from serial.tools import list_ports
+
+__all__ = ["PortCache", "usb_serial_numbers"]
+
+# Bump this when the format of the cache file changes
+PORT_CACHE_VERSION = 1
+# Time in seconds to wait before writing changes out, so that a burst of
+# subscriptions at startup only writes the file once
+PORT_CACHE_SAVE_DELAY = 1
+
+
+def usb_serial_numbers():
+    """
+    Returns:
+        A mapping from port names to the serial numbers of the USB devices
+        behind them, for ports that have one.
+    """
+    try:
+        return {port.device: port.serial_number for port in list_ports.comports()
+                if port.serial_number}
+    except OSError:
+        return {}
+
+
+class PortCache:
+    """
+    A mapping from ports to the UID and subscription of the device last seen
+    on each, saved in a JSON file.
+
+    If a port's USB serial number is known, a cache entry is only used
+    when it matches, so swapping cables between ports is noticed.
+    """
+    def __init__(self, path, event_loop):
+        self.path = path
+        self._event_loop = event_loop
+        self._entries = {}
+        self._save_handle = None
+        try:
+            with open(path) as cache_file:
+                contents = json.load(cache_file)
+            if contents.get("version") == PORT_CACHE_VERSION:
+                self._entries = contents["ports"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def lookup(self, port, usb_serial=None):
+        """
+        Returns:
+            The (UID, delay, params) of the device last seen on PORT,
+            or None if there is no usable entry.
+        """
+        entry = self._entries.get(port)
+        if entry is None or entry["usb_serial"] != usb_serial:
+            return None
+        return entry["uid"], entry["delay"], entry["params"]
+
+    def store(self, port, usb_serial, uid, delay, params):
+        """
+        Remember that the device at UID is on PORT with the given subscription.
+        """
+        entry = {"usb_serial": usb_serial, "uid": uid, "delay": delay, "params": list(params)}
+        if self._entries.get(port) != entry:
+            self._entries[port] = entry
+            self._schedule_save()
+
+    def forget(self, port):
+        """
+        Drop the entry for PORT.
+        """
+        if self._entries.pop(port, None) is not None:
+            self._schedule_save()
+
+    def _schedule_save(self):
+        if self._save_handle is None:
+            self._save_handle = self._event_loop.call_later(PORT_CACHE_SAVE_DELAY, self.save)
+
+    def save(self):
+        """
+        Write the cache out to disk.
+        """
+        self._save_handle = None
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as cache_file:
+                json.dump({"version": PORT_CACHE_VERSION, "ports": self._entries}, cache_file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
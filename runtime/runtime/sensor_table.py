@@ -0,0 +1,316 @@
+"""
+A table of sensor values in shared memory.
+
+Hibike writes the latest values of each device into a fixed-size slot, and
+student code reads them in place instead of asking StateManager for a copy
+of every device on each tick.
+
+Layout::
+
+    header: generation (uint32), number of slots (uint32)
+    slot:   sequence (uint32), present params bitmask (uint16), state (uint8),
+            UID bits 95:64 (uint64), UID bits 63:0 (uint64), timestamp (double),
+            param values packed in param number order
+
+Each slot is guarded by a seqlock: the writer makes the sequence number odd
+while it writes and even again when it is done, and readers retry if the
+number was odd or changed while they read. The generation number in the
+header works the same way for adding and removing devices.
+
+When Hibike is split into shards, each shard writes to its own share of the
+slots (see `share`), and a lock shared between them keeps their changes to
+the generation number from interleaving.
+
+A slot's state is 0 if it is free, 1 if its device is connected, and 2 if
+its device has gone quiet and its values may be out of date.
+"""
+import contextlib
+import struct
+import time
+
+try:
+    from multiprocessing import shared_memory
+    USING_SHARED_MEMORY = True
+except ImportError:
+    USING_SHARED_MEMORY = False
+
+from . import hibike_message as hm
+
+__all__ = ["SensorTable", "MAX_DEVICES", "USING_SHARED_MEMORY"]
+
+# The most devices that can be connected at once
+MAX_DEVICES = 32
+# How many times to retry a read that raced with a write before giving up
+MAX_READ_RETRIES = 1000
+
+SLOT_FREE = 0
+SLOT_CONNECTED = 1
+SLOT_STALE = 2
+
+HEADER = struct.Struct("<II")
+SEQUENCE = struct.Struct("<I")
+SLOT_HEADER = struct.Struct("<IHBxQQd")
+
+
+def make_device_layouts():
+    """
+    Compute where each param of each device type lives within a slot.
+
+    Returns:
+        A mapping from device IDs to mappings from param names to
+        (param number, offset, struct) tuples.
+    """
+    layouts = {}
+    for device_id, device in hm.DEVICES.items():
+        offset = SLOT_HEADER.size
+        params = {}
+        for param in sorted(device["params"], key=lambda param: param["number"]):
+            param_struct = struct.Struct("<" + hm.PARAM_TYPES[param["type"]])
+            params[param["name"]] = (param["number"], offset, param_struct)
+            offset += param_struct.size
+        layouts[device_id] = params
+    return layouts
+
+
+DEVICE_LAYOUTS = make_device_layouts()
+SLOT_SIZE = max(max((offset + param_struct.size for _, offset, param_struct in params.values()),
+                    default=SLOT_HEADER.size)
+                for params in DEVICE_LAYOUTS.values())
+
+
+class SensorTable:
+    """
+    Sensor values shared between Hibike and student code.
+
+    Create the table with `SensorTable.create` in the parent process before
+    starting the processes that use it. Pickling a table (for example, when
+    passing it to a spawned process) reattaches to the same shared memory.
+    """
+    def __init__(self, shm):
+        self._shm = shm
+        self._buf = shm.buf
+        self._num_slots = HEADER.unpack_from(self._buf)[1]
+        self._slots = {}
+        self._generation = None
+        # The slots this writer may use, and what guards the generation number
+        self._own_slots = range(self._num_slots)
+        self._lock = contextlib.nullcontext()
+
+    @classmethod
+    def create(cls, max_devices=MAX_DEVICES):
+        """
+        Allocate a new, empty table.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=HEADER.size + max_devices * SLOT_SIZE)
+        shm.buf[:] = bytes(len(shm.buf))
+        HEADER.pack_into(shm.buf, 0, 0, max_devices)
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attach to an existing table by the name of its shared memory.
+        """
+        return cls(shared_memory.SharedMemory(name=name))
+
+    def __reduce__(self):
+        return (SensorTable.attach, (self._shm.name,))
+
+    def close(self):
+        """
+        Detach from the shared memory.
+        """
+        self._buf = None
+        self._shm.close()
+
+    def unlink(self):
+        """
+        Free the shared memory. Only the process that created the table should do this.
+        """
+        self._shm.unlink()
+
+    def share(self, shard, shard_count, lock):
+        """
+        Only write to every SHARD_COUNTth slot starting at SHARD, so that
+        SHARD_COUNT processes can write to the table at once.
+
+        :param lock: A `multiprocessing.Lock` shared by all the writers
+        """
+        self._own_slots = range(shard, self._num_slots, shard_count)
+        self._lock = lock
+
+    def _slot_offset(self, slot):
+        return HEADER.size + slot * SLOT_SIZE
+
+    def _write_slot_header(self, offset, sequence, *fields):
+        """
+        Write FIELDS to the header of the slot at OFFSET, whose sequence
+        number was SEQUENCE, making the number odd until they are written.
+        """
+        buf = self._buf
+        SEQUENCE.pack_into(buf, offset, (sequence + 1) & 0xFFFFFFFF)
+        SLOT_HEADER.pack_into(buf, offset, (sequence + 1) & 0xFFFFFFFF, *fields)
+        SEQUENCE.pack_into(buf, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    def _bump_generation(self):
+        generation = HEADER.unpack_from(self._buf)[0]
+        HEADER.pack_into(self._buf, 0, (generation + 1) & 0xFFFFFFFF, self._num_slots)
+
+    def _refresh_slots(self):
+        """
+        Rebuild the mapping from UIDs to slots if devices were added or removed.
+        """
+        for _ in range(MAX_READ_RETRIES):
+            generation = HEADER.unpack_from(self._buf)[0]
+            if generation == self._generation:
+                return
+            if generation & 1:
+                continue
+            slots = {}
+            for slot in range(self._num_slots):
+                _, _, occupied, uid_high, uid_low, _ = \
+                    SLOT_HEADER.unpack_from(self._buf, self._slot_offset(slot))
+                if occupied:
+                    slots[uid_high << 64 | uid_low] = slot
+            if HEADER.unpack_from(self._buf)[0] == generation:
+                self._slots = slots
+                self._generation = generation
+                return
+        raise RuntimeError("Timed out reading the sensor table")
+
+    # Used by Hibike, which is the only writer.
+
+    def clear(self):
+        """
+        Remove every device from the slots this writer uses.
+        """
+        with self._lock:
+            self._bump_generation()
+            for slot in self._own_slots:
+                offset = self._slot_offset(slot)
+                sequence = SEQUENCE.unpack_from(self._buf, offset)[0]
+                self._write_slot_header(offset, sequence, 0, 0, 0, 0, 0)
+            self._bump_generation()
+        self._slots = {}
+
+    def add_device(self, uid):
+        """
+        Give the device at UID a slot, if it does not already have one.
+        """
+        if uid in self._slots:
+            return self._slots[uid]
+        used = set(self._slots.values())
+        for slot in self._own_slots:
+            if slot not in used:
+                break
+        else:
+            raise RuntimeError("Sensor table is full")
+        offset = self._slot_offset(slot)
+        sequence = SEQUENCE.unpack_from(self._buf, offset)[0]
+        with self._lock:
+            self._bump_generation()
+            self._write_slot_header(offset, sequence, 0, SLOT_CONNECTED, uid >> 64,
+                                    uid & 0xFFFFFFFFFFFFFFFF, time.time())
+            self._bump_generation()
+        self._slots[uid] = slot
+        return slot
+
+    def remove_device(self, uid):
+        """
+        Free the slot of the device at UID.
+        """
+        slot = self._slots.pop(uid, None)
+        if slot is None:
+            return
+        offset = self._slot_offset(slot)
+        sequence = SEQUENCE.unpack_from(self._buf, offset)[0]
+        with self._lock:
+            self._bump_generation()
+            self._write_slot_header(offset, sequence, 0, 0, 0, 0, 0)
+            self._bump_generation()
+
+    def update(self, uid, params_and_values):
+        """
+        Write an iterable of (param, value) tuples for the device at UID.
+        """
+        slot = self._slots.get(uid)
+        if slot is None:
+            slot = self.add_device(uid)
+        layout = DEVICE_LAYOUTS[hm.uid_to_device_id(uid)]
+        buf = self._buf
+        offset = self._slot_offset(slot)
+        sequence, present, state, uid_high, uid_low, _ = SLOT_HEADER.unpack_from(buf, offset)
+        SEQUENCE.pack_into(buf, offset, (sequence + 1) & 0xFFFFFFFF)
+        for param, value in params_and_values:
+            number, param_offset, param_struct = layout[param]
+            param_struct.pack_into(buf, offset + param_offset, value)
+            present |= 1 << number
+        self._write_slot_header(offset, sequence, present, state, uid_high, uid_low, time.time())
+
+    def set_stale(self, uid, stale):
+        """
+        Mark whether the device at UID has gone quiet.
+        """
+        slot = self._slots.get(uid)
+        if slot is None:
+            return
+        offset = self._slot_offset(slot)
+        sequence, present, _, uid_high, uid_low, timestamp = \
+            SLOT_HEADER.unpack_from(self._buf, offset)
+        self._write_slot_header(offset, sequence, present,
+                                SLOT_STALE if stale else SLOT_CONNECTED, uid_high, uid_low,
+                                timestamp)
+
+    # Used by student code.
+
+    def uids(self):
+        """
+        The UIDs of all devices in the table.
+        """
+        self._refresh_slots()
+        return self._slots.keys()
+
+    def is_stale(self, uid):
+        """
+        Whether the device at UID has gone quiet.
+
+        Raises ``KeyError`` if the device does not exist.
+        """
+        self._refresh_slots()
+        offset = self._slot_offset(self._slots[uid])
+        for _ in range(MAX_READ_RETRIES):
+            sequence, _, state, uid_high, uid_low, _ = SLOT_HEADER.unpack_from(self._buf, offset)
+            if not sequence & 1 and SEQUENCE.unpack_from(self._buf, offset)[0] == sequence:
+                break
+        else:
+            raise RuntimeError("Timed out reading the sensor table")
+        if state == SLOT_FREE or (uid_high << 64 | uid_low) != uid:
+            raise KeyError(uid)
+        return state == SLOT_STALE
+
+    def get_value(self, uid, param):
+        """
+        Read the latest value of PARAM from the device at UID.
+
+        Returns ``None`` if the device has not reported PARAM yet.
+        Raises ``KeyError`` if the device or param does not exist.
+        """
+        self._refresh_slots()
+        offset = self._slot_offset(self._slots[uid])
+        number, param_offset, param_struct = DEVICE_LAYOUTS[hm.uid_to_device_id(uid)][param]
+        buf = self._buf
+        for _ in range(MAX_READ_RETRIES):
+            sequence, present, occupied, uid_high, uid_low, _ = \
+                SLOT_HEADER.unpack_from(buf, offset)
+            if sequence & 1:
+                continue
+            value, = param_struct.unpack_from(buf, offset + param_offset)
+            if SEQUENCE.unpack_from(buf, offset)[0] == sequence:
+                break
+        else:
+            raise RuntimeError("Timed out reading the sensor table")
+        if not occupied or (uid_high << 64 | uid_low) != uid:
+            raise KeyError(uid)
+        if not present & (1 << number):
+            return None
+        return value
@@ -0,0 +1,227 @@
+"""
+Record the raw bytes sent and received on a serial port, and play them back.
+
+A recording is a header followed by one record per read or write:
+
+    header: magic (8 bytes), version (uint8), wall clock time the recording
+            started (double), length of the port name (uint16), port name
+    record: microseconds since the previous record (uint32), direction
+            (uint8, 0 for received and 1 for sent), length (uint16), bytes
+
+`ReplayTransport` feeds the received bytes of a recording to a protocol
+such as `SmartSensorProtocol`, either with their original timing or as
+fast as the protocol can take them, so problems seen on a robot can be
+reproduced and benchmarked without the devices.
+"""
+import asyncio
+import os
+import struct
+import time
+
+__all__ = ["SerialRecorder", "read_recording", "recording_path", "ReplayTransport",
+           "RECEIVED", "SENT"]
+
+RECORDING_MAGIC = b"HBKREC\r\n"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct("<BdH")
+RECORD_HEADER = struct.Struct("<IBH")
+# Longest gap between records, in microseconds, that fits in a record header
+MAX_RECORD_GAP = 0xFFFFFFFF
+# Longest chunk of bytes that fits in one record
+MAX_RECORD_LENGTH = 0xFFFF
+
+RECEIVED = 0
+SENT = 1
+
+
+class SerialRecorder:
+    """
+    Append the traffic on one serial port to a recording file.
+
+    :param str path: Where to write the recording
+    :param str port: The name of the port being recorded
+    """
+    __slots__ = ("path", "_file", "_last_time")
+
+    def __init__(self, path, port):
+        self.path = path
+        self._file = open(path, "wb")
+        name = port.encode()
+        self._file.write(RECORDING_MAGIC)
+        self._file.write(RECORDING_HEADER.pack(RECORDING_VERSION, time.time(), len(name)))
+        self._file.write(name)
+        self._last_time = time.monotonic()
+
+    def record(self, direction, data):
+        """
+        Record DATA as received or sent, depending on DIRECTION.
+        """
+        if self._file is None:
+            return
+        now = time.monotonic()
+        gap = min(round((now - self._last_time) * 1e6), MAX_RECORD_GAP)
+        self._last_time = now
+        for start in range(0, len(data), MAX_RECORD_LENGTH):
+            chunk = data[start:start + MAX_RECORD_LENGTH]
+            self._file.write(RECORD_HEADER.pack(gap, direction, len(chunk)))
+            self._file.write(chunk)
+            gap = 0
+
+    def close(self):
+        """
+        Finish the recording.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Recording:
+    """
+    The contents of a recording file.
+
+    Attributes:
+        port    - the name of the recorded port
+        started - the wall clock time the recording started
+        records - a list of (seconds since the start, direction, bytes)
+    """
+    __slots__ = ("port", "started", "records")
+
+    def __init__(self, port, started, records):
+        self.port = port
+        self.started = started
+        self.records = records
+
+    def received(self):
+        """ Every received byte, in order. """
+        return b"".join(data for _, direction, data in self.records if direction == RECEIVED)
+
+    def sent(self):
+        """ Every sent byte, in order. """
+        return b"".join(data for _, direction, data in self.records if direction == SENT)
+
+
+def read_recording(path):
+    """
+    Read the recording at PATH.
+
+    A record cut short, e.g. because Hibike was killed, ends the recording.
+
+    Raises:
+        ValueError: If PATH is not a recording this version can read.
+    """
+    with open(path, "rb") as recording_file:
+        contents = recording_file.read()
+    if not contents.startswith(RECORDING_MAGIC):
+        raise ValueError("{} is not a serial recording".format(path))
+    pos = len(RECORDING_MAGIC)
+    if len(contents) < pos + RECORDING_HEADER.size:
+        raise ValueError("{} is truncated".format(path))
+    version, started, name_length = RECORDING_HEADER.unpack_from(contents, pos)
+    if version != RECORDING_VERSION:
+        raise ValueError("{} has unsupported version {}".format(path, version))
+    pos += RECORDING_HEADER.size
+    port = contents[pos:pos + name_length].decode(errors="replace")
+    pos += name_length
+    records = []
+    elapsed = 0
+    while pos + RECORD_HEADER.size <= len(contents):
+        gap, direction, length = RECORD_HEADER.unpack_from(contents, pos)
+        pos += RECORD_HEADER.size
+        if pos + length > len(contents):
+            break
+        elapsed += gap
+        records.append((elapsed / 1e6, direction, contents[pos:pos + length]))
+        pos += length
+    return Recording(port, started, records)
+
+
+class _ReplaySerial:
+    """
+    Stands in for the `serial.Serial` of a transport.
+    """
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class ReplayTransport(asyncio.Transport):
+    """
+    A transport that feeds the received bytes of a recording to a protocol.
+
+    What the protocol writes is kept in `writes` instead of being sent
+    anywhere, so it can be compared with what was sent when recording.
+    Reading pauses when the protocol asks, as on a real serial port.
+
+    :param protocol: The protocol to feed, e.g. a `SmartSensorProtocol`
+    :param Recording recording: What to feed it
+    :param event_loop: The event loop
+    :param float speed: How many times faster than it was recorded to play
+    the recording, or None to play it as fast as possible
+    """
+    def __init__(self, protocol, recording, event_loop, speed=1.0):
+        super().__init__()
+        self.serial = _ReplaySerial(recording.port)
+        self.writes = []
+        self._protocol = protocol
+        self._recording = recording
+        self._event_loop = event_loop
+        self._speed = speed
+        self._closing = False
+        self._reading = asyncio.Event(loop=event_loop)
+        self._reading.set()
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            self._event_loop.call_soon(self._protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def pause_reading(self):
+        self._reading.clear()
+
+    def resume_reading(self):
+        self._reading.set()
+
+    def is_reading(self):
+        return self._reading.is_set()
+
+    async def play(self):
+        """
+        Connect the protocol and feed it every received byte in the
+        recording, returning once all of them have been fed.
+
+        The transport is left open so the protocol can finish processing.
+        """
+        self._protocol.connection_made(self)
+        start = self._event_loop.time()
+        for offset, direction, data in self._recording.records:
+            if direction != RECEIVED:
+                continue
+            if self._speed is not None:
+                delay = start + offset / self._speed - self._event_loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay, loop=self._event_loop)
+            await self._reading.wait()
+            if self._closing:
+                return
+            self._protocol.data_received(data)
+            # Let the protocol process the data, as it would between reads
+            await asyncio.sleep(0, loop=self._event_loop)
+
+
+def recording_path(directory, port):
+    """
+    A new file name in DIRECTORY for a recording of PORT.
+    """
+    name = os.path.basename(port) or "port"
+    return os.path.join(directory, "{}-{}.hbr".format(time.strftime("%Y%m%d-%H%M%S"), name))
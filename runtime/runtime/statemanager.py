@@ -1,3 +1,5 @@
+import json
+import os
 import sys
 import time
 import traceback
@@ -13,18 +15,31 @@ class StateManager: # pylint: disable=too-many-public-methods
     Sends BadThingsQueue, studentCode pipe, Hibike pipe, and Ansible pipe to the above.
     """
 
-    def __init__(self, badThingsQueue, inputQueue, runtimePipe):
+    def __init__(self, badThingsQueue, inputQueue, runtimePipe, emergencyStop=None):
         self.init_robot_state()
         self.bad_things_queue = badThingsQueue
+        # The `EmergencyStop` fast path to Hibike, if any
+        self.emergency_stop_channel = emergencyStop
         self.input_ = inputQueue
         self.command_mapping = self.make_command_map()
         self.hibike_mapping = self.make_hibike_map()
         self.hibike_response_mapping = self.make_hibike_response_map()
         self.device_name_to_subscribe_params = self.make_subscription_map()
+        self.default_subscription_delay, self.subscription_delays = \
+            self.make_subscription_delays()
+        # Params that student code has read, by UID
+        self.accessed_params = {}
+        # Delays in milliseconds set by student code, by UID and param
+        self.delay_overrides = {}
+        # Delays of the params last subscribed to, by UID and param
+        self.subscriptions = {}
         self.process_mapping = {PROCESS_NAMES.RUNTIME: runtimePipe}
 
     @staticmethod
     def make_subscription_map():
+        """
+        Create a mapping between device types and the params Dawn shows for them.
+        """
         subscription_map = {
             "LimitSwitch": ["switch0", "switch1", "switch2"],
             "LineFollower": ["left", "center", "right"],
@@ -39,6 +54,20 @@ class StateManager: # pylint: disable=too-many-public-methods
         }
         return subscription_map
 
+    @staticmethod
+    def make_subscription_delays(filename="subscriptionRates.json"):
+        """
+        Load how often each param should be updated, in milliseconds.
+
+        Returns:
+            The default delay, and a mapping from device types to mappings
+            from params to delays for params that differ from the default.
+        """
+        rates_file = os.path.join(os.path.dirname(__file__), filename)
+        with open(rates_file, "r") as f:
+            rates = json.load(f)
+        return rates["default"], rates["devices"]
+
     def make_command_map(self):
         """
         Create a mapping between command input and the state manager behavior.
@@ -58,12 +87,16 @@ class StateManager: # pylint: disable=too-many-public-methods
             SM_COMMANDS.STUDENT_UPLOAD: self.student_upload,
             SM_COMMANDS.SEND_CONSOLE: self.send_console,
             SM_COMMANDS.SET_ADDR: self.set_addr,
+            SM_COMMANDS.CLEAR_ADDR: self.clear_addr,
             SM_COMMANDS.SEND_ADDR: self.send_addr,
             SM_COMMANDS.ENTER_IDLE: self.enter_idle,
             SM_COMMANDS.ENTER_TELEOP: self.enter_teleop,
             SM_COMMANDS.ENTER_AUTO: self.enter_auto,
             SM_COMMANDS.END_STUDENT_CODE: self.end_student_code,
             SM_COMMANDS.SET_TEAM: self.set_team,
+            SM_COMMANDS.PARAMS_ACCESSED: self.params_accessed,
+            SM_COMMANDS.SET_PARAM_DELAY: self.set_param_delay,
+            SM_COMMANDS.RECORD_LOOP_LAG: self.record_loop_lag,
         }
         return command_mapping
 
@@ -89,6 +122,10 @@ class StateManager: # pylint: disable=too-many-public-methods
             HIBIKE_RESPONSE.DEVICE_SUBBED: self.hibike_response_device_subbed,
             HIBIKE_RESPONSE.DEVICE_VALUES: self.hibike_response_device_values,
             HIBIKE_RESPONSE.DEVICE_DISCONNECT: self.hibike_response_device_disconnect,
+            HIBIKE_RESPONSE.DEVICE_STALE: self.hibike_response_device_stale,
+            HIBIKE_RESPONSE.LINK_METRICS: self.hibike_response_link_metrics,
+            HIBIKE_RESPONSE.LOOP_LAG: self.record_loop_lag,
+            HIBIKE_RESPONSE.EMERGENCY_STOP_LATENCY: self.record_emergency_stop_latency,
             HIBIKE_RESPONSE.TIMESTAMP_UP: self.hibike_response_timestamp_up
         }
         return {k.value: v for k, v in hibike_response_mapping.items()}
@@ -108,7 +145,8 @@ class StateManager: # pylint: disable=too-many-public-methods
             "dict1": [{"inner_dict1_int": [555, t], "inner_dict_1_string": ["hello", t]}, t],
             "list1": [[[70, t], ["five", t], [14.3, t]], t],
             "string1": ["abcde", t],
-            "runtime_meta": [{"studentCode_main_count": [0, t], "e_stopped": [False, t]}, t],
+            "runtime_meta": [{"studentCode_main_count": [0, t], "e_stopped": [False, t],
+                              "loop_lag": [{}, t], "e_stop_latency": [{}, t]}, t],
             "hibike": [{"device_subscribed": [0, t],
                         "devices": [{-1: [{"major": [RUNTIME_CONFIG.VERSION_MAJOR.value, t],
                                            "minor": [RUNTIME_CONFIG.VERSION_MINOR.value, t],
@@ -116,7 +154,9 @@ class StateManager: # pylint: disable=too-many-public-methods
                                           t],
                                      0: [{"code": [0, t]}, t],
                                      1: [{"code": [0, t]}, t],
-                                     2: [{"code": [0, t]}, t]}, t]}, t],
+                                     2: [{"code": [0, t]}, t]}, t],
+                        "stale_devices": [{}, t],
+                        "link_metrics": [{"ports": [{}, t], "devices": [{}, t]}, t]}, t],
             "dawn_addr": [None, t],
             "gamepads": [{0: {"axes": {0: 0.5, 1: -0.5, 2: 1, 3: -1},
                               "buttons": {0: True, 1: False, 2: True, 3: False, 4: True}}}, t],
@@ -206,6 +246,18 @@ class StateManager: # pylint: disable=too-many-public-methods
     def set_addr(self, new_addr):
         self.state["dawn_addr"] = [new_addr, time.time()]
         self.bad_things_queue.put(BadThing(sys.exc_info(), None, BAD_EVENTS.NEW_IP, False))
+        # Dawn shows more params than student code may read
+        for uid in self.subscriptions:
+            self.update_subscription(uid)
+
+    def clear_addr(self):
+        """
+        Forget Dawn's address, since Dawn disconnected.
+        """
+        self.state["dawn_addr"] = [None, time.time()]
+        # Stop sending the params only Dawn shows
+        for uid in self.subscriptions:
+            self.update_subscription(uid)
 
     def send_addr(self, process_name):
         self.process_mapping[process_name].send(self.state["dawn_addr"][0])
@@ -275,6 +327,8 @@ class StateManager: # pylint: disable=too-many-public-methods
         """
         Activate emergency stop.
         """
+        if self.emergency_stop_channel is not None:
+            self.emergency_stop_channel.trigger()
         self.state["runtime_meta"][0]["e_stopped"][0] = True
         self.bad_things_queue.put(BadThing(sys.exc_info(
         ), "Emergency Stop Activated", event=BAD_EVENTS.EMERGENCY_STOP, printStackTrace=False))
@@ -287,12 +341,75 @@ class StateManager: # pylint: disable=too-many-public-methods
     def end_student_code(self):
         self.process_mapping[PROCESS_NAMES.UDP_RECEIVE_PROCESS].send(
             runtime_pb2.RuntimeData.STUDENT_STOPPED)
+        self.accessed_params.clear()
+        self.delay_overrides.clear()
+        for uid in self.subscriptions:
+            self.update_subscription(uid)
+
+    def params_accessed(self, uid, params):
+        """
+        Subscribe to PARAMS of the device at UID, now that student code reads them.
+        """
+        self.accessed_params.setdefault(uid, set()).update(params)
+        if uid in self.subscriptions:
+            self.update_subscription(uid)
+            # Student code is waiting for these, so ask for them now instead
+            # of at the device's next update. The subscription went out first,
+            # so the values have somewhere to go when they arrive.
+            self.hibike_read_params(self.process_mapping[PROCESS_NAMES.HIBIKE], uid,
+                                    sorted(params))
+
+    def set_param_delay(self, uid, param, delay):
+        """
+        Update PARAM of the device at UID every DELAY milliseconds, or at
+        the configured rate if DELAY is None, until student code ends.
+        """
+        if delay is None:
+            self.delay_overrides.get(uid, {}).pop(param, None)
+        else:
+            self.delay_overrides.setdefault(uid, {})[param] = delay
+        if uid in self.subscriptions:
+            self.update_subscription(uid)
+
+    def update_subscription(self, uid):
+        """
+        Subscribe the device at UID to the params that student code reads,
+        and the ones Dawn shows if Dawn is connected, if those changed.
+
+        The params with the shortest delay make up the device's subscription,
+        and Hibike reads the rest on their own schedules.
+        """
+        params = set(self.accessed_params.get(uid, ()))
+        device_name = SENSOR_TYPE[uid >> 72]
+        if self.state["dawn_addr"][0] is not None:
+            params.update(self.device_name_to_subscribe_params.get(device_name, ()))
+        device_delays = self.subscription_delays.get(device_name, {})
+        overrides = self.delay_overrides.get(uid, {})
+        delays = {param: overrides.get(param, device_delays.get(param,
+                                                                self.default_subscription_delay))
+                  for param in params}
+        if delays == self.subscriptions.get(uid):
+            return
+        self.subscriptions[uid] = delays
+        delay = min(delays.values(), default=0)
+        self.hibike_subscribe_device(
+            self.process_mapping[PROCESS_NAMES.HIBIKE], uid, delay,
+            sorted(param for param, param_delay in delays.items() if param_delay == delay),
+            {param: param_delay for param, param_delay in delays.items() if param_delay != delay})
 
     def hibike_enumerate_all(self, pipe):
         pipe.send([HIBIKE_COMMANDS.ENUMERATE.value, []])
 
-    def hibike_subscribe_device(self, pipe, uid, delay, params):
-        pipe.send([HIBIKE_COMMANDS.SUBSCRIBE.value, [uid, delay, params]])
+    def hibike_subscribe_device(self, pipe, uid, delay, params, read_delays=None): # pylint: disable=too-many-arguments
+        """
+        Subscribe to PARAMS of the device at UID every DELAY milliseconds.
+
+        READ_DELAYS maps any other params to how often Hibike should read them.
+        """
+        args = [uid, delay, params]
+        if read_delays:
+            args.append(read_delays)
+        pipe.send([HIBIKE_COMMANDS.SUBSCRIBE.value, args])
 
     def hibike_write_params(self, pipe, uid, param_values):
         pipe.send([HIBIKE_COMMANDS.WRITE.value, [uid, param_values]])
@@ -311,27 +428,56 @@ class StateManager: # pylint: disable=too-many-public-methods
     def hibike_response_device_subbed(self, uid, delay, params):
         """
         Stores information about subscribed device.
+
+        New devices, and devices that were reset (which report a delay of
+        0), are subscribed to the params that are in use.
         """
         if delay == 0:
-            device_name = SENSOR_TYPE[uid >> 72]
-
-            if device_name in self.device_name_to_subscribe_params:
-                self.hibike_subscribe_device(
-                    self.process_mapping[PROCESS_NAMES.HIBIKE], uid, 40,
-                    self.device_name_to_subscribe_params[device_name])
+            self.subscriptions[uid] = {}
+        elif uid not in self.subscriptions:
+            self.subscriptions[uid] = dict.fromkeys(params, delay)
+        self.update_subscription(uid)
+        # The response only lists the params read at the subscription's delay
+        params = set(params) | set(self.subscriptions[uid])
         self.create_key(["hibike", "devices", uid], send=False)
+        device_params = self.state["hibike"][0]["devices"][0][uid][0]
+        for param in set(device_params) - params:
+            # No longer subscribed, so the value would only go stale
+            del device_params[param]
         for param in params:
-            self.create_key(["hibike", "devices", uid, param], send=False)
-            self.set_value(None, ["hibike", "devices", uid, param], send=False)
+            if param not in device_params:
+                # Params that were already subscribed keep their values, since
+                # Hibike only sends values again when they change
+                self.create_key(["hibike", "devices", uid, param], send=False)
+                self.set_value(None, ["hibike", "devices", uid, param], send=False)
         self.state["hibike"][0]["device_subscribed"][0] += 1
 
-    def hibike_response_device_values(self, data):
+    def hibike_response_device_values(self, data, arrivals=None):
         """
         Updates devices' values based on data.
+
+        Hibike may send only the params that changed since its last batch, so
+        params missing from ``data`` keep their previous values. ``arrivals``
+        maps UIDs to the ``time.time()`` at which their values arrived, and
+        values are timestamped with that rather than now.
         """
+        hibike = self.state["hibike"]
+        devices = hibike[0]["devices"]
+        now = time.time()
+        if arrivals is None:
+            arrivals = {}
         for uid, params in data.items():
+            if uid not in devices[0]:
+                continue
+            device = devices[0][uid]
+            device_params = device[0]
+            arrived = arrivals.get(uid, now)
             for key, value in params:
-                self.set_value(value, ["hibike", "devices", uid, key], send=False)
+                if key in device_params:
+                    device_params[key][0] = value
+                    device_params[key][1] = arrived
+            device[1] = arrived
+        devices[1] = hibike[1] = now
 
     # pylint: disable=invalid-name
     def hibike_response_device_disconnect(self, uid):
@@ -339,7 +485,88 @@ class StateManager: # pylint: disable=too-many-public-methods
         Delete any history of the device at UID.
         """
         devs = self.state["hibike"][0]["devices"][0]
-        del devs[uid]
+        # Hibike may report a device that went quiet before its port closed
+        devs.pop(uid, None)
+        self.state["hibike"][0]["stale_devices"][0].pop(uid, None)
+        self.subscriptions.pop(uid, None)
+
+    def hibike_response_device_stale(self, uid, stale):
+        """
+        Record whether the device at UID has stopped sending, so its
+        values may be out of date.
+        """
+        now = time.time()
+        stale_devices = self.state["hibike"][0]["stale_devices"]
+        if stale:
+            stale_devices[0][uid] = [True, now]
+        else:
+            stale_devices[0].pop(uid, None)
+        stale_devices[1] = now
+
+    def hibike_response_link_metrics(self, ports):
+        """
+        Store the latest traffic counters of each serial link, by port and
+        by the UID of the device on it.
+
+        When Hibike is split into shards, each reports only its own ports.
+
+        Totals over every port also go to Dawn as params of the runtime
+        version device, like the loop lag.
+        """
+        now = time.time()
+        link_metrics = self.state["hibike"][0]["link_metrics"]
+        all_ports = link_metrics[0]["ports"][0]
+        all_ports.update(ports)
+        link_metrics[0]["ports"][1] = now
+        link_metrics[0]["devices"] = [{summary["uid"]: summary
+                                       for summary in all_ports.values()
+                                       if summary["uid"] is not None}, now]
+        link_metrics[1] = now
+        runtime_device = self.state["hibike"][0]["devices"][0].get(-1)
+        if runtime_device is None:
+            return
+        for counter in ("checksum_errors", "resyncs", "rx_packet_rate", "tx_packet_rate"):
+            # Rates are None until a port has been reported twice
+            total = sum(summary[counter] or 0 for summary in all_ports.values())
+            runtime_device[0]["hibike_link_{}".format(counter)] = [float(total), now]
+        runtime_device[1] = now
+
+    def record_loop_lag(self, process_name, summary):
+        """
+        Store how late the event loop of PROCESS_NAME is running.
+
+        The percentiles also go to Dawn as params of the runtime version
+        device, since the proto has no field for them.
+        """
+        now = time.time()
+        runtime_meta = self.state["runtime_meta"]
+        loop_lag = runtime_meta[0].setdefault("loop_lag", [{}, now])
+        loop_lag[0][process_name] = [summary, now]
+        loop_lag[1] = runtime_meta[1] = now
+        runtime_device = self.state["hibike"][0]["devices"][0].get(-1)
+        if runtime_device is None:
+            return
+        for stat in ("p50", "p99"):
+            if summary[stat] is not None:
+                key = "{}_loop_lag_{}".format(process_name, stat)
+                runtime_device[0][key] = [float(summary[stat]), now]
+        runtime_device[1] = now
+
+    def record_emergency_stop_latency(self, process_name, latency):
+        """
+        Store how many milliseconds after an emergency stop PROCESS_NAME
+        disabled its devices, and pass it on to Dawn like the loop lag.
+        """
+        now = time.time()
+        runtime_meta = self.state["runtime_meta"]
+        latencies = runtime_meta[0].setdefault("e_stop_latency", [{}, now])
+        latencies[0][process_name] = [latency, now]
+        latencies[1] = runtime_meta[1] = now
+        runtime_device = self.state["hibike"][0]["devices"][0].get(-1)
+        if runtime_device is None:
+            return
+        runtime_device[0]["{}_e_stop_latency".format(process_name)] = [float(latency), now]
+        runtime_device[1] = now
 
     def hibike_response_timestamp_up(self, *data):
         """
@@ -9,6 +9,10 @@ import time
 
 from .util import *
 
+# How long the first read of a param waits for the device to start sending it, in seconds
+FIRST_READ_TIMEOUT = 0.1
+# Time in seconds between checks for the value while waiting
+FIRST_READ_POLL_INTERVAL = 0.005
 
 class Actions:
     @staticmethod
@@ -144,8 +148,12 @@ class Robot(StudentAPI):
         "led4": [(bool,)],
     }
 
-    def __init__(self, to_manager, from_manager):
+    def __init__(self, to_manager, from_manager, sensor_table=None, emergency_stop=None):
         super().__init__(to_manager, from_manager)
+        self._sensor_table = sensor_table
+        self._emergency_stop = emergency_stop
+        # (uid, param) pairs that have been read, so StateManager knows what to subscribe to
+        self._accessed_params = set()
         self._create_sensor_mapping()
         self._coroutines_running = set()
         self._stdout_buffer = io.StringIO()
@@ -156,13 +164,76 @@ class Robot(StudentAPI):
 
     def _get_all_sensors(self):
         """Get a list of sensors."""
-        self.peripherals = self._get_sm_value('hibike', 'devices')
+        if self._sensor_table is not None:
+            # Values are read from shared memory, so only the UIDs are needed
+            self.peripherals = self._sensor_table.uids()
+        else:
+            self.peripherals = self._get_sm_value('hibike', 'devices')
 
     def get_value(self, device_name, param):
-        """Get a single value from a device."""
+        """
+        Get a single value from a device.
+
+        Devices only send the params that are read, so the first read of a
+        param waits up to `FIRST_READ_TIMEOUT` seconds for the device to
+        send it. ``None`` means the device still hasn't sent it.
+        """
+        uid = self._hibike_get_uid(device_name)
+        self._check_read_params(uid, param)
+        if (uid, param) in self._accessed_params:
+            return self._read_value(device_name, uid, param)
+        self._accessed_params.add((uid, param))
+        self.to_manager.put([SM_COMMANDS.PARAMS_ACCESSED, [uid, [param]]])
+        deadline = time.monotonic() + FIRST_READ_TIMEOUT
+        value = self._read_value(device_name, uid, param)
+        while value is None and time.monotonic() < deadline:
+            time.sleep(FIRST_READ_POLL_INTERVAL)
+            self._get_all_sensors()
+            value = self._read_value(device_name, uid, param)
+        return value
+
+    def _read_value(self, device_name, uid, param):
+        """Read the latest value of a param, or None if it hasn't been sent."""
+        if self._sensor_table is not None:
+            try:
+                return self._sensor_table.get_value(uid, param)
+            except KeyError:
+                raise StudentAPIKeyError("Device {} was disconnected".format(device_name))
+        value_and_timestamp = self.peripherals[uid][0].get(param)
+        if value_and_timestamp is None:
+            return None
+        return value_and_timestamp[0]
+
+    def is_stale(self, device_name):
+        """
+        Whether a device has stopped sending, so its values may be out of date.
+        A device that stays silent for long enough is disconnected.
+        """
         uid = self._hibike_get_uid(device_name)
+        if uid is None:
+            return False
+        if self._sensor_table is not None:
+            try:
+                return self._sensor_table.is_stale(uid)
+            except KeyError:
+                raise StudentAPIKeyError("Device {} was disconnected".format(device_name))
+        return uid in self._get_sm_value('hibike', 'stale_devices')
+
+    def set_update_delay(self, device_name, param, delay):
+        """
+        Update ``param`` of a device every ``delay`` milliseconds, instead of
+        at the usual rate. Passing ``None`` goes back to the usual rate.
+        """
+        uid = self._hibike_get_uid(device_name)
+        if uid is None:
+            return
         self._check_read_params(uid, param)
-        return self.peripherals[uid][0][param][0]
+        if delay is not None:
+            if not isinstance(delay, int) or isinstance(delay, bool):
+                raise StudentAPIValueError("Update delay must be a whole number of milliseconds")
+            if not 1 <= delay <= 0xFFFF:
+                raise StudentAPIValueError("Update delay must be between 1 and 65535 milliseconds")
+        self.to_manager.put([SM_COMMANDS.SET_PARAM_DELAY, [uid, param, delay]])
 
     def set_value(self, device_name, param, value):
         """Set a parameter value for device."""
@@ -303,6 +374,8 @@ class Robot(StudentAPI):
 
     def emergency_stop(self):
         """Stop the robot."""
+        if self._emergency_stop is not None:
+            self._emergency_stop.trigger()
         self.to_manager.put([SM_COMMANDS.EMERGENCY_STOP, []])
 
     def _print(self, *args, sep=' ', end='\n', file=None, flush=False):
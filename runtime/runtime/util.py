@@ -4,8 +4,8 @@
 from enum import Enum, IntEnum, auto, unique
 import traceback
 import multiprocessing
-import os
-import json
+
+from .device_schema import DEVICE_NAMES
 
 __version__ = (1, 5, 0)
 
@@ -90,6 +90,10 @@ class HIBIKE_RESPONSE(Enum):
     DEVICE_SUBBED = "device_subscribed"
     DEVICE_VALUES = "device_values"
     DEVICE_DISCONNECT = "device_disconnected"
+    DEVICE_STALE = "device_stale"
+    LINK_METRICS = "link_metrics"
+    LOOP_LAG = "loop_lag"
+    EMERGENCY_STOP_LATENCY = "emergency_stop_latency"
     TIMESTAMP_UP  = "timestamp_up"
 
 
@@ -124,6 +128,10 @@ class SM_COMMANDS(AutoIntEnum):
     ENTER_AUTO          = auto()
     END_STUDENT_CODE    = auto()
     SET_TEAM            = auto()
+    PARAMS_ACCESSED     = auto()
+    SET_PARAM_DELAY     = auto()
+    RECORD_LOOP_LAG     = auto()
+    CLEAR_ADDR          = auto()
 
 
 class BadThing:
@@ -194,7 +202,5 @@ class StudentAPITypeError(StudentAPIError):
 
 
 # Sensor type names are CamelCase, with the first letter capitalized as well
-# TODO: could we read this ahead of time and not keep the file open?
-CONFIG_FILE = open(os.path.join(os.path.dirname(__file__), 'hibikeDevices.json'), 'r')
-SENSOR_TYPE = {device_data["id"]: device_data["name"] for device_data in json.load(CONFIG_FILE)}
+SENSOR_TYPE = dict(DEVICE_NAMES)
 SENSOR_TYPE[-1] = "runtime_version"
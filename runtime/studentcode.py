@@ -9,3 +9,12 @@ def teleop_setup():
 
 def teleop_main():
     print('Running teleop main ...')
+
+async def async_run_from_setup_coroutine():
+    print('Coroutine started from setup ran')
+
+def asyncRunFromSetup_setup():
+    Robot.run(async_run_from_setup_coroutine)
+
+def asyncRunFromSetup_main():
+    pass